@@ -0,0 +1,100 @@
+import os
+from functools import wraps
+from flask import Blueprint, jsonify, abort, request, send_from_directory
+from flask_login import login_required, current_user
+from config import ADMIN_USERS
+from llm_scheduler import llm_scheduler
+from resilient_http import http_client
+from profiling import request_profiler, memory_snapshots
+from db_routing import replica_router
+from cache_bus import cache_bus
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+def admin_required(view):
+    """Allow only users listed in ADMIN_USERS"""
+    @wraps(view)
+    @login_required
+    def wrapped(*args, **kwargs):
+        if current_user.username not in ADMIN_USERS:
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+@admin_bp.route('/metrics')
+@admin_required
+def metrics():
+    # Imported here because routes imports the app, which registers this blueprint
+    from routes import document_manager, rag_system
+
+    return jsonify({
+        'http': http_client.snapshot(),
+        'database': replica_router.snapshot(),
+        'llm_scheduler': llm_scheduler.snapshot(),
+        'ollama': rag_system.ollama.snapshot() if rag_system.ollama else None,
+        'caches': {
+            'text': _cache_stats(document_manager.text_cache),
+            'prompt_prefix': _cache_stats(rag_system.prompt_prefix_cache),
+            'vectors': {
+                **_cache_stats(rag_system.vector_store.cache),
+                'quantization': rag_system.vector_store.quantization,
+                'resident_bytes': rag_system.vector_store.memory_bytes(),
+                'budget_bytes': rag_system.vector_store.cache.max_bytes,
+                'evictions': rag_system.vector_store.cache.evictions
+            }
+        },
+        'title_index': {
+            'hits': document_manager.title_index.hits,
+            'misses': document_manager.title_index.misses
+        },
+        'ocr': document_manager.ocr.snapshot(),
+        'cache_invalidation': cache_bus.snapshot()
+    })
+
+
+@admin_bp.route('/profiling', methods=['GET', 'POST'])
+@admin_required
+def profiling_settings():
+    """Show or change this worker's profiling settings (each gunicorn worker has its own)"""
+    if request.method == 'POST':
+        data = request.json or {}
+        if 'slow_ms' in data:
+            request_profiler.slow_ms = int(data['slow_ms'])
+        if 'sample_rate' in data:
+            request_profiler.sample_rate = min(1.0, max(0.0, float(data['sample_rate'])))
+        if 'interval_ms' in data:
+            request_profiler.interval_ms = max(1.0, float(data['interval_ms']))
+    return jsonify(request_profiler.settings())
+
+
+@admin_bp.route('/profiles')
+@admin_required
+def profiles():
+    return jsonify(request_profiler.list_profiles())
+
+
+@admin_bp.route('/profiles/<name>')
+@admin_required
+def profile(name):
+    return send_from_directory(request_profiler.output_dir, os.path.basename(name), mimetype='text/plain')
+
+
+@admin_bp.route('/memory', methods=['GET', 'POST', 'DELETE'])
+@admin_required
+def memory():
+    """tracemalloc for this worker: POST starts it, GET takes a snapshot, DELETE stops it"""
+    if request.method == 'POST':
+        return jsonify(memory_snapshots.start())
+    if request.method == 'DELETE':
+        return jsonify(memory_snapshots.stop())
+    limit = request.args.get('limit', 25, type=int)
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        abort(400)
+    return jsonify(memory_snapshots.snapshot(limit=limit, group_by=group_by))
+
+
+def _cache_stats(cache):
+    return {'entries': len(cache), 'hits': cache.hits, 'misses': cache.misses}
@@ -6,6 +6,8 @@ from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager
 from config import MAX_CONTENT_LENGTH, UPLOAD_FOLDER
+from db_routing import RoutingSession, engine_options, replica_router
+from llm_scheduler import llm_scheduler
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,8 +19,8 @@ logger = logging.getLogger(__name__)
 class Base(DeclarativeBase):
     pass
 
-# Initialize SQLAlchemy
-db = SQLAlchemy(model_class=Base)
+# Initialize SQLAlchemy; the session sends read-only views' queries to replicas
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -27,10 +29,8 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Configure database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+app.config["SQLALCHEMY_BINDS"] = replica_router.binds()
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Configure file uploads
@@ -43,6 +43,9 @@ logger.info(f"Upload folder configured at: {UPLOAD_FOLDER}")
 
 # Initialize the database with the app
 db.init_app(app)
+with app.app_context():
+    replica_router.init_app(app, db)
+    llm_scheduler.init_app(app, db)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -54,15 +57,48 @@ with app.app_context():
     import models
     db.create_all()
 
+    # create_all() doesn't add columns to existing tables
+    db.session.execute(db.text(
+        "ALTER TABLE document_chunk ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0"))
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_document_chunk_generation ON document_chunk (generation)"))
+    db.session.execute(db.text("ALTER TABLE chat_session ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP"))
+    db.session.execute(db.text("ALTER TABLE chat_session ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP"))
+    db.session.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_session_last_message_at ON chat_session (last_message_at)"))
+    db.session.execute(db.text("ALTER TABLE reindex_job ADD COLUMN IF NOT EXISTS failed_ids TEXT NOT NULL DEFAULT '[]'"))
+    db.session.execute(db.text("ALTER TABLE import_job ADD COLUMN IF NOT EXISTS directory VARCHAR(500)"))
+    db.session.execute(db.text("ALTER TABLE import_job ADD COLUMN IF NOT EXISTS owner VARCHAR(100)"))
+    db.session.execute(db.text("ALTER TABLE import_job ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP"))
+    db.session.commit()
+
+    # Chat messages are written to monthly partitions, created ahead here and then hourly (see init_app below)
+    from chat_archive import chat_partitions
+    if chat_partitions.is_partitioned():
+        chat_partitions.ensure()
+    else:
+        logger.warning("chat_message is not partitioned yet; run `flask partition-chat-messages`")
+
 # Import routes after models to avoid circular imports
 from auth import auth_bp
 app.register_blueprint(auth_bp)
+from admin import admin_bp
+app.register_blueprint(admin_bp)
+
+# Request profiling hooks (idle unless enabled or asked for by an admin)
+from profiling import request_profiler
+request_profiler.init_app(app)
+from cache_bus import cache_bus
+cache_bus.init_app(app)
+chat_partitions.init_app(app)
 
 # Load user
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    return User.query.get(int(user_id))
+    # Runs on every request; a few seconds of replica lag are fine for the user row
+    with replica_router.reading():
+        return User.query.get(int(user_id))
 
 # Error handlers
 @app.errorhandler(404)
@@ -81,3 +117,6 @@ def inject_now():
 
 # Import routes (must be after all configurations)
 import routes
+
+# Register CLI commands
+import commands
@@ -0,0 +1,341 @@
+"""
+Bulk library import from a zip of PDFs and/or a BibTeX file.
+
+An import is planned from the uploaded files (BibTeX entries matched to the
+PDFs they name, and PDFs without an entry), then resolved in bulk: entries
+with a DOI or arXiv id go through the Semantic Scholar /paper/batch endpoint
+S2_BATCH_SIZE ids per request, and only entries with neither fall back to
+one title lookup each. Papers are then ingested IMPORT_WORKERS at a time
+through the same path as single uploads; ImportItem rows record each
+paper's outcome and make up the job's progress report.
+
+A running import refreshes its job's heartbeat every IMPORT_HEARTBEAT_S.
+If its worker dies (a gunicorn restart, a deploy), the heartbeat goes
+stale and the next progress poll, or `flask resume-imports`, takes the
+job over and ingests the papers still pending.
+"""
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from app import db
+from models import ImportJob, ImportItem
+from llm_scheduler import LLMBusyError
+from resilient_http import http_client
+from import_plan import plan_import
+from config import (IMPORT_WORKERS, IMPORT_MAX_MB, IMPORT_MAX_PAPERS, IMPORT_DIR, IMPORT_HEARTBEAT_S, IMPORT_STALE_S,
+                    MAX_CONTENT_LENGTH, SEMANTIC_SCHOLAR_API_KEY, S2_BATCH_SIZE)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+S2_BATCH_URL = "https://api.semanticscholar.org/graph/v1/paper/batch"
+S2_FIELDS = "title,openAccessPdf,externalIds"
+
+# Times a paper waits out a busy LLM scheduler (citation extraction) before it counts as failed
+LLM_BUSY_RETRIES = 3
+
+# Failed papers listed in a progress report
+MAX_REPORTED_FAILURES = 50
+
+UNFINISHED = ('resolving', 'importing')
+
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class BulkImporter:
+    """Runs library imports in the background of this worker"""
+
+    def __init__(self, ingestor, workers=IMPORT_WORKERS, base_dir=IMPORT_DIR):
+        self.ingestor = ingestor
+        self.document_manager = ingestor.document_manager
+        self.base_dir = base_dir
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import")
+
+    def start(self, user_id, archive=None, bibtex=None, with_citations=False):
+        """
+        Unpack the uploaded files and start importing them
+
+        Args:
+            archive (FileStorage, optional): Zip of PDFs (and .bib files)
+            bibtex (FileStorage, optional): BibTeX file
+
+        Returns:
+            ImportJob: The new job
+
+        Raises:
+            ValueError: The upload holds nothing to import
+        """
+        directory = os.path.join(self.base_dir, uuid.uuid4().hex)
+        os.makedirs(directory)
+        try:
+            if archive is not None:
+                self._unpack(archive, directory)
+            if bibtex is not None:
+                bibtex.save(os.path.join(directory, 'upload.bib'))
+            if not any(name.lower().endswith(('.pdf', '.bib')) for name in os.listdir(directory)):
+                raise ValueError("The upload contains no PDF or BibTeX file")
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        job = ImportJob(user_id=user_id, with_citations=with_citations, status='resolving', directory=directory,
+                        owner=_owner(), heartbeat_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.commit()
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run, args=(app, job.id), name=f"import-{job.id}", daemon=True).start()
+        return job
+
+    def stale_jobs(self):
+        """Unfinished jobs whose process has stopped refreshing their heartbeat"""
+        return ImportJob.query.filter(ImportJob.status.in_(UNFINISHED),
+                                      func.coalesce(ImportJob.heartbeat_at, ImportJob.created_at) < self._stale_before()) \
+            .order_by(ImportJob.id).all()
+
+    def take_over(self, job):
+        """
+        Claim a stale job for this process
+
+        Returns:
+            bool: False if the job is not stale (any more), e.g. because another process took it first
+        """
+        claimed = ImportJob.query.filter(
+            ImportJob.id == job.id, ImportJob.status.in_(UNFINISHED),
+            func.coalesce(ImportJob.heartbeat_at, ImportJob.created_at) < self._stale_before()) \
+            .update({'owner': _owner(), 'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            logger.warning(f"Import job {job.id} stopped in {job.owner}; resuming it in {_owner()}")
+        return bool(claimed)
+
+    def resume(self, job, background=True):
+        """Continue a job claimed with take_over, in a thread or in the caller's"""
+        app = current_app._get_current_object()
+        if background:
+            threading.Thread(target=self._run, args=(app, job.id), name=f"import-{job.id}", daemon=True).start()
+        else:
+            self._run(app, job.id)
+
+    def fail(self, job, reason):
+        """Give up on a job, with its pending papers"""
+        ImportItem.query.filter_by(job_id=job.id, status='pending').update(
+            {'status': 'failed', 'error': reason[:500]}, synchronize_session=False)
+        ImportJob.query.filter_by(id=job.id).update(
+            {'status': 'failed', 'error': reason[:500], 'finished_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if job.directory:
+            shutil.rmtree(job.directory, ignore_errors=True)
+
+    def progress(self, job):
+        """Aggregated progress of a job, with the papers that failed; a stale job is resumed here"""
+        if job.status in UNFINISHED and (job.heartbeat_at or job.created_at) < self._stale_before() \
+                and self.take_over(job):
+            self.resume(job)
+        counts = dict(db.session.query(ImportItem.status, func.count(ImportItem.id))
+                      .filter(ImportItem.job_id == job.id).group_by(ImportItem.status).all())
+        failures = ImportItem.query.filter_by(job_id=job.id, status='failed') \
+            .order_by(ImportItem.id).limit(MAX_REPORTED_FAILURES).all()
+        end = job.finished_at or datetime.utcnow()
+        return {
+            'id': job.id,
+            'status': job.status,
+            'error': job.error,
+            'total': job.total,
+            'imported': counts.get('imported', 0),
+            'failed': counts.get('failed', 0),
+            'pending': counts.get('pending', 0),
+            'elapsed_s': round((end - job.created_at).total_seconds()),
+            'failures': [{'title': item.title, 'error': item.error} for item in failures]
+        }
+
+    def _run(self, app, job_id):
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(app, job_id, stop), name=f"import-{job_id}-heartbeat",
+                         daemon=True).start()
+        try:
+            self._import(app, job_id)
+        finally:
+            stop.set()
+
+    def _heartbeat(self, app, job_id, stop):
+        while not stop.wait(IMPORT_HEARTBEAT_S):
+            with app.app_context():
+                try:
+                    ImportJob.query.filter_by(id=job_id).update({'heartbeat_at': datetime.utcnow()})
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error recording the heartbeat of import job {job_id}: {e}")
+
+    def _import(self, app, job_id):
+        with app.app_context():
+            job = ImportJob.query.get(job_id)
+            directory = job.directory or ""  # jobs started before directories were recorded have none
+            try:
+                if job.status == 'resolving':
+                    if not directory or not os.path.isdir(directory):
+                        raise ValueError("The uploaded files are no longer available; upload them again")
+                    planned = plan_import(directory)
+                    self._resolve(planned)
+                    items = [ImportItem(job_id=job_id, title=entry['title'][:500], doi=entry['doi'],
+                                        filename=entry['filename'], pdf_url=entry['pdf_url']) for entry in planned]
+                    db.session.add_all(items)
+                    job.total = len(items)
+                    job.status = 'importing'
+                    db.session.commit()
+                    item_ids = [item.id for item in items]
+                else:
+                    # Resumed: papers the previous process finished keep their outcome
+                    item_ids = [item.id for item in ImportItem.query.with_entities(ImportItem.id)
+                                .filter_by(job_id=job_id, status='pending').order_by(ImportItem.id)]
+                user_id, with_citations = job.user_id, job.with_citations
+                logger.info(f"Import job {job_id}: {len(item_ids)} papers to ingest")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error planning import job {job_id}: {e}")
+                ImportJob.query.filter_by(id=job_id).update(
+                    {'status': 'failed', 'error': str(e)[:500], 'finished_at': datetime.utcnow()})
+                db.session.commit()
+                shutil.rmtree(directory, ignore_errors=True)
+                return
+
+        started = time.monotonic()
+        wait([self.executor.submit(self._ingest_item, app, item_id, directory, user_id, with_citations)
+              for item_id in item_ids])
+        shutil.rmtree(directory, ignore_errors=True)
+
+        with app.app_context():
+            ImportJob.query.filter_by(id=job_id).update({'status': 'completed', 'finished_at': datetime.utcnow()})
+            db.session.commit()
+        logger.info(f"Import job {job_id} finished in {time.monotonic() - started:.0f}s")
+
+    def _stale_before(self):
+        return datetime.utcnow() - timedelta(seconds=IMPORT_STALE_S)
+
+    def _unpack(self, archive, directory):
+        """Extract the PDFs and .bib files of a zip, flattened to unique base names"""
+        try:
+            with zipfile.ZipFile(archive.stream) as zip_file:
+                members = [member for member in zip_file.infolist() if not member.is_dir()
+                           and not member.filename.startswith('__MACOSX/')
+                           and member.filename.lower().endswith(('.pdf', '.bib'))]
+                if len(members) > IMPORT_MAX_PAPERS:
+                    raise ValueError(f"The archive holds more than {IMPORT_MAX_PAPERS} files")
+                # Guard against archives that expand far beyond their upload size
+                if sum(member.file_size for member in members) > 4 * IMPORT_MAX_MB * 1024 * 1024:
+                    raise ValueError("The archive is too large once unpacked")
+                for member in members:
+                    if member.filename.lower().endswith('.pdf') and member.file_size > MAX_CONTENT_LENGTH:
+                        logger.warning(f"Skipping {member.filename}: larger than the upload limit")
+                        continue
+                    name = secure_filename(os.path.basename(member.filename)) or f"{uuid.uuid4().hex[:8]}.pdf"
+                    while os.path.exists(os.path.join(directory, name)):
+                        stem, extension = os.path.splitext(name)
+                        name = f"{stem}_{uuid.uuid4().hex[:4]}{extension}"
+                    with zip_file.open(member) as source, open(os.path.join(directory, name), 'wb') as target:
+                        shutil.copyfileobj(source, target)
+        except zipfile.BadZipFile:
+            raise ValueError("The archive is not a valid zip file")
+
+    def _resolve(self, planned):
+        """Fill in canonical titles and open-access PDF links, batching every lookup by id"""
+        by_id = {}
+        for entry in planned:
+            if entry['doi']:
+                by_id.setdefault(f"DOI:{entry['doi']}", []).append(entry)
+            elif entry['arxiv']:
+                by_id.setdefault(f"ARXIV:{entry['arxiv']}", []).append(entry)
+
+        headers = {'x-api-key': SEMANTIC_SCHOLAR_API_KEY} if SEMANTIC_SCHOLAR_API_KEY else {}
+        ids = list(by_id)
+        for start in range(0, len(ids), S2_BATCH_SIZE):
+            batch = ids[start:start + S2_BATCH_SIZE]
+            try:
+                response = http_client.post(S2_BATCH_URL, params={"fields": S2_FIELDS}, json={"ids": batch},
+                                            headers=headers)
+                response.raise_for_status()
+                papers = response.json()
+            except Exception as e:
+                logger.error(f"Semantic Scholar batch lookup of {len(batch)} ids failed: {e}")
+                continue
+            # One result per id, in order; null for ids Semantic Scholar doesn't know
+            for paper_key, paper in zip(batch, papers):
+                if not paper:
+                    continue
+                open_access_pdf = (paper.get('openAccessPdf') or {}).get('url')
+                self.document_manager.title_index.add(
+                    title=paper.get('title') or by_id[paper_key][0]['title'],
+                    open_access_pdf=open_access_pdf,
+                    paper_id=paper.get('paperId'),
+                    doi=(paper.get('externalIds') or {}).get('DOI')
+                )
+                for entry in by_id[paper_key]:
+                    entry['title'] = paper.get('title') or entry['title']
+                    entry['pdf_url'] = open_access_pdf
+                    entry['resolved'] = True
+            logger.info(f"Resolved {len(batch)} ids in one Semantic Scholar batch request")
+        db.session.commit()
+
+        # Entries without a PDF that no id resolved: the title index, then one title search each
+        for entry in planned:
+            if entry['filename'] is None and not entry.get('resolved'):
+                metadata = self.document_manager._search_citation(entry['title'])
+                if metadata:
+                    entry['pdf_url'] = metadata.get('openAccessPdf')
+        db.session.commit()
+
+    def _ingest_item(self, app, item_id, directory, user_id, with_citations):
+        with app.app_context():
+            item = ImportItem.query.get(item_id)
+            try:
+                if item.filename:
+                    path = os.path.join(directory, item.filename)
+                    if not directory or not os.path.exists(path):
+                        # The job was resumed on another host than the one it was uploaded to
+                        raise ValueError("The uploaded PDF is no longer available")
+                    stream = open(path, 'rb')
+                elif item.pdf_url:
+                    stream = self.document_manager._download_pdf({'openAccessPdf': item.pdf_url})
+                    if stream is None:
+                        raise ValueError("The open-access PDF could not be downloaded")
+                else:
+                    raise ValueError("No PDF was uploaded and no open-access PDF was found")
+
+                file = FileStorage(stream=stream, content_type='application/pdf',
+                                   filename=item.filename or secure_filename(f"{item.title[:80]}.pdf"))
+                try:
+                    for attempt in range(LLM_BUSY_RETRIES + 1):
+                        try:
+                            document = self.ingestor.ingest(file, item.title, user_id,
+                                                            crawl_citations=with_citations)
+                            break
+                        except LLMBusyError as e:
+                            db.session.rollback()
+                            if attempt == LLM_BUSY_RETRIES:
+                                raise
+                            time.sleep(e.retry_after)
+                finally:
+                    stream.close()
+
+                item = ImportItem.query.get(item_id)
+                item.status = 'imported'
+                item.document_id = document.id
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error importing '{item.title}' (import item {item_id}): {e}")
+                ImportItem.query.filter_by(id=item_id).update({'status': 'failed', 'error': str(e)[:500]})
+                db.session.commit()
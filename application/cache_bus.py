@@ -0,0 +1,222 @@
+"""
+Cache invalidation across worker processes and instances over Postgres LISTEN/NOTIFY.
+
+Write paths publish what changed as a kind plus keys. Every worker runs a
+listener thread that passes the keys to the handlers subscribed to that
+kind, which drop their cached copies; the publishing process updates its
+own caches itself. Handlers are told whether the change was made on this
+host, since local disk copies (text artifacts, vector shards) are only
+stale on other hosts. A listener that lost its connection may have missed
+messages, so on every (re)connect each handler is called with key None,
+meaning "drop everything held in memory".
+"""
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+import psycopg2
+from sqlalchemy.engine import make_url
+from config import CACHE_BUS_DATABASE_URL, CACHE_BUS_CHANNEL, DB_CONNECT_TIMEOUT_S
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Kinds of change, and what their keys are
+TEXT = 'text'  # PDF blob names whose extracted text was replaced or deleted
+DOCUMENT = 'document'  # document ids whose prompt prefix is stale
+VECTORS = 'vectors'  # vector families with a document saved or deleted
+
+# NOTIFY payloads must stay under 8000 bytes
+MAX_PAYLOAD_BYTES = 7000
+
+# Idle listeners check their connection this often, so a dead one is noticed without traffic
+KEEPALIVE_S = 60
+RECONNECT_MAX_S = 30
+
+
+class InvalidationBus:
+    """Publishes cache invalidations and delivers other processes' ones to subscribed handlers"""
+
+    def __init__(self, url=CACHE_BUS_DATABASE_URL, channel=CACHE_BUS_CHANNEL):
+        self.dsn = _libpq_dsn(url)
+        self.channel = channel
+        self.host = socket.gethostname()
+        self._handlers = defaultdict(list)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._origin = None
+        self._connection = None
+        self._inherited = []
+        self._thread = None
+        self.listening = False
+        self.stats = Counter()
+        if self.dsn is None:
+            logger.warning("No PostgreSQL URL for cache invalidation; caches of other processes may go stale")
+
+    def init_app(self, app):
+        app.before_request(self.start)
+
+    def subscribe(self, kind, handler):
+        """
+        Call handler(key, same_host) from the listener thread for each key other processes publish
+
+        key is None when every entry may be stale.
+        """
+        self._handlers[kind].append(handler)
+
+    def publish(self, kind, keys):
+        """
+        Tell every other worker, on every instance, that cached data under these keys changed
+
+        Sent immediately rather than on commit: the caches hold copies of blob and
+        disk data, which has already been written (or deleted) by the time this is called.
+        """
+        keys = list(keys)
+        if self.dsn is None or not keys:
+            return
+        self._check_fork()
+        payloads = self._payloads(kind, keys)
+        # One retry on a fresh connection, since a dropped invalidation leaves caches stale
+        for attempt in range(2):
+            try:
+                with self._lock:
+                    if self._connection is None or self._connection.closed:
+                        self._connection = self._connect()
+                    with self._connection.cursor() as cursor:
+                        for payload in payloads:
+                            cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                self.stats["published"] += len(keys)
+                return
+            except Exception as e:
+                with self._lock:
+                    self._close_connection()
+                if attempt:
+                    logger.error(f"Error publishing {kind} invalidation of {len(keys)} keys: {e}")
+                    self.stats["publish_errors"] += 1
+
+    def start(self):
+        """Start this process's listener (on its first request, so after gunicorn has forked)"""
+        if self.dsn is None:
+            return
+        self._check_fork()
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="cache-bus", daemon=True)
+                self._thread.start()
+
+    def snapshot(self):
+        return {"channel": self.channel, "listening": self.listening, **self.stats}
+
+    def _listen(self):
+        delay = 1
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                self.listening = True
+                delay = 1
+                # Anything published before this point (or while disconnected) was not received
+                self._deliver(None, None, True)
+                while True:
+                    if select.select([connection], [], [], KEEPALIVE_S) == ([], [], []):
+                        with connection.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                    connection.poll()
+                    while connection.notifies:
+                        self._receive(connection.notifies.pop(0).payload)
+            except Exception as e:
+                self.listening = False
+                self.stats["reconnects"] += 1
+                logger.error(f"Cache invalidation listener disconnected, retrying in {delay}s: {e}")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_S)
+
+    def _receive(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed cache invalidation: {payload[:100]}")
+            return
+        if message.get("origin") == self._origin:
+            return
+        self.stats["received"] += len(message["keys"])
+        for key in message["keys"]:
+            self._deliver(message["kind"], key, message.get("host") == self.host)
+
+    def _deliver(self, kind, key, same_host):
+        """Call the handlers of one kind, or with kind None every handler"""
+        kinds = [kind] if kind is not None else list(self._handlers)
+        for handler_kind in kinds:
+            for handler in self._handlers.get(handler_kind, ()):
+                try:
+                    handler(key, same_host)
+                except Exception as e:
+                    logger.error(f"Error invalidating {handler_kind} cache entry {key}: {e}")
+
+    def _payloads(self, kind, keys):
+        """Split keys into messages that fit a NOTIFY payload"""
+        payloads, batch = [], []
+        for key in keys:
+            batch.append(key)
+            if len(batch) > 1 and len(self._message(kind, batch).encode('utf-8')) > MAX_PAYLOAD_BYTES:
+                payloads.append(self._message(kind, batch[:-1]))
+                batch = [key]
+        payloads.append(self._message(kind, batch))
+        return payloads
+
+    def _message(self, kind, keys):
+        return json.dumps({"origin": self._origin, "host": self.host, "kind": kind, "keys": keys})
+
+    def _connect(self):
+        connection = psycopg2.connect(self.dsn, connect_timeout=DB_CONNECT_TIMEOUT_S)
+        connection.autocommit = True
+        return connection
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _check_fork(self):
+        """Give each process its own identity, publishing connection and listener"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._connection is not None:
+                # The parent's connection: closing (or garbage collecting) it here would end the parent's session
+                self._inherited.append(self._connection)
+                self._connection = None
+            self._pid = os.getpid()
+            self._origin = f"{self.host}:{self._pid}:{uuid.uuid4().hex[:8]}"
+            self._thread = None
+            self.listening = False
+
+
+def _libpq_dsn(url):
+    """A libpq connection URI for a SQLAlchemy PostgreSQL URL, or None for other databases"""
+    if not url or not url.startswith('postgres'):
+        return None
+    return make_url(url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+# One per worker process
+cache_bus = InvalidationBus()
@@ -0,0 +1,405 @@
+"""
+Chat history storage: monthly partitions of chat_message and a cold archive.
+
+chat_message is range-partitioned by month on timestamp, so inserts go to a
+small current partition and reads filtered on timestamp skip older ones.
+Partitions are created ahead at startup and then periodically by each worker;
+a DEFAULT partition takes rows for months that have none yet, which move to
+their month's partition once it is created.
+Sessions idle for CHAT_ARCHIVE_AFTER_DAYS are moved to blob storage as
+gzipped JSON (cool tier) and their rows deleted; opening such a session
+brings its messages back. Monthly partitions left empty by archival are
+dropped, so the hot table holds only recently active sessions.
+"""
+import gzip
+import json
+import logging
+import re
+import time
+from datetime import datetime, timedelta
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings, StandardBlobTier
+from sqlalchemy import and_, or_
+from app import db
+from models import ChatMessage, ChatSession
+from config import (CHAT_PARTITION_MONTHS_AHEAD, CHAT_PARTITION_CHECK_INTERVAL_S, CHAT_ARCHIVE_AFTER_DAYS,
+                    CHAT_ARCHIVE_PREFIX)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+TABLE = 'chat_message'
+# Catches rows of months without a partition, so an insert never fails for want of one
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+# Serializes partition DDL across workers (transaction-scoped advisory lock key)
+PARTITION_LOCK_KEY = 'chat_message_partitions'
+
+PARTITION_BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _parse_bound(value):
+    """A partition bound from pg_get_expr, None for MINVALUE/MAXVALUE"""
+    value = value.strip("'")
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value)
+
+
+class ChatPartitions:
+    """Monthly range partitions of chat_message"""
+
+    def __init__(self, check_interval=CHAT_PARTITION_CHECK_INTERVAL_S):
+        self.check_interval = check_interval
+        self._checked_at = None
+
+    def init_app(self, app):
+        app.before_request(self.ensure_due)
+
+    def ensure_due(self):
+        """Run ensure() if this process hasn't checked for check_interval seconds (there is no cron on App Service)"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            if self.is_partitioned():
+                self.ensure()
+            db.session.commit()
+        except Exception as e:
+            # Rows still land in the DEFAULT partition; try again after the next interval
+            db.session.rollback()
+            logger.error(f"Periodic chat message partition check failed: {e}")
+
+    def is_partitioned(self):
+        return db.session.execute(db.text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+            {"table": TABLE}).first() is not None
+
+    def existing(self):
+        """
+        Returns:
+            list: (name, lower bound, upper bound) per partition, oldest first; None bounds are open
+        """
+        rows = db.session.execute(db.text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)"),
+            {"table": TABLE}).all()
+        partitions = []
+        for name, bound in rows:
+            match = PARTITION_BOUND.search(bound)
+            if match:
+                partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+        partitions.sort(key=lambda partition: partition[1] or datetime.min)
+        return partitions
+
+    def ensure(self, months_ahead=CHAT_PARTITION_MONTHS_AHEAD, months=()):
+        """
+        Create the partitions of the current month, the next months_ahead months and any given months
+
+        Also creates the DEFAULT partition if missing. Rows already in the DEFAULT
+        partition for a month being created are moved to the new partition.
+
+        Returns:
+            list: Names of the partitions created
+        """
+        current = _month_start(datetime.utcnow())
+        wanted = {current}
+        for _ in range(months_ahead):
+            current = _next_month(current)
+            wanted.add(current)
+        wanted.update(_month_start(month) for month in months)
+
+        created = []
+        try:
+            db.session.execute(db.text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": PARTITION_LOCK_KEY})
+            db.session.execute(db.text(
+                f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+            partitions = self.existing()
+            for month in sorted(wanted):
+                end = _next_month(month)
+                # A range may already be covered, e.g. by the pre-partitioning table attached as a partition
+                if any((lower is None or lower < end) and (upper is None or upper > month)
+                       for _, lower, upper in partitions):
+                    continue
+                name = f"{TABLE}_p{month:%Y%m}"
+                bounds = f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+                in_range = f"timestamp >= '{month:%Y-%m-%d}' AND timestamp < '{end:%Y-%m-%d}'"
+                if db.session.execute(db.text(
+                        f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range} LIMIT 1")).first() is None:
+                    db.session.execute(db.text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} {bounds}"))
+                else:
+                    # A partition can't be created while the DEFAULT partition holds rows in its range
+                    db.session.execute(db.text(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)"))
+                    db.session.execute(db.text(
+                        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {in_range} RETURNING *) "
+                        f"INSERT INTO {name} SELECT * FROM moved"))
+                    db.session.execute(db.text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} {bounds}"))
+                created.append(name)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error creating chat message partitions: {e}")
+            raise
+        if created:
+            logger.info(f"Created chat message partitions {', '.join(created)}")
+        return created
+
+    def drop_empty(self, before):
+        """
+        Drop partitions that end on or before the given time and hold no rows
+
+        Returns:
+            list: Names of the partitions dropped
+        """
+        dropped = []
+        try:
+            db.session.execute(db.text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": PARTITION_LOCK_KEY})
+            for name, _, upper in self.existing():
+                if upper is None or upper > before:
+                    continue
+                if db.session.execute(db.text(f"SELECT 1 FROM {name} LIMIT 1")).first() is None:
+                    db.session.execute(db.text(f"DROP TABLE {name}"))
+                    dropped.append(name)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error dropping chat message partitions: {e}")
+            raise
+        if dropped:
+            logger.info(f"Dropped empty chat message partitions {', '.join(dropped)}")
+        return dropped
+
+    def migrate(self):
+        """
+        Turn an unpartitioned chat_message table into a partitioned one, without copying rows
+
+        The existing table is attached as the partition of everything before next
+        month; it is dropped by drop_empty once archival has emptied it.
+
+        Returns:
+            bool: False if the table was already partitioned
+        """
+        if self.is_partitioned():
+            return False
+        cutover = _next_month(_month_start(datetime.utcnow()))
+        statements = [
+            f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE",
+            "UPDATE chat_session SET last_message_at = COALESCE("
+            f"(SELECT max(m.timestamp) FROM {TABLE} m WHERE m.session_id = chat_session.id), created_at) "
+            "WHERE last_message_at IS NULL",
+            # The partition key must be NOT NULL
+            f"UPDATE {TABLE} SET timestamp = s.created_at FROM chat_session s "
+            f"WHERE {TABLE}.session_id = s.id AND {TABLE}.timestamp IS NULL",
+            f"ALTER TABLE {TABLE} ALTER COLUMN timestamp SET NOT NULL",
+            f"ALTER TABLE {TABLE} RENAME TO {TABLE}_legacy",
+            f"ALTER TABLE {TABLE}_legacy RENAME CONSTRAINT {TABLE}_pkey TO {TABLE}_legacy_pkey",
+            # Replaced by the partitioned table's foreign key, which cascades
+            f"ALTER TABLE {TABLE}_legacy DROP CONSTRAINT IF EXISTS {TABLE}_session_id_fkey",
+            f"CREATE TABLE {TABLE} ("
+            f"id INTEGER NOT NULL DEFAULT nextval('{TABLE}_id_seq'), "
+            "content TEXT NOT NULL, "
+            "is_user BOOLEAN, "
+            "timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+            "session_id INTEGER NOT NULL REFERENCES chat_session (id) ON DELETE CASCADE, "
+            "PRIMARY KEY (id, timestamp)"
+            ") PARTITION BY RANGE (timestamp)",
+            f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id",
+            f"CREATE INDEX ix_chat_message_session_timestamp ON {TABLE} (session_id, timestamp)",
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {TABLE}_legacy "
+            f"FOR VALUES FROM (MINVALUE) TO ('{cutover:%Y-%m-%d}')",
+        ]
+        try:
+            for statement in statements:
+                db.session.execute(db.text(statement))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error partitioning {TABLE}: {e}")
+            raise
+        logger.info(f"Partitioned {TABLE}; existing rows kept in {TABLE}_legacy (before {cutover:%Y-%m-%d})")
+        self.ensure()
+        return True
+
+
+class ChatArchiver:
+    """Moves idle chat sessions to blob storage and back"""
+
+    def __init__(self, container_client, partitions=None, after_days=CHAT_ARCHIVE_AFTER_DAYS,
+                 prefix=CHAT_ARCHIVE_PREFIX):
+        self.container_client = container_client
+        self.partitions = partitions or ChatPartitions()
+        self.after_days = after_days
+        self.prefix = prefix
+
+    def messages(self, chat_session):
+        """A session's hot messages in order, reading only partitions from its creation on"""
+        return ChatMessage.query.filter(
+            ChatMessage.session_id == chat_session.id,
+            ChatMessage.timestamp >= chat_session.created_at
+        ).order_by(ChatMessage.timestamp, ChatMessage.id).all()
+
+    def archive_idle(self, batch_size=100, limit=None, dry_run=False):
+        """
+        Archive every session without messages for after_days, in id order
+
+        Returns:
+            dict: Counts of sessions archived, skipped (active after all) and failed
+        """
+        if self.container_client is None:
+            raise RuntimeError("Blob storage is not configured; chat sessions cannot be archived")
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        counts = {"archived": 0, "skipped": 0, "failed": 0}
+        last_id = 0
+        while limit is None or counts["archived"] < limit:
+            session_ids = [row.id for row in ChatSession.query.with_entities(ChatSession.id).filter(
+                ChatSession.id > last_id,
+                ChatSession.archived_at.is_(None),
+                or_(ChatSession.last_message_at < cutoff,
+                    and_(ChatSession.last_message_at.is_(None), ChatSession.created_at < cutoff))
+            ).order_by(ChatSession.id).limit(batch_size)]
+            if not session_ids:
+                break
+            last_id = session_ids[-1]
+            for session_id in session_ids:
+                if dry_run:
+                    counts["archived"] += 1
+                    continue
+                result = self.archive_session(session_id, cutoff)
+                counts[result] += 1
+        if not dry_run:
+            self.partitions.drop_empty(_month_start(cutoff))
+        return counts
+
+    def archive_session(self, session_id, cutoff):
+        """
+        Upload one session's messages and delete them from chat_message
+
+        The session row stays locked until the rows are deleted, so a message
+        sent meanwhile waits and sees the session archived (and restores it).
+
+        Returns:
+            str: 'archived', 'skipped' or 'failed'
+        """
+        try:
+            chat_session = ChatSession.query.filter_by(id=session_id).with_for_update().first()
+            if chat_session is None or chat_session.archived_at is not None:
+                db.session.rollback()
+                return "skipped"
+            messages = self.messages(chat_session)
+            newest = messages[-1].timestamp if messages else chat_session.created_at
+            if newest >= cutoff:
+                # last_message_at was missing or stale
+                chat_session.last_message_at = newest
+                db.session.commit()
+                return "skipped"
+
+            payload = gzip.compress(json.dumps({
+                "session_id": chat_session.id,
+                "messages": [{
+                    "id": message.id,
+                    "content": message.content,
+                    "is_user": message.is_user,
+                    "timestamp": message.timestamp.isoformat()
+                } for message in messages]
+            }).encode('utf-8'))
+            self.container_client.get_blob_client(self._blob_name(chat_session)).upload_blob(
+                payload,
+                content_settings=ContentSettings(content_type='application/json', content_encoding='gzip'),
+                standard_blob_tier=StandardBlobTier.COOL,
+                overwrite=True)
+
+            if messages:
+                ChatMessage.query.filter(
+                    ChatMessage.session_id == chat_session.id,
+                    ChatMessage.timestamp >= messages[0].timestamp,
+                    ChatMessage.timestamp <= newest
+                ).delete(synchronize_session=False)
+            chat_session.last_message_at = newest
+            chat_session.archived_at = datetime.utcnow()
+            db.session.commit()
+            logger.info(f"Archived chat session {session_id} ({len(messages)} messages, {len(payload)} bytes)")
+            return "archived"
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error archiving chat session {session_id}: {e}")
+            return "failed"
+
+    def restore(self, chat_session):
+        """
+        Bring an archived session's messages back into chat_message
+
+        Returns:
+            bool: True if the session is (now) hot
+        """
+        if chat_session.archived_at is None:
+            return True
+        session_id = chat_session.id
+        blob_name = self._blob_name(chat_session)
+        try:
+            payload = self.container_client.get_blob_client(blob_name).download_blob().readall()
+            rows = [{
+                "id": message["id"],
+                "content": message["content"],
+                "is_user": message["is_user"],
+                "timestamp": datetime.fromisoformat(message["timestamp"]),
+                "session_id": session_id
+            } for message in json.loads(gzip.decompress(payload))["messages"]]
+            if rows:
+                # Old months' partitions may have been dropped once archival emptied them
+                self.partitions.ensure(months_ahead=0, months=[row["timestamp"] for row in rows])
+
+            chat_session = ChatSession.query.filter_by(id=session_id).with_for_update().populate_existing().first()
+            if chat_session is None or chat_session.archived_at is None:
+                # Deleted or restored by another request meanwhile
+                db.session.commit()
+                return chat_session is not None
+            if rows:
+                db.session.execute(ChatMessage.__table__.insert(), rows)
+            chat_session.archived_at = None
+            db.session.commit()
+            logger.info(f"Restored chat session {session_id} ({len(rows)} messages)")
+        except ResourceNotFoundError:
+            db.session.rollback()
+            logger.error(f"Archive {blob_name} of chat session {session_id} is missing")
+            return False
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error restoring chat session {session_id}: {e}")
+            return False
+        self._delete_blob(blob_name)
+        return True
+
+    def delete_session(self, chat_session):
+        """Delete a session, its hot messages and its archive (the caller commits)"""
+        ChatMessage.query.filter(
+            ChatMessage.session_id == chat_session.id,
+            ChatMessage.timestamp >= chat_session.created_at
+        ).delete(synchronize_session=False)
+        if chat_session.archived_at is not None:
+            self._delete_blob(self._blob_name(chat_session))
+        db.session.delete(chat_session)
+
+    def _delete_blob(self, blob_name):
+        if self.container_client is None:
+            return
+        try:
+            self.container_client.delete_blob(blob_name)
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error deleting chat archive {blob_name}: {e}")
+
+    def _blob_name(self, chat_session):
+        return f"{self.prefix}{chat_session.user_id}/{chat_session.id}.json.gz"
+
+
+chat_partitions = ChatPartitions()
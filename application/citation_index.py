@@ -0,0 +1,215 @@
+import logging
+import re
+from app import db
+from models import CitationContext
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Heading that starts the reference list, e.g. "7. REFERENCES" or "Bibliography"
+REFERENCES_HEADING = re.compile(r'^\s*(?:\d+\.?\s*)?(references|bibliography)\s*$', re.IGNORECASE | re.MULTILINE)
+
+# Numbered reference entries: "[12] A. Author ..." or "12. A. Author ..."
+BRACKET_ENTRY = re.compile(r'^\s*\[(\d{1,3})\]\s*', re.MULTILINE)
+DOTTED_ENTRY = re.compile(r'^\s*(\d{1,3})\.\s+(?=[A-Z])', re.MULTILINE)
+
+# Author-year reference entries start with "Surname, X." or "Surname X,"
+AUTHOR_YEAR_ENTRY = re.compile(r'^\s*([A-Z][A-Za-z\'\-]+),?\s+(?:[A-Z]\.|[A-Z][a-z]+,)', re.MULTILINE)
+
+# In-text markers: "[12]", "[3, 7-9]" and "(Smith et al., 2019; Doe and Roe, 2020a)"
+NUMERIC_MARKER = re.compile(r'\[(\d{1,3}(?:\s*[,–\-]\s*\d{1,3})*)\]')
+AUTHOR_YEAR_MARKER = re.compile(
+    r'\(((?:[A-Z][A-Za-z\'\-]+(?:\s+et\s+al\.?|\s+(?:and|&)\s+[A-Z][A-Za-z\'\-]+)?,?\s+\d{4}[a-z]?(?:;\s*)?)+)\)')
+AUTHOR_YEAR_PART = re.compile(r'([A-Z][A-Za-z\'\-]+)(?:\s+et\s+al\.?|\s+(?:and|&)\s+[A-Z][A-Za-z\'\-]+)?,?\s+(\d{4})[a-z]?')
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+(?=[A-Z\[(])')
+
+# References the user can name in a question: "[12]", "reference 12", "ref. 12", "citation 12"
+QUERY_NUMERIC_REFERENCE = re.compile(r'\[(\d{1,3})\]|\b(?:reference|ref\.?|citation)\s*#?\s*(\d{1,3})\b', re.IGNORECASE)
+QUERY_AUTHOR_REFERENCE = re.compile(r'\b([A-Z][A-Za-z\'\-]+)\s+(?:et\s+al\.?|and\s+[A-Z][A-Za-z\'\-]+)')
+
+
+class CitationIndex:
+    """Index of the sentences in a document that cite each of its references"""
+
+    def build(self, document, text_content, citation_docs=None, window=1):
+        """
+        Find in-text citation markers and store the sentences around them
+
+        Args:
+            document (Document): The primary document (must already have an id)
+            text_content (str): Extracted text of the primary document
+            citation_docs (list): Cited Document rows resolved during upload
+            window (int): Number of neighbouring sentences stored on each side
+
+        Returns:
+            int: Number of citation contexts stored
+        """
+        try:
+            body, references = self._split_references(text_content)
+            entries = self._parse_reference_entries(references)
+            if not entries:
+                logger.info(f"No reference entries found for document {document.id}")
+                return 0
+
+            sentences = self._split_sentences(body)
+            cited_doc_ids = self._match_entries_to_documents(entries, citation_docs or [])
+
+            contexts = []
+            for position, sentence in enumerate(sentences):
+                for marker, labels in self._find_markers(sentence, entries):
+                    start = max(0, position - window)
+                    surrounding = " ".join(sentences[start:position + window + 1])
+                    for label in labels:
+                        contexts.append(CitationContext(
+                            document_id=document.id,
+                            cited_document_id=cited_doc_ids.get(label),
+                            marker=marker[:100],
+                            reference_label=label[:100],
+                            reference_text=entries[label],
+                            sentence=surrounding,
+                            position=position
+                        ))
+
+            db.session.add_all(contexts)
+            logger.info(f"Indexed {len(contexts)} citation contexts for document {document.id}")
+            return len(contexts)
+        except Exception as e:
+            logger.error(f"Error building citation index for document {document.id}: {e}")
+            return 0
+
+    def find_contexts(self, document_id, query, limit=8):
+        """
+        Return the citing sentences for the references named in a question
+
+        Args:
+            document_id (int): The primary document the question is about
+            query (str): The user's question
+            limit (int): Maximum number of contexts returned
+
+        Returns:
+            list: Dicts with marker, reference text, cited document id and sentence
+        """
+        labels = set()
+        for bracket_label, word_label in QUERY_NUMERIC_REFERENCE.findall(query):
+            labels.add(bracket_label or word_label)
+        surnames = {name.lower() for name in QUERY_AUTHOR_REFERENCE.findall(query)}
+
+        if not labels and not surnames:
+            return []
+
+        try:
+            contexts = CitationContext.query.filter_by(document_id=document_id).order_by(CitationContext.position).all()
+        except Exception as e:
+            logger.error(f"Error loading citation contexts for document {document_id}: {e}")
+            return []
+
+        results = []
+        seen = set()
+        for context in contexts:
+            reference_head = (context.reference_text or "")[:120].lower()
+            matches_label = context.reference_label in labels
+            matches_author = any(surname in reference_head or context.reference_label.startswith(surname)
+                                 for surname in surnames)
+            if not (matches_label or matches_author):
+                continue
+            key = (context.reference_label, context.sentence)
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append({
+                "marker": context.marker,
+                "reference_label": context.reference_label,
+                "reference_text": context.reference_text,
+                "cited_document_id": context.cited_document_id,
+                "sentence": context.sentence
+            })
+            if len(results) >= limit:
+                break
+        return results
+
+    def _split_references(self, text_content):
+        """Split text into body and reference list at the last references heading"""
+        headings = list(REFERENCES_HEADING.finditer(text_content))
+        if not headings:
+            return text_content, ""
+        split_at = headings[-1]
+        return text_content[:split_at.start()], text_content[split_at.end():]
+
+    def _parse_reference_entries(self, references):
+        """Parse the reference list into a {label: entry text} mapping"""
+        entries = {}
+        for pattern in (BRACKET_ENTRY, DOTTED_ENTRY):
+            starts = list(pattern.finditer(references))
+            if len(starts) >= 2:
+                for i, match in enumerate(starts):
+                    end = starts[i + 1].start() if i + 1 < len(starts) else len(references)
+                    entries[match.group(1)] = self._clean(references[match.end():end])
+                return entries
+
+        # Author-year style: label entries as "surname+year"
+        starts = list(AUTHOR_YEAR_ENTRY.finditer(references))
+        for i, match in enumerate(starts):
+            end = starts[i + 1].start() if i + 1 < len(starts) else len(references)
+            entry = self._clean(references[match.start():end])
+            year = re.search(r'\b(19|20)\d{2}\b', entry)
+            if year:
+                entries.setdefault(f"{match.group(1).lower()}{year.group(0)}", entry)
+        return entries
+
+    def _split_sentences(self, body):
+        """Join hyphenated line breaks and split the body into sentences"""
+        flat = re.sub(r'-\n(?=[a-z])', '', body)
+        flat = re.sub(r'\s+', ' ', flat)
+        return [s.strip() for s in SENTENCE_BOUNDARY.split(flat) if s.strip()]
+
+    def _find_markers(self, sentence, entries):
+        """Yield (marker, [labels]) for every citation marker that resolves to an entry"""
+        for match in NUMERIC_MARKER.finditer(sentence):
+            labels = []
+            for part in re.split(r'\s*,\s*', match.group(1)):
+                bounds = re.split(r'\s*[–\-]\s*', part)
+                if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit():
+                    low, high = int(bounds[0]), int(bounds[1])
+                    if 0 < high - low <= 20:
+                        labels.extend(str(n) for n in range(low, high + 1))
+                        continue
+                labels.append(bounds[0])
+            labels = [label for label in labels if label in entries]
+            if labels:
+                yield match.group(0), labels
+
+        for match in AUTHOR_YEAR_MARKER.finditer(sentence):
+            labels = []
+            for surname, year in AUTHOR_YEAR_PART.findall(match.group(1)):
+                label = f"{surname.lower()}{year}"
+                if label in entries:
+                    labels.append(label)
+            if labels:
+                yield match.group(0), labels
+
+    def _match_entries_to_documents(self, entries, citation_docs):
+        """Map reference labels to cited Document ids by looking for the title in the entry"""
+        matched = {}
+        compact_entries = {label: self._compact(entry) for label, entry in entries.items()}
+        for doc in citation_docs:
+            compact_title = self._compact(doc.title or "")
+            if len(compact_title) < 12:
+                continue
+            for label, compact_entry in compact_entries.items():
+                # Titles are truncated to 100 chars in the Document row
+                if compact_title[:60] in compact_entry:
+                    matched.setdefault(label, doc.id)
+                    break
+        return matched
+
+    @staticmethod
+    def _clean(text):
+        """Collapse the line breaks inside a reference entry"""
+        text = re.sub(r'-\n(?=[a-z])', '', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    @staticmethod
+    def _compact(text):
+        """Lowercase alphanumerics only, so titles match despite PDF spacing glitches"""
+        return re.sub(r'[^a-z0-9]', '', text.lower())
@@ -0,0 +1,291 @@
+"""
+Bibliographic metadata of each document's references, and exact answers from it.
+
+At ingestion the document's reference list is fetched from Semantic Scholar
+(the paper is found by a DOI in its front matter or by title) and every cited
+paper's authors, year, venue, DOI and citation count are stored in
+CitationMetadata. Papers Semantic Scholar does not know fall back to the
+cited papers resolved during upload, looked up in one batch request.
+
+Questions about the references as a set ("which cited papers are from after
+2018?", "how many references does this paper have?") are recognised by
+reference_questions and answered with SQL and templated text, without
+retrieval or an LLM call. Anything else, including questions about what
+the references say or about a topic among them, is left to the RAG path.
+"""
+import logging
+from markupsafe import escape
+from sqlalchemy import Text, cast
+from app import db
+from models import CitationMetadata
+from resilient_http import http_client
+from titles import DOI_PATTERN, normalize_title, trigrams
+from reference_questions import classify_reference_question
+from config import SEMANTIC_SCHOLAR_API_KEY, S2_BATCH_SIZE, TITLE_MATCH_THRESHOLD
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+S2_API_URL = "https://api.semanticscholar.org/graph/v1"
+S2_FIELDS = "paperId,title,authors,year,venue,externalIds,citationCount"
+
+# Most references the API returns per request
+S2_REFERENCES_LIMIT = 1000
+
+# A paper's own DOI is printed on its first page
+FRONT_MATTER_CHARS = 5000
+
+# Rows listed in an answer; the rest are only counted
+MAX_LISTED = 25
+
+
+class CitationMetadataStore:
+    """Fetches the bibliographic metadata of a document's references from Semantic Scholar"""
+
+    def __init__(self, title_index):
+        self.title_index = title_index
+
+    def build(self, document, text_content, citation_docs=None):
+        """
+        Store the metadata of a document's references (the caller commits)
+
+        Args:
+            document (Document): The primary document (must already have an id)
+            text_content (str): Extracted text of the primary document
+            citation_docs (list): Cited Document rows resolved during upload
+
+        Returns:
+            int: Number of references stored
+        """
+        citation_docs = citation_docs or []
+        try:
+            papers = self._fetch_references(document, text_content) or self._fetch_cited_documents(citation_docs)
+            cited_doc_ids = {normalize_title(doc.title): doc.id for doc in citation_docs}
+            rows = []
+            for paper in papers:
+                if not paper.get('title'):
+                    continue
+                doi = (paper.get('externalIds') or {}).get('DOI')
+                rows.append(CitationMetadata(
+                    document_id=document.id,
+                    cited_document_id=cited_doc_ids.get(normalize_title(paper['title'][:100])),
+                    position=len(rows),
+                    paper_id=paper.get('paperId'),
+                    title=paper['title'][:500],
+                    authors=[author['name'] for author in paper.get('authors') or [] if author.get('name')],
+                    year=paper.get('year'),
+                    venue=(paper.get('venue') or None) and paper['venue'][:300],
+                    doi=doi.lower()[:200] if doi else None,
+                    citation_count=paper.get('citationCount')
+                ))
+            db.session.add_all(rows)
+            logger.info(f"Stored metadata of {len(rows)} references of document {document.id}")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error storing citation metadata for document {document.id}: {e}")
+            return 0
+
+    def clone(self, source, target, reused_citations):
+        """
+        Copy the reference metadata of a near-duplicate's source document
+
+        Args:
+            reused_citations: (new citation Document, source citation id) pairs
+        """
+        cited_doc_ids = {source_id: citation_doc.id for citation_doc, source_id in reused_citations}
+        for row in CitationMetadata.query.filter_by(document_id=source.id).order_by(CitationMetadata.position):
+            db.session.add(CitationMetadata(
+                document_id=target.id,
+                cited_document_id=cited_doc_ids.get(row.cited_document_id),
+                position=row.position,
+                paper_id=row.paper_id,
+                title=row.title,
+                authors=row.authors,
+                year=row.year,
+                venue=row.venue,
+                doi=row.doi,
+                citation_count=row.citation_count,
+                fetched_at=row.fetched_at
+            ))
+
+    def _fetch_references(self, document, text_content):
+        """The document's full reference list, or None if Semantic Scholar doesn't know the paper"""
+        for paper_key in self._paper_keys(document, text_content):
+            try:
+                response = http_client.get(
+                    f"{S2_API_URL}/paper/{paper_key}/references",
+                    params={"fields": S2_FIELDS, "limit": S2_REFERENCES_LIMIT},
+                    headers=self._headers()
+                )
+                if response.status_code == 404:
+                    continue
+                response.raise_for_status()
+                # Publishers may withhold reference lists, leaving the data empty
+                papers = [item.get('citedPaper') or {} for item in response.json().get('data') or []]
+                if papers:
+                    logger.info(f"Fetched {len(papers)} references of document {document.id} ({paper_key})")
+                    return papers
+            except Exception as e:
+                logger.error(f"Semantic Scholar reference lookup of {paper_key} failed: {e}")
+        return None
+
+    def _paper_keys(self, document, text_content):
+        """Semantic Scholar ids to try for a document: a DOI in its front matter, then a title match"""
+        doi_match = DOI_PATTERN.search((text_content or "")[:FRONT_MATTER_CHARS])
+        if doi_match:
+            yield f"DOI:{doi_match.group(1).rstrip('.,;)')}"
+        try:
+            response = http_client.get(
+                f"{S2_API_URL}/paper/search/match",
+                params={"query": document.title, "fields": "paperId,title"},
+                headers=self._headers()
+            )
+            if response.status_code == 404:
+                return
+            response.raise_for_status()
+            matches = response.json().get('data') or []
+        except Exception as e:
+            logger.error(f"Semantic Scholar title match for document {document.id} failed: {e}")
+            return
+        # The best match may be a different paper with a similar title
+        if matches and self._same_title(document.title, matches[0].get('title')):
+            yield matches[0]['paperId']
+
+    def _fetch_cited_documents(self, citation_docs):
+        """Metadata of the cited papers resolved during upload, in one batch request"""
+        paper_ids = []
+        for citation_doc in citation_docs:
+            paper = self.title_index.lookup(citation_doc.title)
+            if paper is not None and paper.get('paperId'):
+                paper_ids.append(paper['paperId'])
+        papers = []
+        for start in range(0, len(paper_ids), S2_BATCH_SIZE):
+            batch = paper_ids[start:start + S2_BATCH_SIZE]
+            try:
+                response = http_client.post(f"{S2_API_URL}/paper/batch", params={"fields": S2_FIELDS},
+                                            json={"ids": batch}, headers=self._headers())
+                response.raise_for_status()
+                papers.extend(paper for paper in response.json() if paper)
+            except Exception as e:
+                logger.error(f"Semantic Scholar batch lookup of {len(batch)} cited papers failed: {e}")
+        return papers
+
+    @staticmethod
+    def _same_title(title, candidate):
+        expected, found = trigrams(normalize_title(title)), trigrams(normalize_title(candidate))
+        return bool(expected) and len(expected & found) / len(expected | found) >= TITLE_MATCH_THRESHOLD
+
+    @staticmethod
+    def _headers():
+        return {'x-api-key': SEMANTIC_SCHOLAR_API_KEY} if SEMANTIC_SCHOLAR_API_KEY else {}
+
+
+class MetadataQueryRouter:
+    """Answers questions about a document's reference list from its metadata, without the LLM"""
+
+    def answer(self, query, document_id):
+        """
+        Answer a metadata question about a document's references
+
+        Returns:
+            str: The answer, or None when the question isn't one or no metadata is stored
+        """
+        intent = classify_reference_question(query)
+        if intent is None:
+            return None
+        try:
+            total = CitationMetadata.query.filter_by(document_id=document_id).count()
+            if not total:
+                return None
+            rows = self._filtered(document_id, intent)
+            description = self._describe(intent)
+            if intent["mode"] == "count":
+                text = self._count_answer(document_id, rows, total, description)
+            elif intent["mode"] == "list":
+                text = self._list_answer(rows, total, description)
+            else:
+                text = self._ranked_answer(rows, intent["mode"], description)
+        except Exception as e:
+            logger.error(f"Error answering from citation metadata of document {document_id}: {e}")
+            return None
+        logger.info(f"Answered '{query[:80]}' from citation metadata ({intent['mode']})")
+        return f"{text}\n\n(From Semantic Scholar's metadata of this paper's {total} references.)"
+
+    def _filtered(self, document_id, intent):
+        query = CitationMetadata.query.filter_by(document_id=document_id)
+        if intent["year_min"] is not None:
+            query = query.filter(CitationMetadata.year >= intent["year_min"])
+        if intent["year_max"] is not None:
+            query = query.filter(CitationMetadata.year <= intent["year_max"])
+        if intent["author"]:
+            query = query.filter(cast(CitationMetadata.authors, Text).ilike(f"%{intent['author']}%"))
+        if intent["venue"]:
+            query = query.filter(CitationMetadata.venue.ilike(f"%{intent['venue']}%"))
+
+        if intent["mode"] == "top":
+            query = query.filter(CitationMetadata.citation_count.isnot(None)).order_by(
+                CitationMetadata.citation_count.desc())
+        elif intent["mode"] in ("oldest", "newest"):
+            year = CitationMetadata.year
+            query = query.filter(year.isnot(None)).order_by(year.asc() if intent["mode"] == "oldest" else year.desc())
+        else:
+            query = query.order_by(CitationMetadata.position)
+        return query.all()
+
+    def _count_answer(self, document_id, rows, total, description):
+        if description:
+            return f"{len(rows)} of the paper's {total} references {_are(len(rows))} {description}."
+        in_library = CitationMetadata.query.filter(
+            CitationMetadata.document_id == document_id, CitationMetadata.cited_document_id.isnot(None)).count()
+        return f"The paper has {total} references; {in_library} of them {_are(in_library)} in your library."
+
+    def _list_answer(self, rows, total, description):
+        if not rows:
+            return f"None of the paper's {total} references are {description}."
+        heading = f"{len(rows)} of the paper's {total} references {_are(len(rows))} {description}:" if description \
+            else f"The paper's {total} references:"
+        return self._format(heading, rows)
+
+    def _ranked_answer(self, rows, mode, description):
+        scope = f"references {description}" if description else "references"
+        if not rows:
+            return f"No {scope} have {'citation counts' if mode == 'top' else 'a known year'}."
+        heading = {
+            "top": f"The most cited {scope}:",
+            "oldest": f"The oldest {scope}:",
+            "newest": f"The most recent {scope}:"
+        }[mode]
+        return self._format(heading, rows[:5])
+
+    def _format(self, heading, rows):
+        lines = [heading]
+        for row in rows[:MAX_LISTED]:
+            details = [str(row.year) if row.year else None, row.venue,
+                       f"{row.citation_count:,} citations" if row.citation_count is not None else None]
+            authors = row.authors or []
+            byline = f"{authors[0]} et al." if len(authors) > 2 else " and ".join(authors)
+            line = f"- {row.title}"
+            if byline:
+                line += f", {byline}"
+            details = [detail for detail in details if detail]
+            if details:
+                line += f" ({', '.join(details)})"
+            lines.append(str(escape(line)))
+        if len(rows) > MAX_LISTED:
+            lines.append(f"...and {len(rows) - MAX_LISTED} more.")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _describe(intent):
+        parts = []
+        if intent["author"]:
+            parts.append(f"by {intent['author']}")
+        if intent["venue"]:
+            parts.append(f"published in {intent['venue']}")
+        if intent["year_label"]:
+            parts.append(intent["year_label"])
+        return str(escape(" ".join(parts)))
+
+
+def _are(count):
+    return "is" if count == 1 else "are"
@@ -0,0 +1,183 @@
+import json
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+import click
+from app import app, db
+from models import Document, CitationMetadata
+from routes import document_manager, chat_archiver, rag_system, bulk_importer
+from chat_archive import DEFAULT_PARTITION, chat_partitions
+from cache_bus import cache_bus, TEXT
+from reindex import Reindexer
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Blobs owned by a user live under "<user id>/"
+USER_BLOB_PATTERN = re.compile(r'^\d+/')
+
+TEXT_BLOB_SUFFIXES = ('.apct', '.txt')
+
+
+def _base_blob_name(blob_name):
+    """Map a text blob to the PDF blob it belongs to"""
+    for suffix in TEXT_BLOB_SUFFIXES:
+        if blob_name.endswith(suffix):
+            return blob_name[:-len(suffix)]
+    return blob_name
+
+
+@app.cli.command('gc-blobs')
+@click.option('--dry-run', is_flag=True, help='Only report orphaned blobs')
+@click.option('--min-age-hours', default=24, show_default=True,
+              help='Skip blobs younger than this, so uploads in progress are not collected')
+def gc_blobs(dry_run, min_age_hours):
+    """Delete blobs that no Document row references"""
+    referenced = {document_manager._document_blob_name(document)
+                  for document in Document.query.with_entities(
+                      Document.id, Document.user_id, Document.filename,
+                      Document.blob_url, Document.parent_document_id)}
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=min_age_hours)
+    orphans = []
+    present = set()
+    total = 0
+    for blob in document_manager.container_client.list_blobs():
+        if not USER_BLOB_PATTERN.match(blob.name):
+            continue
+        total += 1
+        base_name = _base_blob_name(blob.name)
+        present.add(base_name)
+        if base_name not in referenced and blob.last_modified < cutoff:
+            orphans.append(blob.name)
+
+    missing = referenced - present
+    for blob_name in sorted(missing):
+        logger.warning(f"Document blob {blob_name} is missing from storage")
+
+    click.echo(f"Scanned {total} blobs: {len(orphans)} orphaned, {len(missing)} documents without blobs")
+    if dry_run:
+        for blob_name in orphans:
+            click.echo(f"  {blob_name}")
+        return
+
+    deleted = document_manager.delete_blobs(orphans)
+    cache_bus.publish(TEXT, sorted({_base_blob_name(name) for name in orphans}))
+    click.echo(f"Deleted {deleted} orphaned blobs")
+
+
+@app.cli.command('reindex')
+@click.option('--workers', default=4, show_default=True, help='Processes reprocessing documents')
+@click.option('--batch-size', default=50, show_default=True, help='Documents per checkpoint')
+@click.option('--max-per-minute', default=0, show_default=True, help='Throttle; 0 for no limit')
+@click.option('--user-id', type=int, help='Only documents of this user')
+@click.option('--since', type=click.DateTime(), help='Only documents uploaded at or after this time')
+@click.option('--until', type=click.DateTime(), help='Only documents uploaded before this time')
+@click.option('--outdated-only', is_flag=True, help='Only documents processed by an older pipeline version')
+@click.option('--restart', is_flag=True, help='Abandon an unfinished job instead of resuming it')
+def reindex(workers, batch_size, max_per_minute, user_id, since, until, outdated_only, restart):
+    """Reprocess documents through the current pipeline, resuming an unfinished run"""
+    reindexer = Reindexer(workers=workers, batch_size=batch_size, max_per_minute=max_per_minute)
+
+    job = reindexer.unfinished_job()
+    if job is not None and restart:
+        click.echo(f"Abandoning reindex job {job.id}")
+        reindexer.abandon(job)
+        job = None
+    if job is not None:
+        click.echo(f"Resuming reindex job {job.id} after document {job.last_document_id} "
+                   f"(filters {job.filters})")
+    else:
+        try:
+            job = reindexer.start(user_id=user_id, since=since, until=until, outdated_only=outdated_only)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Started reindex job {job.id} (pipeline version {job.pipeline_version})")
+
+    reindexer.run(job, progress=lambda job: click.echo(
+        f"  through document {job.last_document_id}: {job.processed} processed, {job.failed} failed"))
+
+    failed_ids = json.loads(job.failed_ids or '[]')
+    if failed_ids:
+        click.echo(f"Documents that failed twice: {', '.join(map(str, failed_ids[:50]))}"
+                   f"{' ...' if len(failed_ids) > 50 else ''}")
+    if job.status == 'incomplete':
+        raise click.ClickException(
+            f"Index generation {job.generation} was not activated: {job.failed} documents failed. "
+            f"Run `flask reindex` again to retry them, or `flask reindex --restart` to abandon the rebuild")
+    click.echo(f"Reindex job {job.id} completed: {job.processed} processed, {job.failed} failed")
+    if job.switch_on_completion:
+        click.echo(f"Searches now use index generation {job.generation}")
+
+
+@app.cli.command('partition-chat-messages')
+def partition_chat_messages():
+    """Convert chat_message into a table partitioned by month (once, briefly locks the table)"""
+    if chat_partitions.migrate():
+        click.echo("chat_message is now partitioned; existing messages are in chat_message_legacy")
+    else:
+        click.echo("chat_message is already partitioned")
+    for name, lower, upper in chat_partitions.existing():
+        click.echo(f"  {name}: {lower or 'MINVALUE'} to {upper or 'MAXVALUE'}")
+    click.echo(f"  {DEFAULT_PARTITION}: DEFAULT")
+
+
+@app.cli.command('archive-chats')
+@click.option('--days', type=int, help='Archive sessions idle this long (default CHAT_ARCHIVE_AFTER_DAYS)')
+@click.option('--batch-size', default=100, show_default=True, help='Sessions selected per query')
+@click.option('--limit', type=int, help='Stop after archiving this many sessions')
+@click.option('--dry-run', is_flag=True, help='Only count the sessions that would be archived')
+def archive_chats(days, batch_size, limit, dry_run):
+    """Move idle chat sessions to blob storage and drop emptied partitions (run daily)"""
+    chat_partitions.ensure()
+    if days is not None:
+        chat_archiver.after_days = days
+    counts = chat_archiver.archive_idle(batch_size=batch_size, limit=limit, dry_run=dry_run)
+    verb = "Would archive" if dry_run else "Archived"
+    click.echo(f"{verb} {counts['archived']} sessions ({counts['skipped']} still active, {counts['failed']} failed)")
+
+
+@app.cli.command('resume-imports')
+@click.option('--fail', 'give_up', is_flag=True, help='Mark stale imports failed instead of resuming them')
+def resume_imports(give_up):
+    """Finish library imports whose worker stopped (the import page also resumes them when polled)"""
+    jobs = bulk_importer.stale_jobs()
+    if not jobs:
+        click.echo("No stale imports")
+    for job in jobs:
+        if not bulk_importer.take_over(job):
+            click.echo(f"  import {job.id}: taken over by another process")
+        elif give_up:
+            bulk_importer.fail(job, "The import was interrupted")
+            click.echo(f"  import {job.id}: marked failed")
+        else:
+            click.echo(f"  import {job.id}: resuming ({job.status}, started {job.created_at:%Y-%m-%d %H:%M})")
+            bulk_importer.resume(job, background=False)
+            db.session.refresh(job)
+            progress = bulk_importer.progress(job)
+            click.echo(f"  import {job.id}: {progress['imported']} imported, {progress['failed']} failed")
+
+
+@app.cli.command('fetch-citation-metadata')
+@click.option('--user-id', type=int, help='Only documents of this user')
+@click.option('--refresh', is_flag=True, help='Refetch documents that already have metadata (updates citation counts)')
+@click.option('--limit', type=int, help='Stop after this many documents')
+def fetch_citation_metadata(user_id, refresh, limit):
+    """Fetch reference metadata from Semantic Scholar for documents uploaded without it"""
+    query = Document.query.filter(Document.parent_document_id.is_(None))
+    if user_id is not None:
+        query = query.filter(Document.user_id == user_id)
+    if not refresh:
+        query = query.filter(~Document.cited_papers.any())
+    documents = query.order_by(Document.id).limit(limit).all()
+
+    stored = 0
+    for document in documents:
+        if refresh:
+            CitationMetadata.query.filter_by(document_id=document.id).delete()
+        count = rag_system.citation_metadata.build(
+            document, document_manager.get_document_text(document), document.citations.all())
+        db.session.commit()
+        stored += count
+        click.echo(f"  document {document.id}: {count} references")
+    click.echo(f"Stored metadata of {stored} references for {len(documents)} documents")
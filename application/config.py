@@ -11,10 +11,29 @@ POSTGRES_HOST = os.environ.get('PGHOST')
 POSTGRES_PORT = os.environ.get('PGPORT')
 POSTGRES_DB = os.environ.get('PGDATABASE')
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+# Database Connection Pool Configuration (per worker process, for the primary and each replica)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))  # connections kept open
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))  # extra connections opened under load
+DB_POOL_TIMEOUT_S = float(os.environ.get('DB_POOL_TIMEOUT_S', 10))  # wait for a free connection before failing
+DB_POOL_RECYCLE_S = int(os.environ.get('DB_POOL_RECYCLE_S', 300))
+DB_CONNECT_TIMEOUT_S = int(os.environ.get('DB_CONNECT_TIMEOUT_S', 5))
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true'  # URLs point at PgBouncer (transaction pooling)
+DB_REPLICA_MAX_LAG_S = float(os.environ.get('DB_REPLICA_MAX_LAG_S', 5))  # replicas further behind get no reads
+DB_REPLICA_CHECK_S = float(os.environ.get('DB_REPLICA_CHECK_S', 5))  # how often each worker rechecks replica lag
+DB_READ_YOUR_WRITES_S = float(os.environ.get('DB_READ_YOUR_WRITES_S', 10))  # a user's reads stay on the primary after a write
+
+# Cache Invalidation Configuration (LISTEN/NOTIFY between all workers of all instances)
+# LISTEN needs a direct connection: behind PgBouncer in transaction mode, point this at Postgres itself
+CACHE_BUS_DATABASE_URL = os.environ.get('CACHE_BUS_DATABASE_URL', DATABASE_URL)
+CACHE_BUS_CHANNEL = os.environ.get('CACHE_BUS_CHANNEL', 'apce_cache_invalidation')
 
 # Upload Configuration (for local fallback if needed)
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB max file size
+TEXT_CACHE_SIZE = int(os.environ.get('TEXT_CACHE_SIZE', 64))  # extracted texts kept per worker
+PROMPT_PREFIX_CACHE_SIZE = int(os.environ.get('PROMPT_PREFIX_CACHE_SIZE', 32))  # prompt prefixes kept per worker
 
 # Azure Blob Storage Configuration
 AZURE_STORAGE_CONNECTION_STRING = os.environ.get('AZURE_STORAGE_CONNECTION_STRING')
@@ -22,3 +41,110 @@ AZURE_BLOB_CONTAINER_NAME = os.environ.get('AZURE_BLOB_CONTAINER_NAME')
 
 # Flask Configuration
 SESSION_SECRET = os.environ.get('SESSION_SECRET')
+ADMIN_USERS = {name.strip() for name in os.environ.get('ADMIN_USERS', '').split(',') if name.strip()}  # usernames allowed on /admin
+
+# Embedding Service Configuration
+EMBEDDING_SERVICE_HOST = os.environ.get('EMBEDDING_SERVICE_HOST', '127.0.0.1')
+EMBEDDING_SERVICE_PORT = int(os.environ.get('EMBEDDING_SERVICE_PORT', 8500))
+# The service startup.sh runs next to gunicorn; set to an empty string to turn embeddings (and the service) off
+EMBEDDING_SERVICE_URL = os.environ.get(
+    'EMBEDDING_SERVICE_URL', f"http://{EMBEDDING_SERVICE_HOST}:{EMBEDDING_SERVICE_PORT}") or None
+EMBEDDING_MODEL_NAME = os.environ.get('EMBEDDING_MODEL_NAME', 'sentence-transformers/all-MiniLM-L6-v2')
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get('EMBEDDING_MAX_BATCH_SIZE', 64))
+EMBEDDING_MAX_LATENCY_MS = int(os.environ.get('EMBEDDING_MAX_LATENCY_MS', 10))
+EMBEDDING_QUERY_CACHE_SIZE = int(os.environ.get('EMBEDDING_QUERY_CACHE_SIZE', 4096))
+
+# Chunk Vector Store Configuration
+VECTOR_STORE_DIR = os.environ.get('VECTOR_STORE_DIR', os.path.join(os.getcwd(), 'vectors'))
+VECTOR_CACHE_SIZE = int(os.environ.get('VECTOR_CACHE_SIZE', 256))  # document families kept in memory per worker
+VECTOR_CACHE_MB = int(os.environ.get('VECTOR_CACHE_MB', 512))  # memory budget of resident families per worker
+VECTOR_BLOB_PREFIX = os.environ.get('VECTOR_BLOB_PREFIX', 'vectors/')  # blob name prefix of the family shards
+VECTOR_QUANTIZATION = os.environ.get('VECTOR_QUANTIZATION', 'int8')  # none, int8 or binary (first-pass search)
+VECTOR_RESCORE_FACTOR = int(os.environ.get('VECTOR_RESCORE_FACTOR', 0))  # rescore top_k * this exactly; 0 for the default
+
+# LLM Scheduling Configuration (slots and quotas are shared by every worker through PostgreSQL)
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 4))  # LLM calls in flight across all instances
+LLM_INTERACTIVE_RESERVED_SLOTS = int(os.environ.get('LLM_INTERACTIVE_RESERVED_SLOTS', 1))  # never given to ingestion
+LLM_SLOT_LEASE_S = float(os.environ.get('LLM_SLOT_LEASE_S', 300))  # slots of a worker that died are freed after this
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', 32))  # callers waiting for a slot, per worker process
+LLM_USER_TOKENS_PER_MINUTE = int(os.environ.get('LLM_USER_TOKENS_PER_MINUTE', 60000))
+LLM_USER_BURST_TOKENS = int(os.environ.get('LLM_USER_BURST_TOKENS', 90000))
+LLM_INTERACTIVE_DEADLINE_S = float(os.environ.get('LLM_INTERACTIVE_DEADLINE_S', 20))
+LLM_BACKGROUND_DEADLINE_S = float(os.environ.get('LLM_BACKGROUND_DEADLINE_S', 300))
+
+# Near-Duplicate Detection Configuration
+DEDUP_SIMILARITY_THRESHOLD = float(os.environ.get('DEDUP_SIMILARITY_THRESHOLD', 0.9))
+DEDUP_GLOBAL = os.environ.get('DEDUP_GLOBAL', 'true').lower() == 'true'  # also match other users' uploads
+
+# Local Title Index Configuration
+TITLE_MATCH_THRESHOLD = float(os.environ.get('TITLE_MATCH_THRESHOLD', 0.8))  # trigram Jaccard similarity
+TITLE_INDEX_REFRESH_S = int(os.environ.get('TITLE_INDEX_REFRESH_S', 60))  # pick up papers resolved by other workers
+
+# Retrieval Backend Configuration
+PIPELINE_VERSION = 2  # bump when extraction, chunking or indexing changes, then run `flask reindex`
+RETRIEVAL_BACKEND = os.environ.get('RETRIEVAL_BACKEND', 'blob')  # 'blob' or 'postgres'
+
+# Chat History Storage Configuration
+CHAT_PARTITION_MONTHS_AHEAD = int(os.environ.get('CHAT_PARTITION_MONTHS_AHEAD', 2))  # monthly chat_message partitions created ahead
+CHAT_PARTITION_CHECK_INTERVAL_S = int(os.environ.get('CHAT_PARTITION_CHECK_INTERVAL_S', 3600))  # how often each worker makes sure they exist
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 90))  # sessions idle this long move to blob storage
+CHAT_ARCHIVE_PREFIX = os.environ.get('CHAT_ARCHIVE_PREFIX', 'chat-archive/')  # blob name prefix of archived sessions
+
+# OCR Configuration (image-only PDF pages; needs Tesseract and its language data)
+OCR_ENABLED = os.environ.get('OCR_ENABLED', 'true').lower() == 'true'  # also off where Tesseract data is missing
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 2))  # OCR processes per web worker
+OCR_MAX_PAGES = int(os.environ.get('OCR_MAX_PAGES', 60))  # pages OCR'd per document; later ones stay empty
+# Per document; pages not done by then stay empty. OCR runs within the upload request, so keep this
+# well below gunicorn's --timeout (startup.sh)
+OCR_TIMEOUT_S = float(os.environ.get('OCR_TIMEOUT_S', 120))
+OCR_MIN_CHARS = int(os.environ.get('OCR_MIN_CHARS', 50))  # pages with less text and an image are OCR'd
+OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')  # Tesseract languages, e.g. 'eng+deu'
+OCR_DPI = int(os.environ.get('OCR_DPI', 300))
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', os.path.join(os.getcwd(), 'uploads', 'ocr'))
+OCR_BLOB_PREFIX = os.environ.get('OCR_BLOB_PREFIX', 'ocr-cache/')  # OCR text shared across hosts by page image hash
+
+# Bulk Import Configuration
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 4))  # papers ingested in parallel per web worker
+IMPORT_MAX_MB = int(os.environ.get('IMPORT_MAX_MB', 500))  # largest zip (or BibTeX) upload
+IMPORT_MAX_PAPERS = int(os.environ.get('IMPORT_MAX_PAPERS', 1000))  # entries and PDFs per import
+IMPORT_DIR = os.environ.get('IMPORT_DIR', os.path.join(os.getcwd(), 'uploads', 'imports'))  # unpacked uploads in progress
+IMPORT_HEARTBEAT_S = float(os.environ.get('IMPORT_HEARTBEAT_S', 30))  # how often a running import records it is alive
+IMPORT_STALE_S = float(os.environ.get('IMPORT_STALE_S', 300))  # imports silent this long are resumed elsewhere
+SEMANTIC_SCHOLAR_API_KEY = os.environ.get('SEMANTIC_SCHOLAR_API_KEY')  # optional; raises the rate limit
+S2_BATCH_SIZE = int(os.environ.get('S2_BATCH_SIZE', 500))  # ids per /paper/batch request (the API maximum)
+
+# Passage Extraction Configuration
+PASSAGE_BUDGET_CHARS = int(os.environ.get('PASSAGE_BUDGET_CHARS', 6000))  # per cited paper, ~1,500 tokens
+
+# Library-Wide Question Answering Configuration
+LIBRARY_MAX_DOCUMENTS = int(os.environ.get('LIBRARY_MAX_DOCUMENTS', 8))  # candidates read per question
+LIBRARY_MAP_CONCURRENCY = int(os.environ.get('LIBRARY_MAP_CONCURRENCY', 4))  # evidence extractions in flight
+LIBRARY_TOKEN_BUDGET = int(os.environ.get('LIBRARY_TOKEN_BUDGET', 16000))  # input tokens across all extractions
+LIBRARY_DEADLINE_S = float(os.environ.get('LIBRARY_DEADLINE_S', 45))  # extractions still running are dropped
+
+# Outbound HTTP Configuration
+HTTP_DEFAULT_DEADLINE_S = float(os.environ.get('HTTP_DEFAULT_DEADLINE_S', 15))  # total time for a call, retries included
+HTTP_DOWNLOAD_DEADLINE_S = float(os.environ.get('HTTP_DOWNLOAD_DEADLINE_S', 30))  # citation PDF downloads
+HTTP_CONNECT_TIMEOUT_S = float(os.environ.get('HTTP_CONNECT_TIMEOUT_S', 3.05))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))  # idempotent calls only
+HTTP_HEDGE_MIN_SAMPLES = int(os.environ.get('HTTP_HEDGE_MIN_SAMPLES', 20))  # latencies needed before hedging a host
+HTTP_BREAKER_FAILURES = int(os.environ.get('HTTP_BREAKER_FAILURES', 5))  # consecutive failures that open a host's circuit
+HTTP_BREAKER_COOLDOWN_S = float(os.environ.get('HTTP_BREAKER_COOLDOWN_S', 30))  # before a probe request is let through
+LLM_REQUEST_TIMEOUT_S = float(os.environ.get('LLM_REQUEST_TIMEOUT_S', 60))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+
+# LLM Backend Configuration
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'groq')  # 'groq' or 'ollama'
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://127.0.0.1:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.1:8b')
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')  # keeps the model and its prompt cache loaded
+OLLAMA_NUM_CTX = int(os.environ.get('OLLAMA_NUM_CTX', 32768))  # must fit the primary document
+OLLAMA_SESSION_CACHE_SIZE = int(os.environ.get('OLLAMA_SESSION_CACHE_SIZE', 16))  # pinned prefix contexts per worker
+
+# Profiling Configuration (per worker; adjustable at runtime under /admin/profiling)
+PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', 0))  # keep profiles of requests slower than this; 0 disables
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))  # share of requests always profiled
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))  # stack sampling interval
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.getcwd(), 'uploads', 'profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))  # oldest profiles are deleted beyond this
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 10))
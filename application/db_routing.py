@@ -0,0 +1,208 @@
+"""
+Database connection pooling and read-replica routing.
+
+Views marked with @read_replica (and the per-request user lookup) send
+their plain SELECTs to a streaming replica; everything else, and any query
+of such a view after it has written, goes to the primary. Each worker
+checks replica lag every DB_REPLICA_CHECK_S and skips replicas more than
+DB_REPLICA_MAX_LAG_S behind, falling back to the primary. A user who has
+just written reads from the primary for DB_READ_YOUR_WRITES_S, so they see
+their own changes.
+"""
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, session as user_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import Select
+from config import (DATABASE_REPLICA_URLS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT_S, DB_POOL_RECYCLE_S,
+                    DB_CONNECT_TIMEOUT_S, DB_PGBOUNCER, DB_REPLICA_MAX_LAG_S, DB_REPLICA_CHECK_S,
+                    DB_READ_YOUR_WRITES_S)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Seconds of replay lag; 0 when the replica has replayed everything it received,
+# since pg_last_xact_replay_timestamp() also ages while the primary is idle
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+# Flask session key holding the time until which a user's reads stay on the primary
+PRIMARY_UNTIL_KEY = '_db_primary_until'
+
+
+def engine_options(pgbouncer=DB_PGBOUNCER):
+    """
+    SQLAlchemy engine options for the primary and each replica
+
+    Behind PgBouncer in transaction mode, PgBouncer does the pooling: a pool
+    in every worker would only pin server connections, so connections are
+    opened per checkout instead. psycopg2 uses no server-side prepared
+    statements, and no session-level settings are sent, so nothing else
+    depends on keeping one server connection.
+    """
+    connect_args = {"connect_timeout": DB_CONNECT_TIMEOUT_S}
+    if pgbouncer:
+        return {"poolclass": NullPool, "connect_args": connect_args}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT_S,
+        "pool_recycle": DB_POOL_RECYCLE_S,
+        "pool_pre_ping": True,
+        # Reuse the most recent connection, so surplus ones sit idle and get recycled
+        "pool_use_lifo": True,
+        "connect_args": connect_args
+    }
+
+
+class ReplicaRouter:
+    """Chooses a replica for read-only queries, skipping lagging or unreachable ones"""
+
+    def __init__(self, urls=DATABASE_REPLICA_URLS, max_lag_s=DB_REPLICA_MAX_LAG_S, check_s=DB_REPLICA_CHECK_S,
+                 read_your_writes_s=DB_READ_YOUR_WRITES_S):
+        self.keys = [f"replica_{number}" for number in range(len(urls))]
+        self.urls = dict(zip(self.keys, urls))
+        self.max_lag_s = max_lag_s
+        self.check_s = check_s
+        self.read_your_writes_s = read_your_writes_s
+        self._lag = {}  # bind key -> (lag in seconds or None if unreachable, checked at)
+        self._next = itertools.cycle(self.keys)
+        self._lock = threading.Lock()
+        self._engines = {}
+        self.reads = {key: 0 for key in self.keys}
+        self.fallbacks = 0
+
+    def binds(self):
+        """SQLALCHEMY_BINDS entries for the replicas"""
+        return {key: {"url": url, **engine_options()} for key, url in self.urls.items()}
+
+    def init_app(self, app, db):
+        self._engines = db.engines
+        app.after_request(self._after_request)
+
+    def choose(self):
+        """
+        Returns:
+            str: Bind key of a replica within the lag limit, or None for the primary
+        """
+        for _ in range(len(self.keys)):
+            with self._lock:
+                key = next(self._next)
+            lag = self._current_lag(key)
+            if lag is not None and lag <= self.max_lag_s:
+                self.reads[key] += 1
+                return key
+        if self.keys:
+            self.fallbacks += 1
+        return None
+
+    def wants_replica(self, session, clause):
+        """Whether a query may read from a replica: plain SELECTs of a read-only view that has not written"""
+        if not self.keys or not has_request_context() or not g.get('_db_read_only'):
+            return False
+        if session.info.get('wrote') or not isinstance(clause, Select) or clause._for_update_arg is not None:
+            return False
+        return user_session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()
+
+    def engine(self, key):
+        return self._engines[key]
+
+    @contextmanager
+    def reading(self):
+        """Let the queries in this block read from a replica"""
+        previous = g.get('_db_read_only', False)
+        g._db_read_only = True
+        try:
+            yield
+        finally:
+            g._db_read_only = previous
+
+    def snapshot(self):
+        replicas = {}
+        for key in self.keys:
+            lag, checked_at = self._lag.get(key, (None, None))
+            replicas[key] = {
+                "lag_s": lag,
+                "healthy": lag is not None and lag <= self.max_lag_s,
+                "checked_s_ago": round(time.monotonic() - checked_at, 1) if checked_at else None,
+                "reads": self.reads[key],
+                "pool": self._engines[key].pool.status() if key in self._engines else None
+            }
+        return {
+            "primary_pool": self._engines[None].pool.status() if None in self._engines else None,
+            "replicas": replicas,
+            "fallbacks_to_primary": self.fallbacks
+        }
+
+    def _current_lag(self, key):
+        lag, checked_at = self._lag.get(key, (None, 0))
+        if time.monotonic() - checked_at < self.check_s:
+            return lag
+        # One thread rechecks while the others use the previous value
+        with self._lock:
+            lag, checked_at = self._lag.get(key, (None, 0))
+            if time.monotonic() - checked_at < self.check_s:
+                return lag
+            self._lag[key] = (lag, time.monotonic())
+        try:
+            with self._engines[key].connect() as connection:
+                lag = float(connection.execute(LAG_QUERY).scalar())
+            if lag > self.max_lag_s:
+                logger.warning(f"Replica {key} is {lag:.1f}s behind; reading from other servers")
+        except Exception as e:
+            logger.error(f"Error checking lag of replica {key}: {e}")
+            lag = None
+        self._lag[key] = (lag, time.monotonic())
+        return lag
+
+    def _after_request(self, response):
+        if g.pop('_db_wrote', False) and self.keys:
+            user_session[PRIMARY_UNTIL_KEY] = time.time() + self.read_your_writes_s
+        return response
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends eligible reads to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and replica_router.wants_replica(self, clause):
+            key = replica_router.choose()
+            if key is not None:
+                return replica_router.engine(key)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _mark_write(session, flush_context, instances):
+    # The rest of the request reads its own writes from the primary
+    session.info['wrote'] = True
+    if has_request_context():
+        g._db_wrote = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_statement_write(orm_execute_state):
+    # Bulk and textual statements, and locking reads that precede a write
+    statement = orm_execute_state.statement
+    if not orm_execute_state.is_select or getattr(statement, '_for_update_arg', None) is not None:
+        _mark_write(orm_execute_state.session, None, None)
+
+
+def read_replica(view):
+    """Let a view's plain SELECTs go to a replica (its writes, and reads after them, still use the primary)"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        g._db_read_only = True
+        return view(*args, **kwargs)
+    return wrapped
+
+
+# One per worker process
+replica_router = ReplicaRouter()
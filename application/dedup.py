@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import re
+import numpy as np
+from app import db
+from models import DocumentFingerprint, LshBucket, CitationContext
+from config import DEDUP_SIMILARITY_THRESHOLD, DEDUP_GLOBAL
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+NUM_PERMUTATIONS = 128
+SHINGLE_SIZE = 5
+
+# 32 bands of 4 rows: pairs above ~0.6 Jaccard share a bucket with high probability
+LSH_BANDS = 32
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# Shingles permuted at a time, bounding the work array to SIGNATURE_BLOCK x NUM_PERMUTATIONS uint64s (8 MB)
+SIGNATURE_BLOCK = 8192
+
+# Fixed permutations so signatures stay comparable across processes and deploys
+_generator = np.random.RandomState(1)
+PERM_A = _generator.randint(1, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+PERM_B = _generator.randint(0, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+class DuplicateDetector:
+    """MinHash fingerprints of extracted text with a persistent LSH index"""
+
+    def signature(self, text_content):
+        """
+        Compute the MinHash signature of a document's text
+
+        Returns:
+            numpy.ndarray: NUM_PERMUTATIONS uint32 values, or None for texts too short to fingerprint
+        """
+        words = re.findall(r'[a-z0-9]+', text_content.lower())
+        if len(words) < SHINGLE_SIZE:
+            return None
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+             for shingle in shingles),
+            dtype=np.uint64, count=len(shingles))
+        signature = np.full(NUM_PERMUTATIONS, MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(hashes), SIGNATURE_BLOCK):
+            block = hashes[start:start + SIGNATURE_BLOCK]
+            permuted = np.bitwise_and((np.outer(block, PERM_A) + PERM_B) % MERSENNE_PRIME, MAX_HASH)
+            np.minimum(signature, permuted.min(axis=0), out=signature)
+        return signature.astype(np.uint32)
+
+    def find_duplicate(self, signature, user_id):
+        """
+        Find an existing primary document that nearly duplicates the signature
+
+        Args:
+            signature (numpy.ndarray): Signature of the new upload
+            user_id (int): Uploading user; their own documents win ties
+
+        Returns:
+            tuple: (Document, estimated Jaccard similarity) or (None, 0.0)
+        """
+        if signature is None:
+            return None, 0.0
+        try:
+            bands = self._band_hashes(signature)
+            query = db.session.query(LshBucket.document_id).filter(
+                db.tuple_(LshBucket.band, LshBucket.bucket).in_(list(enumerate(bands))))
+            if not DEDUP_GLOBAL:
+                query = query.join(DocumentFingerprint).filter(DocumentFingerprint.user_id == user_id)
+            candidate_ids = {row.document_id for row in query.distinct()}
+            if not candidate_ids:
+                return None, 0.0
+
+            best, best_key = None, None
+            for fingerprint in DocumentFingerprint.query.filter(
+                    DocumentFingerprint.document_id.in_(candidate_ids)).all():
+                candidate = np.frombuffer(fingerprint.signature, dtype=np.uint32)
+                similarity = float(np.mean(candidate == signature))
+                if similarity < DEDUP_SIMILARITY_THRESHOLD:
+                    continue
+                key = (fingerprint.user_id == user_id, similarity)
+                if best_key is None or key > best_key:
+                    best, best_key = fingerprint, key
+
+            if best is None:
+                return None, 0.0
+            logger.info(f"Upload nearly duplicates document {best.document_id} (similarity {best_key[1]:.2f})")
+            return best.document, best_key[1]
+        except Exception as e:
+            logger.error(f"Error searching LSH index: {e}")
+            return None, 0.0
+
+    def remember(self, document, signature):
+        """Add a saved primary document to the LSH index"""
+        if signature is None:
+            return
+        fingerprint = DocumentFingerprint(
+            document_id=document.id,
+            user_id=document.user_id,
+            signature=signature.astype(np.uint32).tobytes()
+        )
+        db.session.add(fingerprint)
+        db.session.add_all(
+            LshBucket(band=band, bucket=bucket, document_id=document.id)
+            for band, bucket in enumerate(self._band_hashes(signature)))
+
+    def clone_derived_data(self, source, target, reused_citations, vector_store):
+        """
+        Copy citation contexts and chunk vectors from a duplicate's source to the new document
+
+        Args:
+            source (Document): The existing document the upload duplicates
+            target (Document): The new document (must already have an id)
+            reused_citations (list): (new citation Document, source citation id) pairs
+            vector_store (ChunkVectorStore): Store holding the chunk embeddings
+        """
+        cited_id_map = {source_id: citation_doc.id for citation_doc, source_id in reused_citations}
+
+        for context in source.citation_contexts:
+            db.session.add(CitationContext(
+                document_id=target.id,
+                cited_document_id=cited_id_map.get(context.cited_document_id),
+                marker=context.marker,
+                reference_label=context.reference_label,
+                reference_text=context.reference_text,
+                sentence=context.sentence,
+                position=context.position
+            ))
+
+        for source_id, target_id in [(source.id, target.id)] + list(cited_id_map.items()):
+            chunks, vectors = vector_store.load(source_id, family_id=source.id)
+            if chunks is not None:
+                vector_store.save(target_id, chunks, vectors, family_id=target.id)
+        logger.info(f"Reused citations, contexts and vectors of document {source.id} for document {target.id}")
+
+    def _band_hashes(self, signature):
+        rows = signature.astype(np.uint32).reshape(LSH_BANDS, LSH_ROWS)
+        return [hashlib.blake2b(row.tobytes(), digest_size=8).hexdigest() for row in rows]
@@ -2,9 +2,10 @@ import os
 import uuid
 import io
 import logging
+from collections import namedtuple
 from datetime import datetime
 import tempfile
-from models import Document
+from models import Document, DocumentIndexState
 import requests
 import re
 from app import db
@@ -14,11 +15,44 @@ import PyPDF2
 from werkzeug.utils import secure_filename
 from flask import current_app
 from azure.storage.blob import BlobServiceClient, ContentSettings
-from config import AZURE_STORAGE_CONNECTION_STRING, AZURE_BLOB_CONTAINER_NAME
+from azure.core.exceptions import ResourceNotFoundError
+from config import (AZURE_STORAGE_CONNECTION_STRING, AZURE_BLOB_CONTAINER_NAME, TEXT_CACHE_SIZE, RETRIEVAL_BACKEND,
+                    PASSAGE_BUDGET_CHARS, HTTP_DOWNLOAD_DEADLINE_S, PIPELINE_VERSION)
+from cache import LRUCache
+from llm_scheduler import LLMBusyError, BACKGROUND
+from text_artifact import build_artifact, TextArtifactReader
+from dedup import DuplicateDetector
+from title_index import TitleIndex
+from fulltext_search import PostgresFullTextSearch
+from passage_extractor import extract_passages
+from text_normalizer import normalize_pages, with_references, REFERENCES_LABEL
+from resilient_http import http_client
+from ocr import PageOcr
+from cache_bus import cache_bus, TEXT, DOCUMENT
 
 # Set up logger
 logger = logging.getLogger(__name__)
 
+# Extracted text is stored next to each PDF blob as "<blob name>.apct"
+ARTIFACT_EXTENSION = ".apct"
+
+# Every blob stored for a document: the PDF, its text artifact and the legacy .txt
+DOCUMENT_BLOB_EXTENSIONS = ('', ARTIFACT_EXTENSION, '.txt')
+
+# Normalized text of a document and its reference list, stored in separate artifact frames
+StoredText = namedtuple('StoredText', ['text', 'references'])
+
+# Maximum number of sub-requests in one Blob Batch API call
+BLOB_BATCH_SIZE = 256
+
+# What upload_document hands back to the upload view. When the upload nearly
+# duplicates an existing document, duplicate_of is that document and
+# reused_citations pairs each copied citation with the id it was copied from.
+UploadResult = namedtuple('UploadResult', [
+    'blob_name', 'blob_url', 'citation_docs', 'text_content',
+    'fingerprint', 'duplicate_of', 'reused_citations'
+])
+
 class DocumentManager:
 
     def __init__(self):
@@ -31,6 +65,16 @@ class DocumentManager:
         self.uploads_dir = os.path.join(os.getcwd(), 'uploads')
         os.makedirs(self.uploads_dir, exist_ok=True)
 
+        # Extracted text keyed by document blob name, plus local copies of text artifacts
+        self.text_cache = LRUCache(max_entries=TEXT_CACHE_SIZE)
+        self.artifacts_dir = os.path.join(self.uploads_dir, 'artifacts')
+        os.makedirs(self.artifacts_dir, exist_ok=True)
+        cache_bus.subscribe(TEXT, self._invalidate_text)
+
+        self.duplicate_detector = DuplicateDetector()
+        self.title_index = TitleIndex()
+        self.fulltext_search = PostgresFullTextSearch()
+
         # Initialize the blob service client
         try:
             self.blob_service_client = BlobServiceClient.from_connection_string(
@@ -46,6 +90,9 @@ class DocumentManager:
             self.blob_service_client = None
             self.container_client = None
 
+        # OCR for scanned pages, with results shared through blob storage
+        self.ocr = PageOcr(self.container_client)
+
     def container_exists(self):
         """Check if the Azure blob container exists"""
         try:
@@ -58,8 +105,13 @@ class DocumentManager:
             logger.warning(f"Container does not exist: {e}")
             return False
 
-    def upload_document(self, file, title, user_id, rag_system):
-        """Upload a document to Azure Blob Storage"""
+    def upload_document(self, file, title, user_id, rag_system, crawl_citations=True):
+        """
+        Upload a document to Azure Blob Storage
+
+        Args:
+            crawl_citations (bool): Extract the cited papers and fetch their PDFs (skipped by bulk imports on request)
+        """
         try:
             # Check if Azure connection is available
             if self.blob_service_client is None:
@@ -99,21 +151,35 @@ class DocumentManager:
 
             # Extract text from PDF for searching
             file.seek(0)
-            text_content = self._extract_text_from_pdf(file)
+            pages = self._extract_pages_from_pdf(file)
 
-            # Also upload the text content as a separate blob for searching
-            text_blob_name = f"{blob_name}.txt"
-            text_blob_client = self.container_client.get_blob_client(
-                text_blob_name)
-            text_blob_client.upload_blob(
-                io.BytesIO(text_content.encode('utf-8')),
-                content_settings=ContentSettings(content_type='text/plain'),
-                overwrite=True)
+            # Also upload the normalized text as a compressed artifact for searching
+            stored = self._store_text(blob_name, pages, {"title": title})
+            text_content = stored.text
+            # Citation extraction and the citation index also need the reference list
+            source_text = with_references(stored.text, stored.references)
 
             logger.info(f"Document uploaded to Azure: {blob_name}")
 
+            # A near-duplicate of an existing upload reuses its citations instead of re-crawling them
+            fingerprint = self.duplicate_detector.signature(text_content)
+            duplicate_of, _ = self.duplicate_detector.find_duplicate(fingerprint, user_id)
+            if duplicate_of is not None:
+                citation_docs, reused_citations = self._reuse_citations(duplicate_of, user_id)
+                return UploadResult(blob_name, blob_url, citation_docs, source_text,
+                                    fingerprint, duplicate_of, reused_citations)
+
+            if not crawl_citations:
+                return UploadResult(blob_name, blob_url, [], source_text, fingerprint, None, [])
+
             # Extract citations using RAG system
-            citation_titles = self._extract_citation_titles(text_content, rag_system)
+            try:
+                # The reference list alone is enough to name the cited papers
+                citation_titles = self._extract_citation_titles(stored.references or text_content, rag_system, user_id)
+            except LLMBusyError:
+                # Don't leave the half-ingested upload behind; the user retries later
+                self._delete_document_blobs([blob_name])
+                raise
             citation_docs = []
             
             # Process citations and store them
@@ -144,17 +210,18 @@ class DocumentManager:
                     logger.error(f"Error processing citation '{citation_title}': {str(e)}")
                     continue
 
-            return blob_name, blob_url, citation_docs
+            return UploadResult(blob_name, blob_url, citation_docs, source_text, fingerprint, None, [])
 
         except Exception as e:
             logger.error(f"Azure upload error: {e}")
             raise
         
-    def _extract_citation_titles(self, text_content, rag_system):
+    def _extract_citation_titles(self, text_content, rag_system, user_id=None):
         """Extract citation paper titles using the RAG system"""
         try:
             query = "List the titles of papers cited in the references section of the document."
-            response = rag_system._generate_llm_response(query, text_content)
+            response = rag_system._generate_llm_response(query, text_content, [],
+                                                         user_id=user_id, priority=BACKGROUND)
             
              # Parse response and remove digits from titles
             titles = [
@@ -166,22 +233,32 @@ class DocumentManager:
             print(response.split('\n'))
             titles = [title.strip() for title in titles if title.strip()]
             return titles[:20]  # Limit to 10 citations to avoid overwhelming the system
+        except LLMBusyError:
+            raise
         except Exception as e:
             current_app.logger.error(f"Citation extraction error: {e}")
             return []
         
 
     def _search_citation(self, citation_title):
-        """Search for citation metadata and PDF using Semantic Scholar API"""
+        """Search for citation metadata and PDF, locally first and then via the Semantic Scholar API"""
+        paper = self.title_index.lookup(citation_title)
+        if paper is not None:
+            logger.debug(f"Title index hit for '{citation_title}'")
+            return {
+                'title': paper['title'],
+                'openAccessPdf': paper['openAccessPdf'],
+            }
+
         try:
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
-            response = requests.get(
+            response = http_client.get(
                 "https://api.semanticscholar.org/graph/v1/paper/search/match",
                 params={
                     "query": citation_title,
-                    "fields": "openAccessPdf,title",
+                    "fields": "openAccessPdf,title,externalIds",
                     "openAccessPdf": "true"
                 },
                 headers=headers
@@ -190,9 +267,16 @@ class DocumentManager:
             data = response.json()
             if data.get('data'):
                 paper = data['data'][0]
+                open_access_pdf = paper.get('openAccessPdf', {}).get('url') if paper.get('openAccessPdf') else None
+                self.title_index.add(
+                    title=paper.get('title') or citation_title,
+                    open_access_pdf=open_access_pdf,
+                    paper_id=paper.get('paperId'),
+                    doi=(paper.get('externalIds') or {}).get('DOI')
+                )
                 return {
                     'title': paper.get('title'),
-                    'openAccessPdf': paper.get('openAccessPdf', {}).get('url') if paper.get('openAccessPdf') else None,
+                    'openAccessPdf': open_access_pdf,
 
                 }
             return None
@@ -217,7 +301,8 @@ class DocumentManager:
                 'Referer': 'https://www.semanticscholar.org/',
                 'Accept': 'application/pdf'
             }
-            response = requests.get(pdf_url, headers=headers, stream=True, allow_redirects=True, timeout=10)
+            response = http_client.get(pdf_url, headers=headers, allow_redirects=True,
+                                       deadline=HTTP_DOWNLOAD_DEADLINE_S)
             response.raise_for_status()
             if 'application/pdf' not in response.headers.get('Content-Type', ''):
                 logger.error(f"URL {pdf_url} did not return a PDF; Content-Type: {response.headers.get('Content-Type')}")
@@ -230,60 +315,260 @@ class DocumentManager:
             logger.error(f"Request error downloading PDF from {pdf_url}: {e}")
             return None
 
-    def _upload_citation_pdf(self, pdf_file, user_id, citation_title):
-        """Upload a citation PDF to Azure Blob Storage"""
+    def _reuse_citations(self, source, user_id):
+        """
+        Copy the citations of an existing document for a near-duplicate upload
+        
+        Blobs are copied server-side so each upload keeps its own lifecycle.
+        
+        Returns:
+            tuple: (new citation Documents, [(new citation Document, source citation id)])
+        """
+        citation_docs = []
+        reused_citations = []
+        for cited_doc in Document.query.filter_by(parent_document_id=source.id).all():
+            try:
+                blob_name = self._citation_blob_name(user_id, cited_doc.title)
+                for extension in DOCUMENT_BLOB_EXTENSIONS:
+                    source_blob_client = self.container_client.get_blob_client(f"{cited_doc.filename}{extension}")
+                    if source_blob_client.exists():
+                        self.container_client.get_blob_client(
+                            f"{blob_name}{extension}").start_copy_from_url(source_blob_client.url)
+
+                citation_doc = Document(
+                    title=cited_doc.title,
+                    filename=blob_name,
+                    blob_url=self.container_client.get_blob_client(blob_name).url,
+                    user_id=user_id,
+                    parent_document_id=None  # Will be set after original document is saved
+                )
+                db.session.add(citation_doc)
+                citation_docs.append(citation_doc)
+                reused_citations.append((citation_doc, cited_doc.id))
+            except Exception as e:
+                logger.error(f"Error reusing citation {cited_doc.id}: {str(e)}")
+        logger.info(f"Reused {len(citation_docs)} citations of document {source.id}")
+        return citation_docs, reused_citations
+
+    def _citation_blob_name(self, user_id, citation_title):
+        """Unique blob name for a citation PDF under the user's citations prefix"""
         current_time = datetime.now().strftime("%Y%m%d%H%M%S")
         unique_id = str(uuid.uuid4())[:8]
         safe_filename = secure_filename(f"{citation_title[:50]}.pdf")
-        blob_name = f"{user_id}/citations/{current_time}_{unique_id}_{safe_filename}"
+        return f"{user_id}/citations/{current_time}_{unique_id}_{safe_filename}"
+
+    def _upload_citation_pdf(self, pdf_file, user_id, citation_title):
+        """Upload a citation PDF to Azure Blob Storage"""
+        blob_name = self._citation_blob_name(user_id, citation_title)
+
+        # Upload the PDF itself
+        blob_client = self.container_client.get_blob_client(blob_name)
+        pdf_file.seek(0)
+        blob_client.upload_blob(pdf_file,
+                                content_settings=ContentSettings(content_type='application/pdf'),
+                                overwrite=True)
         
         pdf_file.seek(0)
-        text_content = self._extract_text_from_pdf(pdf_file)
+        pages = self._extract_pages_from_pdf(pdf_file)
 
         # Upload text content as a separate blob
-        text_blob_name = f"{blob_name}.txt"
-        text_blob_client = self.container_client.get_blob_client(text_blob_name)
-        text_blob_client.upload_blob(
-            io.BytesIO(text_content.encode('utf-8')),
-            content_settings=ContentSettings(content_type='text/plain'),
-            overwrite=True
-        )
+        self._store_text(blob_name, pages, {"title": citation_title})
 
         # Get the URL for the PDF blob
-        blob_url = text_blob_client.url
+        blob_url = blob_client.url
 
         logger.info(f"Cited document uploaded to Azure: {blob_name}")
         return blob_name, blob_url
     
     
-    def _extract_text_from_pdf(self, file):
-        """Extract text from a PDF file"""
+    def get_document_text(self, document):
+        """Return the extracted text of a Document, from the local cache when possible"""
+        return self.read_text(self._document_blob_name(document))
+
+    def get_document_pages(self, document, page_numbers):
+        """Return only the requested pages (1-based) of a Document's extracted text"""
+        return self.read_pages(self._document_blob_name(document), page_numbers)
+
+    def read_text(self, blob_name):
+        """Return the extracted text stored for a PDF blob"""
+        text_content = self.text_cache.get(blob_name)
+        if text_content is not None:
+            return text_content
+        try:
+            local_path = self._local_artifact_path(blob_name)
+            if os.path.exists(local_path):
+                text_content = TextArtifactReader.from_file(local_path).read_text(exclude_labels=(REFERENCES_LABEL,))
+            else:
+                text_content = self._download_text(blob_name)
+            self.text_cache.set(blob_name, text_content)
+            return text_content
+        except Exception as e:
+            logger.error(f"Error reading text for blob {blob_name}: {e}")
+            return ""
+
+    def read_pages(self, blob_name, page_numbers):
+        """Return the requested pages of a blob's text, reading only their frames"""
+        try:
+            local_path = self._local_artifact_path(blob_name)
+            if os.path.exists(local_path):
+                reader = TextArtifactReader.from_file(local_path)
+            else:
+                artifact_blob_client = self.container_client.get_blob_client(f"{blob_name}{ARTIFACT_EXTENSION}")
+                reader = TextArtifactReader.from_blob(artifact_blob_client)
+            # Frames after the pages hold other sections, such as the reference list
+            page_count = reader.metadata.get("pages", len(reader))
+            return reader.read_frames([page - 1 for page in page_numbers if page <= page_count])
+        except ResourceNotFoundError:
+            # Legacy plain-text blob: no page boundaries were stored
+            return [self.read_text(blob_name)]
+        except Exception as e:
+            logger.error(f"Error reading pages {page_numbers} for blob {blob_name}: {e}")
+            return []
+
+    def _store_text(self, blob_name, pages, metadata):
+        """
+        Normalize extracted pages and upload them as a compressed text artifact
+
+        The reference list goes into its own frame: it is kept for citation
+        extraction but left out of the text that prompts and searches read.
+
+        Returns:
+            StoredText: The normalized text and the reference list
+        """
+        normalized = normalize_pages(pages)
+        if normalized.raw_chars:
+            logger.info(
+                f"Normalized {blob_name}: ~{normalized.raw_chars // 4} -> ~{normalized.chars // 4} prompt tokens "
+                f"({1 - normalized.chars / normalized.raw_chars:.0%} smaller, "
+                f"{len(normalized.references)} reference characters set aside)")
+
+        frames = list(normalized.pages)
+        if normalized.references:
+            frames.append((REFERENCES_LABEL, normalized.references))
+        artifact = build_artifact(frames, {
+            **metadata,
+            "source": blob_name,
+            "pages": len(normalized.pages),
+            "chars": normalized.chars,
+            "raw_chars": normalized.raw_chars,
+            "reference_chars": len(normalized.references)
+        })
+        artifact_blob_client = self.container_client.get_blob_client(f"{blob_name}{ARTIFACT_EXTENSION}")
+        artifact_blob_client.upload_blob(
+            io.BytesIO(artifact),
+            content_settings=ContentSettings(content_type='application/octet-stream'),
+            overwrite=True)
+        self._save_local_artifact(blob_name, artifact)
+
+        text_content = "\n".join(normalized.pages)
+        self.text_cache.set(blob_name, text_content)
+        cache_bus.publish(TEXT, [blob_name])
+        return StoredText(text_content, normalized.references)
+
+    def _download_text(self, blob_name):
+        """Download a blob's text artifact, falling back to a legacy UTF-8 .txt blob"""
+        try:
+            artifact = self.container_client.get_blob_client(
+                f"{blob_name}{ARTIFACT_EXTENSION}").download_blob().readall()
+            self._save_local_artifact(blob_name, artifact)
+            return TextArtifactReader.from_bytes(artifact).read_text(exclude_labels=(REFERENCES_LABEL,))
+        except ResourceNotFoundError:
+            text_blob_client = self.container_client.get_blob_client(f"{blob_name}.txt")
+            return text_blob_client.download_blob().readall().decode('utf-8', errors='replace')
+
+    def _save_local_artifact(self, blob_name, artifact):
+        local_path = self._local_artifact_path(blob_name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as f:
+            f.write(artifact)
+
+    def _invalidate_text(self, blob_name, same_host):
+        """Drop text another process replaced or deleted (its local artifact too, if the change was on another host)"""
+        if blob_name is None:
+            self.text_cache.clear()
+            return
+        self.text_cache.pop(blob_name)
+        if not same_host:
+            try:
+                os.remove(self._local_artifact_path(blob_name))
+            except FileNotFoundError:
+                pass
+
+    def _local_artifact_path(self, blob_name):
+        return os.path.join(self.artifacts_dir, *blob_name.split('/')) + ARTIFACT_EXTENSION
+
+    def index_document_text(self, document, text_content=None, generations=None):
+        """
+        Store a document's chunks for the Postgres full-text backend when it is enabled
+
+        Also records the pipeline version the document was processed with.
+
+        Args:
+            document (Document): A saved document or citation row
+            text_content (str, optional): Its extracted text, read from storage when omitted
+            generations (list, optional): Index generations to write; all writable ones by default
+        """
+        db.session.merge(DocumentIndexState(document_id=document.id, pipeline_version=PIPELINE_VERSION,
+                                            processed_at=datetime.utcnow()))
+        if RETRIEVAL_BACKEND != 'postgres':
+            return 0
+        if text_content is None:
+            text_content = self.get_document_text(document)
+        return self.fulltext_search.index_document(document, text_content, generations=generations)
+
+    def reextract_text(self, document):
+        """
+        Run text extraction again on a stored document's PDF and replace its text artifact
+
+        Returns:
+            str: The extracted text
+        """
+        blob_name = self._document_blob_name(document)
+        try:
+            pdf_data = self.container_client.get_blob_client(blob_name).download_blob().readall()
+        except ResourceNotFoundError:
+            # Citations ingested before their PDFs were stored only have extracted text
+            logger.warning(f"No PDF blob for {blob_name}; keeping its stored text")
+            return self.read_text(blob_name)
+        pages = self._extract_pages_from_pdf(io.BytesIO(pdf_data))
+        stored = self._store_text(blob_name, pages, {"title": document.title})
+        # Prompt prefixes embed the document's text
+        cache_bus.publish(DOCUMENT, [document.id])
+        return stored.text
+
+    def _document_blob_name(self, document):
+        """Name of the PDF blob for a Document row (its text is stored next to it)"""
+        if document.parent_document_id is not None:
+            # Citation rows store the full blob name in filename
+            return document.filename
+        return f"{document.user_id}/{document.blob_url.split('/')[-1]}"
+
+    def _extract_pages_from_pdf(self, file):
+        """Extract the text of each page of a PDF file"""
         try:
             # Read the file into memory
             file.seek(0)
             pdf_data = file.read()
-            
-            # Open PDF with PyMuPDF
+
+            # Open PDF with PyMuPDF and extract text from each page
             pdf_document = fitz.open(stream=BytesIO(pdf_data), filetype="pdf")
-            text_content = ""
-            
-            # Extract text from each page
-            for page in pdf_document:
-                text_content += page.get_text("text") + "\n"
-            
+            pages = [page.get_text("text") for page in pdf_document]
             pdf_document.close()
-            
+
+            # Scanned pages have no text layer
+            pages = self.ocr.fill_missing(pdf_data, pages)
+
             # Validate extracted text
-            if not text_content.strip():
+            if not any(page.strip() for page in pages):
                 logger.warning("No text extracted from PDF")
-                return ""
-            
-            logger.info(f"Extracted {len(text_content)} characters from PDF")
-            return text_content
-        
+                return []
+
+            logger.info(f"Extracted {sum(len(page) for page in pages)} characters from {len(pages)} PDF pages")
+            return pages
+
         except Exception as e:
             logger.error(f"Error extracting text from PDF: {str(e)}")
-            return ""
+            return []
 
     # def search_documents(self, query, user_id, document_id=None, top=5):
     #     """Search documents using simple text matching in Azure Blob Storage"""
@@ -379,6 +664,9 @@ class DocumentManager:
 
     def search_documents(self, query, user_id, document_id=None, top=5):
         """Search documents and their citations using simple text matching in Azure Blob Storage"""
+        if RETRIEVAL_BACKEND == 'postgres':
+            return self.fulltext_search.search(query, user_id, document_id=document_id, top=top)
+
         results = []
 
         try:
@@ -388,15 +676,11 @@ class DocumentManager:
             if document_id:
                 # If document_id is specified, search the primary document and its citations
                 document = Document.query.get(document_id)
-                text_blob_name = f"{document.blob_url.split('/')[-1]}.txt"
-                blob_client = self.container_client.get_blob_client(prefix + text_blob_name)
+                blob_name = self._document_blob_name(document)
 
-                # Retrieve primary document content
+                # Retrieve primary document content (served from the text cache once warmed)
                 try:
-                    download_stream = blob_client.download_blob()
-                    text_content = download_stream.readall().decode('latin-1')
-                    # Get the original blob name (without .txt)
-                    blob_name = text_blob_name[:-4]
+                    text_content = self.get_document_text(document)
                     original_blob_client = self.container_client.get_blob_client(blob_name)
 
                     results.append({
@@ -405,25 +689,22 @@ class DocumentManager:
                         "filename": blob_name.split('/')[-1],
                         "title": blob_name.split('/')[-1],
                         "user_id": str(user_id),
-                        "content": self._get_context_around_query(text_content, query),
+                        "content": text_content,  # The primary document is always sent in full
                         "document_id": document_id,
                         "is_citation": False
                     })
                 except Exception as e:
-                    logger.error(f"Error downloading primary blob {text_blob_name}: {e}")
+                    logger.error(f"Error reading primary document {blob_name}: {e}")
 
                 # Retrieve cited documents from the database
                 cited_documents = Document.query.filter_by(parent_document_id=document_id, user_id=user_id).all()
                 print(cited_documents)
                 for cited_doc in cited_documents[:top]:
                     try:
-                        cited_blob_name = f"{cited_doc.filename}.txt"
-                        cited_blob_client = self.container_client.get_blob_client(cited_blob_name)
-                        download_stream = cited_blob_client.download_blob()
-                        cited_text_content = download_stream.readall().decode('latin-1')
+                        cited_text_content = self.get_document_text(cited_doc)
 
                         # Get the original blob name for the cited document
-                        cited_original_blob_name = cited_blob_name[:-4]
+                        cited_original_blob_name = cited_doc.filename
                         cited_original_blob_client = self.container_client.get_blob_client(cited_original_blob_name)
 
                         results.append({
@@ -437,25 +718,24 @@ class DocumentManager:
                             "is_citation": True
                         })
                     except Exception as e:
-                        logger.error(f"Error downloading cited blob {cited_blob_name}: {e}")
+                        logger.error(f"Error reading cited document {cited_doc.filename}: {e}")
             else:
                 # Search all text blobs for the user, including citations
-                text_blobs = list(self.container_client.list_blobs(name_starts_with=prefix))
-                text_blobs = [blob for blob in text_blobs if blob.name.endswith('.txt')]
+                # Text is stored as a .apct artifact, or a .txt blob for older uploads
+                text_blob_names = {}
+                for blob in self.container_client.list_blobs(name_starts_with=prefix):
+                    for extension in (ARTIFACT_EXTENSION, '.txt'):
+                        if blob.name.endswith(extension):
+                            text_blob_names.setdefault(blob.name[:-len(extension)], blob.name)
 
                 # Get all documents for the user to check for citations
                 user_documents = Document.query.filter_by(user_id=user_id).all()
                 document_map = {doc.filename: doc for doc in user_documents}
 
                 # Limit to top N files
-                for text_blob in text_blobs[:top]:
+                for blob_name in list(text_blob_names)[:top]:
                     try:
-                        blob_client = self.container_client.get_blob_client(text_blob.name)
-                        download_stream = blob_client.download_blob()
-                        text_content = download_stream.readall().decode('utf-8')
-
-                        # Get the original blob name (without .txt)
-                        blob_name = text_blob.name[:-4]
+                        text_content = self.read_text(blob_name)
                         original_blob_client = self.container_client.get_blob_client(blob_name)
 
                         # Check if this is a cited document
@@ -472,7 +752,7 @@ class DocumentManager:
                             "is_citation": is_citation
                         })
                     except Exception as e:
-                        logger.error(f"Error processing blob {text_blob.name}: {e}")
+                        logger.error(f"Error processing blob {blob_name}: {e}")
 
         except Exception as e:
             logger.error(f"Azure search error: {e}")
@@ -480,37 +760,55 @@ class DocumentManager:
         return results
 
 
-    def _get_context_around_query(self, content, query, context_size=500):
-        """Get text context around the search query"""
-        lower_content = content.lower()
-        lower_query = query.lower()
+    def _get_context_around_query(self, content, query, context_size=PASSAGE_BUDGET_CHARS):
+        """Get the passages of content that best match the query, up to context_size characters"""
+        return extract_passages(content, query, budget=context_size)
 
-        # If query not found, return beginning of content
-        return content
-
-    def delete_document(self, blob_name, user_id):
-        """Delete a document from Azure Blob Storage"""
+    def delete_document(self, document, user_id):
+        """Delete a document and all of its citations from Azure Blob Storage"""
         try:
-            # Ensure the blob belongs to this user
-            if not blob_name.startswith(f"{user_id}/"):
+            documents = [document] + document.citations.all()
+            blob_names = [self._document_blob_name(doc) for doc in documents]
+
+            # Ensure the blobs belong to this user
+            if not all(blob_name.startswith(f"{user_id}/") for blob_name in blob_names):
                 current_app.logger.warning(
-                    f"Unauthorized attempt to delete blob {blob_name} by user {user_id}"
+                    f"Unauthorized attempt to delete document {document.id} by user {user_id}"
                 )
                 return False
 
-            # Delete the PDF blob
-            blob_client = self.container_client.get_blob_client(blob_name)
-            blob_client.delete_blob()
-
-            # Delete the text blob
-            text_blob_name = f"{blob_name}.txt"
-            text_blob_client = self.container_client.get_blob_client(
-                text_blob_name)
-            text_blob_client.delete_blob()
-
+            deleted = self._delete_document_blobs(blob_names)
             current_app.logger.info(
-                f"Document {blob_name} deleted for user {user_id}")
+                f"Document {document.id} and {len(documents) - 1} citations deleted for user {user_id} "
+                f"({deleted} blobs)")
             return True
         except Exception as e:
-            current_app.logger.error(f"Error deleting blob {blob_name}: {e}")
+            current_app.logger.error(f"Error deleting blobs of document {document.id}: {e}")
             return False
+
+    def delete_blobs(self, blob_names):
+        """
+        Delete blobs with batched requests; blobs that no longer exist are ignored
+        
+        Returns:
+            int: Number of blobs actually deleted
+        """
+        deleted = 0
+        blob_names = list(blob_names)
+        for i in range(0, len(blob_names), BLOB_BATCH_SIZE):
+            responses = self.container_client.delete_blobs(
+                *blob_names[i:i + BLOB_BATCH_SIZE], raise_on_any_failure=False)
+            deleted += sum(1 for response in responses if response.status_code in (200, 202))
+        return deleted
+
+    def _delete_document_blobs(self, blob_names):
+        """Delete the PDF and text blobs of documents, plus their local copies"""
+        deleted = self.delete_blobs(
+            f"{blob_name}{extension}" for blob_name in blob_names for extension in DOCUMENT_BLOB_EXTENSIONS)
+        for blob_name in blob_names:
+            self.text_cache.pop(blob_name)
+            local_path = self._local_artifact_path(blob_name)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        cache_bus.publish(TEXT, blob_names)
+        return deleted
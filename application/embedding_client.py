@@ -0,0 +1,63 @@
+import logging
+import requests
+from config import EMBEDDING_SERVICE_URL
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingClient:
+    """Client for the shared embedding service (embedding_service.py)"""
+
+    def __init__(self, base_url=EMBEDDING_SERVICE_URL, timeout=30):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    @property
+    def available(self):
+        return self.base_url is not None
+
+    def healthy(self, timeout=5):
+        """Whether the service answers /health; a configured URL alone doesn't mean it's running"""
+        if not self.available:
+            return False
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=timeout)
+            response.raise_for_status()
+            return response.json().get("status") == "ok"
+        except Exception as e:
+            logger.warning(f"Embedding service not reachable at {self.base_url}: {e}")
+            return False
+
+    def embed_documents(self, texts, batch_size=256):
+        """Embed document chunks in bulk; returns a list of vectors or None on failure"""
+        if not self.available or not texts:
+            return None
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            batch = self._embed(texts[i:i + batch_size], kind="document")
+            if batch is None:
+                return None
+            vectors.extend(batch)
+        return vectors
+
+    def embed_query(self, text):
+        """Embed a single query; returns a vector or None on failure"""
+        if not self.available:
+            return None
+        vectors = self._embed([text], kind="query", timeout=5)
+        return vectors[0] if vectors else None
+
+    def _embed(self, texts, kind, timeout=None):
+        try:
+            response = self.session.post(
+                f"{self.base_url}/embed",
+                json={"texts": texts, "kind": kind},
+                timeout=timeout or self.timeout
+            )
+            response.raise_for_status()
+            return response.json()["embeddings"]
+        except Exception as e:
+            logger.error(f"Embedding service error: {e}")
+            return None
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Local embedding service shared by all gunicorn workers.
+
+Loads one embedding model, batches concurrent requests under a short latency
+window and serves them over HTTP on the loopback interface:
+
+    POST /embed   {"texts": [...], "kind": "query" | "document"}
+    GET  /health
+
+Run it next to gunicorn (see startup.txt):
+
+    python embedding_service.py
+"""
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import LRUCache
+from config import (EMBEDDING_SERVICE_HOST, EMBEDDING_SERVICE_PORT, EMBEDDING_MODEL_NAME,
+                    EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_LATENCY_MS, EMBEDDING_QUERY_CACHE_SIZE)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# Queries jump ahead of bulk ingestion batches
+QUERY_PRIORITY = 0
+DOCUMENT_PRIORITY = 1
+
+
+class EmbeddingBatcher:
+    """Collects embedding requests into micro-batches for a single model"""
+
+    def __init__(self, model, max_batch_size=EMBEDDING_MAX_BATCH_SIZE, max_latency_ms=EMBEDDING_MAX_LATENCY_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self.batches = 0
+        self.texts = 0
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, texts, priority=DOCUMENT_PRIORITY):
+        """Queue texts for embedding and return a Future of their vectors"""
+        future = Future()
+        self.queue.put((priority, next(self._sequence), texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0][2])
+            deadline = time.monotonic() + self.max_latency
+
+            # Keep collecting until the batch is full or the latency window closes
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[2])
+
+            texts = [text for _, _, item_texts, _ in batch for text in item_texts]
+            try:
+                vectors = self.model.encode(texts,
+                                            batch_size=self.max_batch_size,
+                                            normalize_embeddings=True,
+                                            convert_to_numpy=True)
+                offset = 0
+                for _, _, item_texts, future in batch:
+                    future.set_result(vectors[offset:offset + len(item_texts)].tolist())
+                    offset += len(item_texts)
+                self.batches += 1
+                self.texts += len(texts)
+            except Exception as e:
+                logger.error(f"Error embedding batch of {len(texts)} texts: {e}")
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+
+
+class EmbeddingService:
+    """Model, batcher and query cache behind the HTTP API"""
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        from sentence_transformers import SentenceTransformer
+
+        logger.info(f"Loading embedding model {model_name}...")
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.batcher = EmbeddingBatcher(self.model)
+        self.query_cache = LRUCache(max_entries=EMBEDDING_QUERY_CACHE_SIZE)
+        logger.info(f"Embedding model loaded ({self.dimension} dimensions)")
+
+    def embed(self, texts, kind="document"):
+        """Embed texts, serving repeated queries from the LRU cache"""
+        if kind != "query":
+            # Split bulk requests so queued queries can interleave with them
+            futures = [self.batcher.submit(texts[i:i + self.batcher.max_batch_size], DOCUMENT_PRIORITY)
+                       for i in range(0, len(texts), self.batcher.max_batch_size)]
+            return [vector for future in futures for vector in future.result()]
+
+        vectors = [self.query_cache.get(text) for text in texts]
+        missing = [text for text, vector in zip(texts, vectors) if vector is None]
+        if missing:
+            computed = dict(zip(missing, self.batcher.submit(missing, QUERY_PRIORITY).result()))
+            for text, vector in computed.items():
+                self.query_cache.set(text, vector)
+            vectors = [vector if vector is not None else computed[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "dimension": self.dimension,
+            "batches": self.batcher.batches,
+            "texts": self.batcher.texts,
+            "queued": self.batcher.queue.qsize(),
+            "query_cache_size": len(self.query_cache),
+            "query_cache_hits": self.query_cache.hits,
+            "query_cache_misses": self.query_cache.misses
+        }
+
+
+def make_handler(service):
+    class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json({"error": "Not found"}, 404)
+                return
+            self._send_json({"status": "ok", **service.stats()})
+
+        def do_POST(self):
+            if self.path != "/embed":
+                self._send_json({"error": "Not found"}, 404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                texts = payload.get("texts") or []
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    self._send_json({"error": "texts must be a list of strings"}, 400)
+                    return
+                vectors = service.embed(texts, kind=payload.get("kind", "document"))
+                self._send_json({"model": service.model_name, "dimension": service.dimension, "embeddings": vectors})
+            except Exception as e:
+                logger.error(f"Error handling embed request: {e}")
+                self._send_json({"error": str(e)}, 500)
+
+        def _send_json(self, body, status=200):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return EmbeddingRequestHandler
+
+
+def main():
+    service = EmbeddingService()
+    server = ThreadingHTTPServer((EMBEDDING_SERVICE_HOST, EMBEDDING_SERVICE_PORT), make_handler(service))
+    logger.info(f"Embedding service listening on {EMBEDDING_SERVICE_HOST}:{EMBEDDING_SERVICE_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Embedding service stopped")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
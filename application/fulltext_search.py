@@ -0,0 +1,122 @@
+import logging
+import re
+from sqlalchemy import func, or_
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from app import db
+from models import Document, DocumentChunk, IndexGeneration
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Words too common to help ranking (Postgres drops English stopwords itself)
+MIN_TERM_LENGTH = 3
+
+
+class PostgresFullTextSearch:
+    """Retrieval backend over DocumentChunk rows with tsvector columns and a GIN index"""
+
+    def __init__(self):
+        # No overlap, so a document's text can be reassembled from its chunks in order
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=0)
+
+    def index_document(self, document, text_content, generations=None):
+        """
+        Replace the stored chunks of a document
+
+        Args:
+            document (Document): A saved document or citation row
+            text_content (str): Its extracted text
+            generations (list, optional): Index generations to write; the active one and any being built by default
+
+        Returns:
+            int: Number of chunks stored
+        """
+        try:
+            if generations is None:
+                generations = self.writable_generations()
+            DocumentChunk.query.filter(DocumentChunk.document_id == document.id,
+                                       DocumentChunk.generation.in_(generations)).delete(synchronize_session=False)
+            chunks = self.splitter.split_text(text_content)
+            db.session.add_all(
+                DocumentChunk(document_id=document.id, user_id=document.user_id, chunk_index=i, content=chunk,
+                              generation=generation)
+                for generation in generations for i, chunk in enumerate(chunks))
+            logger.info(f"Stored {len(chunks)} full-text chunks for document {document.id}")
+            return len(chunks)
+        except Exception as e:
+            logger.error(f"Error indexing chunks for document {document.id}: {e}")
+            return 0
+
+    def active_generation(self):
+        """Id of the generation searches read from; 0 until a reindex has been switched over"""
+        generation = IndexGeneration.query.filter_by(status='active').order_by(IndexGeneration.id.desc()).first()
+        return generation.id if generation else 0
+
+    def writable_generations(self):
+        """The active generation plus any being built, so new uploads are not missing after a switch"""
+        building = [generation.id for generation in IndexGeneration.query.filter_by(status='building')]
+        return [self.active_generation()] + building
+
+    def search(self, query, user_id, document_id=None, top=5, chunks_per_document=3):
+        """
+        Rank chunks with ts_rank in a single indexed query
+
+        With document_id the search is limited to that document and its citations,
+        and the primary document's full text is reassembled from its chunks.
+        Results have the same shape as DocumentManager.search_documents.
+        """
+        results = []
+        try:
+            generation = self.active_generation()
+            document_filter = None
+            if document_id:
+                document_filter = or_(Document.id == document_id, Document.parent_document_id == document_id)
+                primary = Document.query.get(document_id)
+                primary_chunks = DocumentChunk.query.filter_by(document_id=document_id, generation=generation) \
+                    .order_by(DocumentChunk.chunk_index).with_entities(DocumentChunk.content).all()
+                results.append(self._result(primary, "\n".join(chunk.content for chunk in primary_chunks),
+                                            is_citation=False, result_document_id=document_id))
+
+            terms = [term for term in re.findall(r'\w+', query.lower()) if len(term) >= MIN_TERM_LENGTH]
+            if not terms or (document_id and top <= 0):
+                return results
+
+            # OR the terms so a question matches chunks containing any of them; ts_rank orders by coverage
+            tsquery = func.to_tsquery('english', " | ".join(terms))
+            rank = func.ts_rank(DocumentChunk.search_vector, tsquery).label('rank')
+            rows = db.session.query(DocumentChunk.document_id, DocumentChunk.content, rank) \
+                .join(Document, Document.id == DocumentChunk.document_id) \
+                .filter(DocumentChunk.user_id == user_id, DocumentChunk.generation == generation) \
+                .filter(DocumentChunk.search_vector.op('@@')(tsquery))
+            if document_filter is not None:
+                rows = rows.filter(document_filter, Document.id != document_id)
+            rows = rows.order_by(rank.desc()).limit(top * chunks_per_document).all()
+
+            # Group the best chunks per document, keeping documents in rank order
+            grouped = {}
+            for row in rows:
+                chunks = grouped.setdefault(row.document_id, [])
+                if len(chunks) < chunks_per_document:
+                    chunks.append(row.content)
+            documents = {doc.id: doc for doc in Document.query.filter(Document.id.in_(list(grouped))).all()}
+            for matched_id, chunks in list(grouped.items())[:top]:
+                document = documents[matched_id]
+                results.append(self._result(document, "\n\n".join(chunks),
+                                            is_citation=document.parent_document_id is not None,
+                                            result_document_id=matched_id))
+        except Exception as e:
+            logger.error(f"Full-text search error: {e}")
+        logger.info(f"Full-text search results: {len(results)} documents found")
+        return results
+
+    def _result(self, document, content, is_citation, result_document_id):
+        return {
+            "id": f"{document.id}_chunk_0",
+            "blob_url": document.blob_url,
+            "filename": document.filename.split('/')[-1],
+            "title": document.title,
+            "user_id": str(document.user_id),
+            "content": content,
+            "document_id": result_document_id,
+            "is_citation": is_citation
+        }
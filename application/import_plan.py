@@ -0,0 +1,180 @@
+"""
+Planning a library import from the uploaded files.
+
+BibTeX entries are matched to the uploaded PDFs their file field names;
+PDFs no entry names are paired with an entry by DOI or title from their
+own metadata, or imported on their own. Nothing here touches the database,
+so plans can be made (and tested) without the app.
+"""
+import logging
+import os
+import re
+import fitz
+from werkzeug.utils import secure_filename
+from titles import DOI_PATTERN, normalize_title
+from config import IMPORT_MAX_PAPERS
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+BIBTEX_ENTRY_START = re.compile(r'@\s*([A-Za-z]+)\s*([{(])')
+BIBTEX_FIELD_NAME = re.compile(r'\s*([A-Za-z][\w\-:.]*)\s*=\s*')
+BIBTEX_BARE_VALUE = re.compile(r'[^,\s#})]+')
+ARXIV_ID = re.compile(r'arxiv\.org/(?:abs|pdf)/([\w.\-/]+?)(?:v\d+)?(?:\.pdf)?$', re.IGNORECASE)
+PDF_FILE_NAME = re.compile(r'([^:;{}\\/]+\.pdf)', re.IGNORECASE)
+
+
+def parse_bibtex(text):
+    """
+    Parse the entries of a BibTeX file
+
+    Returns:
+        list: One dict per entry with 'type', 'key' and its fields (lowercase names, raw values)
+    """
+    entries = []
+    position = 0
+    while True:
+        match = BIBTEX_ENTRY_START.search(text, position)
+        if match is None:
+            break
+        end = _closing_index(text, match.end() - 1, match.group(2), '}' if match.group(2) == '{' else ')')
+        position = end + 1
+        entry_type = match.group(1).lower()
+        if entry_type in ('comment', 'preamble', 'string'):
+            continue
+        key, _, fields_text = text[match.end():end].partition(',')
+        entries.append({'type': entry_type, 'key': key.strip(), **_parse_fields(fields_text)})
+    return entries
+
+
+def _closing_index(text, start, open_char, close_char):
+    depth = 0
+    for index in range(start, len(text)):
+        char = text[index]
+        if index and text[index - 1] == '\\':
+            continue
+        if char == open_char:
+            depth += 1
+        elif char == close_char:
+            depth -= 1
+            if depth == 0:
+                return index
+    return len(text)
+
+
+def _parse_fields(text):
+    fields = {}
+    position = 0
+    while True:
+        match = BIBTEX_FIELD_NAME.match(text, position)
+        if match is None:
+            break
+        position = match.end()
+        parts = []
+        # A value is one or more braced, quoted or bare parts joined with '#'
+        while position < len(text):
+            char = text[position]
+            if char == '{':
+                end = _closing_index(text, position, '{', '}')
+                parts.append(text[position + 1:end])
+                position = end + 1
+            elif char == '"':
+                end = position + 1
+                depth = 0
+                while end < len(text) and not (text[end] == '"' and depth == 0 and text[end - 1] != '\\'):
+                    depth += {'{': 1, '}': -1}.get(text[end], 0)
+                    end += 1
+                parts.append(text[position + 1:end])
+                position = end + 1
+            else:
+                bare = BIBTEX_BARE_VALUE.match(text, position)
+                if bare is None:
+                    break
+                parts.append(bare.group(0))
+                position = bare.end()
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position < len(text) and text[position] == '#':
+                position += 1
+                while position < len(text) and text[position].isspace():
+                    position += 1
+                continue
+            break
+        fields[match.group(1).lower()] = "".join(parts)
+        while position < len(text) and text[position] in ', \t\r\n':
+            position += 1
+    return fields
+
+
+def clean_latex(value):
+    """Plain text of a BibTeX value: escapes resolved, commands and braces dropped, whitespace collapsed"""
+    value = re.sub(r'\\([&%$#_{}])', r'\1', value or "")
+    value = re.sub(r'\\[A-Za-z]+\s*|\\.', '', value)
+    return " ".join(value.replace('{', '').replace('}', '').replace('~', ' ').split())
+
+
+def _entry_doi(entry):
+    doi = entry.get('doi') or ""
+    match = DOI_PATTERN.search(doi) or DOI_PATTERN.search(entry.get('url') or "")
+    return match.group(1).rstrip('.').lower() if match else None
+
+
+def _entry_arxiv(entry):
+    if entry.get('eprint') and (entry.get('archiveprefix') or entry.get('eprinttype') or "").lower() == 'arxiv':
+        return entry['eprint'].strip()
+    match = ARXIV_ID.search((entry.get('url') or "").strip())
+    return match.group(1) if match else None
+
+
+def plan_import(directory):
+    """
+    One entry per paper to import: BibTeX entries with the PDF they name (if it was uploaded),
+    then uploaded PDFs that no entry names
+
+    Returns:
+        list: Dicts with title, doi, arxiv, filename and pdf_url
+    """
+    names = sorted(os.listdir(directory))
+    pdfs = {name.lower(): name for name in names if name.lower().endswith('.pdf')}
+    planned = []
+    for bib_name in (name for name in names if name.lower().endswith('.bib')):
+        with open(os.path.join(directory, bib_name), encoding='utf-8', errors='replace') as f:
+            entries = parse_bibtex(f.read())
+        for entry in entries:
+            title = clean_latex(entry.get('title'))
+            if not title:
+                continue
+            filename = next((pdfs.pop(candidate.lower()) for candidate in
+                             (secure_filename(name) for name in PDF_FILE_NAME.findall(entry.get('file') or ""))
+                             if candidate.lower() in pdfs), None)
+            planned.append({'title': title, 'doi': _entry_doi(entry), 'arxiv': _entry_arxiv(entry),
+                            'filename': filename, 'pdf_url': None})
+
+    # PDFs no entry named: pair them with entries by DOI or title, or import them on their own
+    by_doi = {entry['doi']: entry for entry in planned if entry['doi'] and entry['filename'] is None}
+    by_title = {normalize_title(entry['title']): entry for entry in planned if entry['filename'] is None}
+    for name in sorted(pdfs.values()):
+        title, doi = _pdf_metadata(os.path.join(directory, name))
+        entry = by_doi.get(doi) or by_title.get(normalize_title(title))
+        if entry is not None and entry['filename'] is None:
+            entry['filename'] = name
+            continue
+        planned.append({'title': title or os.path.splitext(name)[0].replace('_', ' '), 'doi': doi,
+                        'arxiv': None, 'filename': name, 'pdf_url': None})
+
+    if len(planned) > IMPORT_MAX_PAPERS:
+        raise ValueError(f"The import holds {len(planned)} papers; the limit is {IMPORT_MAX_PAPERS}")
+    return planned
+
+
+def _pdf_metadata(path):
+    """(title, DOI) of a PDF from its document info and first page; either may be None"""
+    try:
+        with fitz.open(path) as pdf_document:
+            title = (pdf_document.metadata or {}).get('title') or None
+            first_page = pdf_document[0].get_text("text") if len(pdf_document) else ""
+        match = DOI_PATTERN.search(first_page)
+        return title, match.group(1).rstrip('.').lower() if match else None
+    except Exception as e:
+        logger.warning(f"Could not read metadata of {os.path.basename(path)}: {e}")
+        return None, None
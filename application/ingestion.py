@@ -0,0 +1,81 @@
+import logging
+from werkzeug.utils import secure_filename
+from app import db
+from models import Document
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+
+class DocumentIngestor:
+    """Turns an uploaded PDF into a Document with its citations, citation contexts and retrieval indexes"""
+
+    def __init__(self, document_manager, rag_system, citation_index):
+        self.document_manager = document_manager
+        self.rag_system = rag_system
+        self.citation_index = citation_index
+
+    def ingest(self, file, title, user_id, crawl_citations=True):
+        """
+        Store and index one PDF (the caller rolls back on errors)
+
+        Args:
+            file: Uploaded file with filename and content_type
+            title (str): Document title
+            user_id (int): Owner
+            crawl_citations (bool): Extract the cited papers and fetch their PDFs
+
+        Returns:
+            Document: The committed document
+
+        Raises:
+            LLMBusyError: Citation extraction could not be scheduled; nothing was stored
+        """
+        upload = self.document_manager.upload_document(
+            file=file,
+            title=title,
+            user_id=user_id,
+            rag_system=self.rag_system,
+            crawl_citations=crawl_citations
+        )
+        citation_docs = upload.citation_docs
+
+        # Save document info to database
+        new_document = Document(
+            title=title[:100],
+            filename=secure_filename(file.filename)[:100],
+            blob_url=upload.blob_url,
+            user_id=user_id,
+            parent_document_id=None
+        )
+        db.session.add(new_document)
+        db.session.flush()
+
+        for citation_doc in citation_docs:
+            citation_doc.parent_document_id = new_document.id
+
+        duplicate_detector = self.document_manager.duplicate_detector
+        if upload.duplicate_of is not None:
+            # Near-duplicate upload: copy contexts and vectors instead of recomputing them
+            duplicate_detector.clone_derived_data(
+                upload.duplicate_of, new_document, upload.reused_citations, self.rag_system.vector_store)
+            self.rag_system.citation_metadata.clone(upload.duplicate_of, new_document, upload.reused_citations)
+        else:
+            # Index the sentences that cite each reference
+            self.citation_index.build(new_document, upload.text_content, citation_docs)
+        duplicate_detector.remember(new_document, upload.fingerprint)
+
+        db.session.commit()
+
+        if upload.duplicate_of is None:
+            # Authors, years and venues of the references, for questions answered without the LLM
+            self.rag_system.citation_metadata.build(new_document, upload.text_content, citation_docs)
+
+        # Index chunks of the document and its citations for retrieval
+        for indexed_document in [new_document] + citation_docs:
+            self.document_manager.index_document_text(indexed_document)
+            self.rag_system.index_document(indexed_document)
+        db.session.commit()
+
+        logger.info(f"Document stored in database with ID: {new_document.id}")
+        return new_document
@@ -0,0 +1,232 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from langchain.prompts import ChatPromptTemplate
+from langchain.chains import LLMChain
+from models import Document
+from llm_scheduler import llm_scheduler, LLMBusyError, INTERACTIVE
+from passage_extractor import extract_passages, query_terms
+from rag_system import estimate_tokens, LLM_HOST
+from resilient_http import http_client
+from config import (RETRIEVAL_BACKEND, LIBRARY_MAX_DOCUMENTS, LIBRARY_MAP_CONCURRENCY,
+                    LIBRARY_TOKEN_BUDGET, LIBRARY_DEADLINE_S)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Tokens reserved for the instructions and the extracted evidence of each map call
+MAP_RESERVED_TOKENS = 600
+
+NO_EVIDENCE = "NONE"
+
+MAP_PROMPT = """You are reading one research paper from a user's library to help answer their question.
+Extract the facts, findings and definitions from the excerpts below that help answer the question.
+Quote numbers and key phrases exactly. Keep it under 150 words.
+If the excerpts contain nothing relevant, reply with exactly: NONE
+
+PAPER: {title}
+
+EXCERPTS:
+{excerpts}
+
+QUESTION: {query}"""
+
+REDUCE_PROMPT = """You are a renowned professor answering a question across a library of research papers.
+Below is the evidence extracted from each relevant paper, labelled [1], [2], ...
+
+When answering:
+- Synthesize the evidence into one answer, comparing papers where they agree or differ.
+- Attribute every claim to its paper with the label, e.g. "[2]".
+- If the evidence does not answer the question, say: "I don't have enough information in the provided documents to answer this question."
+- Do not use external knowledge or make up information.
+
+EVIDENCE:
+{evidence}
+
+USER QUESTION:
+{query}"""
+
+
+class LibraryQA:
+    """
+    Answers questions across all of a user's papers with a parallel map-reduce.
+
+    Candidates are preselected with the retrieval index, evidence is extracted
+    from each candidate concurrently within a shared token budget and deadline,
+    and a single reduce call writes the answer with per-paper attributions.
+    """
+
+    def __init__(self, rag_system):
+        self.rag_system = rag_system
+        self.document_manager = rag_system.document_manager
+        self.executor = ThreadPoolExecutor(max_workers=LIBRARY_MAP_CONCURRENCY, thread_name_prefix="library-map")
+
+    def answer(self, query, user_id):
+        """
+        Answer a question from the user's whole library
+
+        Returns:
+            str: The answer followed by the list of papers it draws on
+
+        Raises:
+            LLMBusyError: When no evidence extraction or the reduce call is admitted
+        """
+        if not self.rag_system.llm:
+            return "Library questions need the LLM, which is not available right now."
+
+        started = time.monotonic()
+        candidates = self._select_candidates(query, user_id)
+        if not candidates:
+            return "I couldn't find any relevant information in your documents to answer this question."
+
+        evidence, busy_error = self._map(query, user_id, candidates, started)
+        current_app.logger.info(
+            f"Library question: {len(candidates)} candidates, {len(evidence)} with evidence "
+            f"in {time.monotonic() - started:.1f}s")
+        if not evidence:
+            if busy_error is not None:
+                raise busy_error
+            return "I don't have enough information in the provided documents to answer this question."
+        return self._reduce(query, user_id, evidence)
+
+    def _select_candidates(self, query, user_id):
+        """
+        Pick the papers most likely to answer the question, without reading the whole library
+
+        Returns:
+            list: (Document, excerpts or None) pairs, best first; excerpts come from the index when it has them
+        """
+        documents = {doc.id: doc for doc in Document.query.filter_by(
+            user_id=user_id, parent_document_id=None).all()}
+        if not documents:
+            return []
+
+        # Full-text index: one ranked query over all chunks
+        if RETRIEVAL_BACKEND == 'postgres':
+            results = self.document_manager.fulltext_search.search(
+                query, user_id, top=LIBRARY_MAX_DOCUMENTS * 2)
+            candidates = [(documents[result["document_id"]], result["content"]) for result in results
+                          if result["document_id"] in documents]
+            return candidates[:LIBRARY_MAX_DOCUMENTS]
+
+        # Embedding index: best chunks across the documents that have vectors
+        if self.rag_system.embedding_client.available:
+            indexed = [doc_id for doc_id in documents if self.rag_system.vector_store.has(doc_id)]
+            query_vector = self.rag_system.embedding_client.embed_query(query) if indexed else None
+            if query_vector is not None:
+                grouped = {}
+                for doc_id, chunk, _ in self.rag_system.vector_store.search(
+                        indexed, query_vector, top_k=LIBRARY_MAX_DOCUMENTS * 3):
+                    grouped.setdefault(doc_id, []).append(chunk)
+                if grouped:
+                    return [(documents[doc_id], "\n\n".join(chunks))
+                            for doc_id, chunks in list(grouped.items())[:LIBRARY_MAX_DOCUMENTS]]
+
+        # No index: rank by query terms in the title and first page (one ranged read per paper, in parallel)
+        app = current_app._get_current_object()
+        terms = query_terms(query)
+        first_pages = self.executor.map(lambda document: self._first_page(app, document), documents.values())
+        scored = []
+        for document, first_page in zip(documents.values(), first_pages):
+            title = (document.title or "").lower()
+            score = sum(3 * title.count(term) + first_page.count(term) for term in terms)
+            if score:
+                scored.append((score, document))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [(document, None) for _, document in scored[:LIBRARY_MAX_DOCUMENTS]]
+
+    def _first_page(self, app, document):
+        with app.app_context():
+            try:
+                return " ".join(self.document_manager.get_document_pages(document, [1])).lower()
+            except Exception as e:
+                logger.error(f"Error reading first page of document {document.id}: {e}")
+                return ""
+
+    def _map(self, query, user_id, candidates, started):
+        """
+        Extract evidence from every candidate in parallel
+
+        Returns:
+            tuple: (list of (Document, evidence) in candidate order, last LLMBusyError or None)
+        """
+        app = current_app._get_current_object()
+        document_tokens = max(500, LIBRARY_TOKEN_BUDGET // len(candidates) - MAP_RESERVED_TOKENS)
+        # Absolute, so tasks that only start once the executor frees up still stop at the request's deadline
+        deadline = started + LIBRARY_DEADLINE_S
+
+        futures = [self.executor.submit(self._extract_evidence, app, query, user_id, document,
+                                        excerpts, document_tokens, deadline)
+                   for document, excerpts in candidates]
+        done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            current_app.logger.warning(f"Dropped {len(not_done)} evidence extractions past the deadline")
+
+        evidence = []
+        busy_error = None
+        for (document, _), future in zip(candidates, futures):
+            if future not in done:
+                continue
+            try:
+                text = future.result()
+            except LLMBusyError as e:
+                busy_error = e
+                continue
+            if text:
+                evidence.append((document, text))
+        return evidence, busy_error
+
+    def _extract_evidence(self, app, query, user_id, document, excerpts, document_tokens, deadline):
+        """
+        Map step for one paper
+
+        Args:
+            deadline (float): time.monotonic() by which the answer is due; past it the paper is skipped
+
+        Returns:
+            str: The evidence text, or None when the paper has nothing relevant or the deadline has passed
+        """
+        if time.monotonic() >= deadline:
+            return None
+        with app.app_context():
+            try:
+                budget_chars = document_tokens * 4
+                if excerpts is None:
+                    excerpts = self.document_manager.get_document_text(document)
+                excerpts = extract_passages(excerpts, query, budget=budget_chars)[:budget_chars]
+                if not excerpts.strip():
+                    return None
+
+                chain = LLMChain(llm=self.rag_system.llm, prompt=ChatPromptTemplate.from_template(MAP_PROMPT))
+                cost = estimate_tokens(excerpts) + MAP_RESERVED_TOKENS
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                with llm_scheduler.slot(user_id, priority=INTERACTIVE, cost=cost, deadline=remaining), \
+                        http_client.guard(LLM_HOST):
+                    response = chain.invoke({"title": document.title, "excerpts": excerpts, "query": query})
+
+                text = response['text'].strip()
+                if not text or text.upper().startswith(NO_EVIDENCE):
+                    return None
+                return text
+            except LLMBusyError:
+                raise
+            except Exception as e:
+                logger.error(f"Error extracting evidence from document {document.id}: {e}")
+                return None
+
+    def _reduce(self, query, user_id, evidence):
+        """Synthesize the answer from the per-paper evidence and list the papers it cites"""
+        evidence_text = "\n\n".join(
+            f"[{i}] {document.title}\n{text}" for i, (document, text) in enumerate(evidence, start=1))
+        sources = "\n".join(f"[{i}] {document.title}" for i, (document, _) in enumerate(evidence, start=1))
+
+        chain = LLMChain(llm=self.rag_system.llm, prompt=ChatPromptTemplate.from_template(REDUCE_PROMPT))
+        cost = estimate_tokens(evidence_text) + MAP_RESERVED_TOKENS
+        with llm_scheduler.slot(user_id, priority=INTERACTIVE, cost=cost), http_client.guard(LLM_HOST):
+            response = chain.invoke({"evidence": evidence_text, "query": query})
+        return f"{response['text']}\n\nSources:\n{sources}"
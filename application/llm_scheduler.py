@@ -0,0 +1,312 @@
+"""
+Admission control for LLM calls, shared by every worker process and instance.
+
+The concurrency slots and the per-user token buckets live in PostgreSQL,
+so LLM_MAX_CONCURRENCY and the quotas hold for the whole deployment rather
+than per gunicorn worker. A slot is a lease row, claimed under a
+transaction-level advisory lock and expiring after LLM_SLOT_LEASE_S in case
+its worker dies mid-call. LLM_INTERACTIVE_RESERVED_SLOTS slots are never
+given to background ingestion, so chat is not starved by uploads running in
+other workers. Within a worker, waiters queue by priority and deadline and
+only the head of the queue polls for a free slot. Without PostgreSQL (local
+development) the same limits are applied per process.
+"""
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import text
+from config import (LLM_MAX_CONCURRENCY, LLM_INTERACTIVE_RESERVED_SLOTS, LLM_SLOT_LEASE_S, LLM_MAX_QUEUE,
+                    LLM_USER_TOKENS_PER_MINUTE, LLM_USER_BURST_TOKENS, LLM_INTERACTIVE_DEADLINE_S,
+                    LLM_BACKGROUND_DEADLINE_S)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DEFAULT_DEADLINES = {
+    INTERACTIVE: LLM_INTERACTIVE_DEADLINE_S,
+    BACKGROUND: LLM_BACKGROUND_DEADLINE_S,
+}
+
+# The head of a worker's queue checks for a slot freed by another process this often (doubling up to the max)
+POLL_MIN_S = 0.05
+POLL_MAX_S = 0.5
+
+# Serializes slot claims across processes (pg_advisory_xact_lock key)
+SLOT_LOCK_KEY = 0x6c6c6d736c6f74
+
+TAKE_QUOTA_SQL = text("""
+    INSERT INTO llm_quota AS q (user_id, priority, tokens, updated_at)
+    VALUES (:user_id, :priority, :capacity - :cost, now())
+    ON CONFLICT (user_id, priority) DO UPDATE SET
+        tokens = LEAST(:capacity, q.tokens + EXTRACT(EPOCH FROM now() - q.updated_at) * :rate) - :cost,
+        updated_at = now()
+    WHERE LEAST(:capacity, q.tokens + EXTRACT(EPOCH FROM now() - q.updated_at) * :rate) >= :cost
+    RETURNING tokens
+""")
+QUOTA_TOKENS_SQL = text("""
+    SELECT LEAST(:capacity, tokens + EXTRACT(EPOCH FROM now() - updated_at) * :rate)
+    FROM llm_quota WHERE user_id = :user_id AND priority = :priority
+""")
+CLAIM_SLOT_SQL = text("""
+    INSERT INTO llm_lease (priority, owner, expires_at)
+    SELECT :priority, :owner, now() + make_interval(secs => :lease_s)
+    FROM (SELECT count(*) AS held, count(*) FILTER (WHERE priority <> :interactive) AS background
+          FROM llm_lease WHERE expires_at > now()) AS leases
+    WHERE leases.held < :max_concurrency AND (:priority = :interactive OR leases.background < :background_slots)
+    RETURNING id
+""")
+
+
+class LLMBusyError(Exception):
+    """Raised when an LLM call is not admitted; retry_after is in seconds"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(f"LLM busy ({reason}), retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    """Per-user quota of LLM tokens, refilled continuously"""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost):
+        """Take cost tokens; returns 0 on success or the seconds until they are available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.refill_per_second
+
+
+class _Waiter:
+    def __init__(self, priority, deadline, sequence):
+        self.priority = priority
+        self.deadline = deadline
+        self.sequence = sequence
+        self.event = threading.Event()
+        self.shed = False
+
+    def __lt__(self, other):
+        return (self.priority, self.deadline, self.sequence) < (other.priority, other.deadline, other.sequence)
+
+
+class LLMScheduler:
+    """
+    Admission control for LLM calls.
+
+    Calls run in the caller's thread once a slot is granted. Slots go to
+    interactive chat before background ingestion, each user draws from a
+    token bucket per priority class, the wait queue is bounded and waiters
+    whose deadline has passed are shed instead of being run late.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 tokens_per_minute=LLM_USER_TOKENS_PER_MINUTE, burst_tokens=LLM_USER_BURST_TOKENS,
+                 reserved_slots=LLM_INTERACTIVE_RESERVED_SLOTS, lease_s=LLM_SLOT_LEASE_S):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_tokens = burst_tokens
+        self.background_slots = max(1, max_concurrency - reserved_slots)
+        self.lease_s = lease_s
+        self._engine = None
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._buckets = {}
+        self._running = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._avg_call_seconds = 5.0
+        self.stats = {"admitted": 0, "rejected_quota": 0, "rejected_queue": 0, "shed": 0, "shared_errors": 0}
+
+    def init_app(self, app, db):
+        """Share slots and quotas through the app's database, if it is PostgreSQL"""
+        engine = db.engines[None]
+        if engine.dialect.name == 'postgresql':
+            self._engine = engine
+        else:
+            logger.warning("LLM slots and quotas are per worker process without PostgreSQL")
+
+    @contextmanager
+    def slot(self, user_id, priority=INTERACTIVE, cost=1, deadline=None):
+        """
+        Hold an LLM slot for the duration of the block
+
+        Args:
+            user_id (int): User charged for the call
+            priority (int): INTERACTIVE or BACKGROUND
+            cost (int): Estimated tokens of the call, charged to the user's bucket
+            deadline (float): Seconds the caller is willing to wait for a slot
+
+        Raises:
+            LLMBusyError: When the quota, the queue or the deadline does not allow the call
+        """
+        if deadline is None:
+            deadline = DEFAULT_DEADLINES[priority]
+        elif deadline <= 0:
+            with self._lock:
+                self.stats["shed"] += 1
+            raise LLMBusyError(self._estimated_wait(), "deadline already passed")
+        deadline = time.monotonic() + deadline
+        lease_id = self._acquire(user_id, priority, cost, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(priority, lease_id, time.monotonic() - started)
+
+    def _acquire(self, user_id, priority, cost, deadline):
+        """Wait for a slot; returns the id of its lease row (None for a per-process slot)"""
+        wait = self._take_quota(user_id or 0, priority, min(cost, self.burst_tokens))
+        if wait:
+            with self._lock:
+                self.stats["rejected_quota"] += 1
+            raise LLMBusyError(max(1, round(wait)), "user quota exceeded")
+
+        waiter = _Waiter(priority, deadline, next(self._sequence))
+        with self._lock:
+            if len(self._waiters) >= self.max_queue:
+                # Make room by shedding the least urgent waiter if the new one outranks it
+                worst = max(self._waiters)
+                if not waiter < worst:
+                    self.stats["rejected_queue"] += 1
+                    raise LLMBusyError(self._estimated_wait(), "queue full")
+                self._waiters.remove(worst)
+                heapq.heapify(self._waiters)
+                worst.shed = True
+                worst.event.set()
+                self.stats["shed"] += 1
+            heapq.heappush(self._waiters, waiter)
+
+        poll = POLL_MIN_S
+        try:
+            while True:
+                with self._lock:
+                    if waiter.shed:
+                        raise LLMBusyError(self._estimated_wait(), "shed for higher priority work")
+                    at_head = self._waiters[0] is waiter
+                if at_head:
+                    admitted, lease_id = self._claim_slot(priority)
+                    if admitted:
+                        with self._lock:
+                            self._running[priority] += 1
+                            self.stats["admitted"] += 1
+                        return lease_id
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self.stats["shed"] += 1
+                    raise LLMBusyError(self._estimated_wait(), "deadline exceeded while queued")
+                # Woken early when a call in this process ends or the waiter ahead leaves the queue
+                if waiter.event.wait(min(remaining, poll)):
+                    waiter.event.clear()
+                else:
+                    poll = min(poll * 2, POLL_MAX_S)
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                self._wake_head()
+
+    def _release(self, priority, lease_id, call_seconds):
+        if lease_id is not None:
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(text("DELETE FROM llm_lease WHERE id = :id"), {"id": lease_id})
+            except Exception as e:
+                # The lease expires on its own after lease_s
+                logger.error(f"Error releasing LLM slot {lease_id}: {e}")
+                self.stats["shared_errors"] += 1
+        with self._lock:
+            self._avg_call_seconds = 0.8 * self._avg_call_seconds + 0.2 * call_seconds
+            self._running[priority] -= 1
+            self._wake_head()
+
+    def _wake_head(self):
+        if self._waiters:
+            self._waiters[0].event.set()
+
+    def _take_quota(self, user_id, priority, cost):
+        """Take cost tokens from the user's bucket; returns 0 on success or the seconds until they are available"""
+        if self._engine is not None:
+            params = {"user_id": user_id, "priority": priority, "cost": cost, "capacity": self.burst_tokens,
+                      "rate": self.tokens_per_minute / 60.0}
+            try:
+                with self._engine.begin() as connection:
+                    if connection.execute(TAKE_QUOTA_SQL, params).first() is not None:
+                        return 0
+                    tokens = connection.execute(QUOTA_TOKENS_SQL, params).scalar() or 0
+                return max(0, cost - tokens) / params["rate"]
+            except Exception as e:
+                logger.error(f"Error taking shared LLM quota, using this worker's: {e}")
+                self.stats["shared_errors"] += 1
+        with self._lock:
+            bucket = self._buckets.get((user_id, priority))
+            if bucket is None:
+                bucket = TokenBucket(self.burst_tokens, self.tokens_per_minute / 60.0)
+                self._buckets[(user_id, priority)] = bucket
+            return bucket.take(cost)
+
+    def _claim_slot(self, priority):
+        """
+        Returns:
+            tuple: (whether a slot was granted, id of its lease row or None for a per-process slot)
+        """
+        if self._engine is not None:
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SLOT_LOCK_KEY})
+                    connection.execute(text("DELETE FROM llm_lease WHERE expires_at <= now()"))
+                    lease_id = connection.execute(CLAIM_SLOT_SQL, {
+                        "priority": priority, "owner": f"{socket.gethostname()}:{os.getpid()}",
+                        "lease_s": self.lease_s, "interactive": INTERACTIVE,
+                        "max_concurrency": self.max_concurrency, "background_slots": self.background_slots,
+                    }).scalar()
+                return lease_id is not None, lease_id
+            except Exception as e:
+                logger.error(f"Error claiming shared LLM slot, using this worker's: {e}")
+                self.stats["shared_errors"] += 1
+        with self._lock:
+            running = sum(self._running.values())
+            admitted = running < self.max_concurrency and (
+                priority == INTERACTIVE or self._running[BACKGROUND] < self.background_slots)
+        return admitted, None
+
+    def _estimated_wait(self):
+        """Seconds until a queued call would likely run, for Retry-After"""
+        return max(1, round(self._avg_call_seconds * (len(self._waiters) + 1) / self.max_concurrency))
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {"shared": self._engine is not None, "running": sum(self._running.values()),
+                        "queued": len(self._waiters), **self.stats}
+        if self._engine is not None:
+            try:
+                with self._engine.connect() as connection:
+                    snapshot["running_everywhere"] = connection.execute(
+                        text("SELECT count(*) FROM llm_lease WHERE expires_at > now()")).scalar()
+            except Exception as e:
+                logger.error(f"Error counting LLM slots in use: {e}")
+        return snapshot
+
+
+# One scheduler per worker process; slots and quotas are shared through the database
+llm_scheduler = LLMScheduler()
@@ -1,6 +1,7 @@
 from datetime import datetime
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from app import db
 
 class User(UserMixin, db.Model):
@@ -35,6 +36,10 @@ class Document(db.Model):
     # Relationships
     chat_sessions = db.relationship('ChatSession', backref='document', lazy='dynamic')
     citations = db.relationship('Document', backref=db.backref('parent_document', remote_side=[id]), lazy='dynamic')
+    citation_contexts = db.relationship('CitationContext', foreign_keys='CitationContext.document_id', backref='document', lazy='dynamic', cascade='all, delete-orphan')
+    fingerprint = db.relationship('DocumentFingerprint', backref='document', uselist=False, cascade='all, delete-orphan')
+    chunks = db.relationship('DocumentChunk', backref='document', lazy='dynamic', cascade='all, delete-orphan')
+    cited_papers = db.relationship('CitationMetadata', foreign_keys='CitationMetadata.document_id', backref='document', lazy='dynamic', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Document {self.title}>'
@@ -45,19 +50,198 @@ class ChatSession(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    last_message_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    archived_at = db.Column(db.DateTime, nullable=True)  # messages moved to blob storage (see chat_archive)
     
-    # Relationships
-    messages = db.relationship('ChatMessage', backref='session', lazy='dynamic', cascade='all, delete-orphan')
+    # Relationships; messages are deleted by the database, see ChatArchiver.delete_session
+    messages = db.relationship('ChatMessage', backref='session', lazy='dynamic', passive_deletes=True)
     
     def __repr__(self):
         return f'<ChatSession {self.title}>'
 
 class ChatMessage(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    # Range-partitioned by month on timestamp, which must therefore be part of the primary key.
+    # Filter on timestamp (e.g. >= ChatSession.created_at) so queries only touch recent partitions
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     content = db.Column(db.Text, nullable=False)
     is_user = db.Column(db.Boolean, default=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id', ondelete='CASCADE'), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_chat_message_session_timestamp', 'session_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'}
+    )
     
     def __repr__(self):
         return f'<ChatMessage {self.id}>'
+
+class CitationContext(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    cited_document_id = db.Column(db.Integer, db.ForeignKey('document.id', ondelete='SET NULL'), nullable=True, index=True)
+    marker = db.Column(db.String(100), nullable=False)
+    reference_label = db.Column(db.String(100), nullable=False, index=True)
+    reference_text = db.Column(db.Text, nullable=True)
+    sentence = db.Column(db.Text, nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<CitationContext {self.marker} in {self.document_id}>'
+
+class CitationMetadata(db.Model):
+    # One row per entry of a document's reference list, from Semantic Scholar (see citation_metadata)
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    cited_document_id = db.Column(db.Integer, db.ForeignKey('document.id', ondelete='SET NULL'), nullable=True, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    paper_id = db.Column(db.String(64), nullable=True)
+    title = db.Column(db.String(500), nullable=False)
+    authors = db.Column(db.JSON, nullable=True)  # list of names
+    year = db.Column(db.Integer, nullable=True)
+    venue = db.Column(db.String(300), nullable=True)
+    doi = db.Column(db.String(200), nullable=True)
+    citation_count = db.Column(db.Integer, nullable=True)
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_citation_metadata_document_year', 'document_id', 'year'),)
+    
+    def __repr__(self):
+        return f'<CitationMetadata {self.title} in {self.document_id}>'
+
+class DocumentFingerprint(db.Model):
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    signature = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    lsh_buckets = db.relationship('LshBucket', backref='fingerprint', lazy='dynamic', cascade='all, delete-orphan')
+    
+    def __repr__(self):
+        return f'<DocumentFingerprint {self.document_id}>'
+
+class LshBucket(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    band = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.String(16), nullable=False)
+    document_id = db.Column(db.Integer, db.ForeignKey('document_fingerprint.document_id'), nullable=False, index=True)
+    
+    __table_args__ = (db.Index('ix_lsh_bucket_band_bucket', 'band', 'bucket'),)
+    
+    def __repr__(self):
+        return f'<LshBucket {self.band}:{self.bucket}>'
+
+class ResolvedPaper(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(500), nullable=False)
+    normalized_title = db.Column(db.String(500), nullable=False, index=True)
+    doi = db.Column(db.String(200), nullable=True, index=True)
+    paper_id = db.Column(db.String(64), nullable=True, unique=True)
+    open_access_pdf = db.Column(db.String(1000), nullable=True)
+    resolved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ResolvedPaper {self.title}>'
+
+class DocumentChunk(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    generation = db.Column(db.Integer, nullable=False, default=0, index=True)
+    search_vector = db.Column(TSVECTOR, db.Computed("to_tsvector('english', content)", persisted=True))
+    
+    __table_args__ = (db.Index('ix_document_chunk_search_vector', 'search_vector', postgresql_using='gin'),)
+    
+    def __repr__(self):
+        return f'<DocumentChunk {self.document_id}:{self.chunk_index}>'
+
+class IndexGeneration(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    pipeline_version = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='building', index=True)  # building, active, retired
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    activated_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<IndexGeneration {self.id} {self.status}>'
+
+class ReindexJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    pipeline_version = db.Column(db.Integer, nullable=False)
+    generation = db.Column(db.Integer, nullable=False)
+    switch_on_completion = db.Column(db.Boolean, default=False)
+    filters = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    last_document_id = db.Column(db.Integer, nullable=False, default=0)  # keyset checkpoint
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    failed_ids = db.Column(db.Text, nullable=False, default='[]')  # JSON; retried when the job runs again
+    status = db.Column(db.String(20), nullable=False, default='running', index=True)  # running, incomplete, completed
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ReindexJob {self.id} {self.status}>'
+
+class DocumentIndexState(db.Model):
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id', ondelete='CASCADE'), primary_key=True)
+    pipeline_version = db.Column(db.Integer, nullable=False)
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DocumentIndexState {self.document_id} v{self.pipeline_version}>'
+
+class LlmQuota(db.Model):
+    """A user's LLM token bucket for one priority class, shared by every worker process"""
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    priority = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<LlmQuota {self.user_id}/{self.priority} {self.tokens:.0f}>'
+
+class LlmLease(db.Model):
+    """One of the LLM_MAX_CONCURRENCY slots, held by an LLM call in some worker process"""
+    id = db.Column(db.Integer, primary_key=True)
+    priority = db.Column(db.Integer, nullable=False)
+    owner = db.Column(db.String(100), nullable=False)  # host:pid, for the admin page
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # freed after this if the worker died
+    
+    def __repr__(self):
+        return f'<LlmLease {self.id} {self.owner}>'
+
+class ImportJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='resolving')  # resolving, importing, completed, failed
+    with_citations = db.Column(db.Boolean, default=False)  # also extract and crawl each paper's citations
+    total = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500), nullable=True)
+    directory = db.Column(db.String(500), nullable=True)  # unpacked upload, on the owner's host
+    owner = db.Column(db.String(100), nullable=True)  # host:pid of the process running the import
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # refreshed while it runs; stale jobs are resumed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    items = db.relationship('ImportItem', backref='job', lazy='dynamic', cascade='all, delete-orphan')
+    
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.status}>'
+
+class ImportItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('import_job.id'), nullable=False, index=True)
+    title = db.Column(db.String(500), nullable=False)
+    doi = db.Column(db.String(200), nullable=True)
+    filename = db.Column(db.String(300), nullable=True)  # PDF from the uploaded zip, if any
+    pdf_url = db.Column(db.String(1000), nullable=True)  # open-access PDF found by metadata resolution
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, imported, failed
+    error = db.Column(db.String(500), nullable=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id', ondelete='SET NULL'), nullable=True)
+    
+    def __repr__(self):
+        return f'<ImportItem {self.id} {self.status}>'
@@ -0,0 +1,225 @@
+"""
+OCR fallback for PDF pages without a text layer.
+
+Only pages whose extracted text is (nearly) empty and that hold an image are
+OCR'd, each in a process of a per-worker pool, within per-document page and
+time budgets. Results are cached by a hash of the page's embedded images,
+locally and in blob storage, so uploading the same scan again costs no OCR.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import fitz
+from azure.core.exceptions import ResourceNotFoundError
+from config import (OCR_ENABLED, OCR_WORKERS, OCR_MAX_PAGES, OCR_TIMEOUT_S, OCR_MIN_CHARS, OCR_LANGUAGE, OCR_DPI,
+                    OCR_CACHE_DIR, OCR_BLOB_PREFIX)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+
+def _ocr_page(path, page_number, language, dpi, tessdata):
+    """Render and OCR one page (runs in a pool process)"""
+    with fitz.open(path) as pdf_document:
+        page = pdf_document[page_number]
+        text_page = page.get_textpage_ocr(language=language, dpi=dpi, full=True, tessdata=tessdata)
+        return page.get_text("text", textpage=text_page)
+
+
+class PageOcr:
+    """Fills in the text of image-only pages of a PDF"""
+
+    def __init__(self, container_client=None, enabled=OCR_ENABLED, workers=OCR_WORKERS, max_pages=OCR_MAX_PAGES,
+                 timeout_s=OCR_TIMEOUT_S, min_chars=OCR_MIN_CHARS, language=OCR_LANGUAGE, dpi=OCR_DPI,
+                 cache_dir=OCR_CACHE_DIR):
+        self.container_client = container_client
+        self.language = language
+        # Checked once, so a host without Tesseract skips OCR instead of failing on every scanned page
+        self.tessdata = self._find_tessdata() if enabled else None
+        self.enabled = self.tessdata is not None
+        self.workers = workers
+        self.max_pages = max_pages
+        self.timeout_s = timeout_s
+        self.min_chars = min_chars
+        self.dpi = dpi
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def fill_missing(self, pdf_data, pages):
+        """
+        OCR the pages of a PDF that have no text layer
+
+        Args:
+            pdf_data (bytes): The PDF
+            pages (list): Text extracted from each page
+
+        Returns:
+            list: The pages, with OCR text in place of the image-only ones
+        """
+        if not self.enabled:
+            return pages
+        pages = list(pages)
+        try:
+            with fitz.open(stream=pdf_data, filetype="pdf") as pdf_document:
+                candidates = {}
+                for number, page in enumerate(pdf_document):
+                    if len(pages[number].strip()) >= self.min_chars:
+                        continue
+                    key = self._page_key(pdf_document, page)
+                    if key is not None:
+                        candidates[number] = key
+        except Exception as e:
+            logger.error(f"Error finding pages to OCR: {e}")
+            return pages
+        if not candidates:
+            return pages
+
+        # Pages showing the same images (repeated cover sheets, blank scans) are OCR'd once
+        missing = {}
+        cached = 0
+        for number, key in candidates.items():
+            text = self._cached(key) if key not in missing else None
+            if text is None:
+                missing.setdefault(key, []).append(number)
+            else:
+                pages[number] = text
+                cached += 1
+        self.stats["cache_hits"] += cached
+
+        if len(missing) > self.max_pages:
+            logger.warning(f"OCR budget: {len(missing)} pages to OCR, OCR'ing the first {self.max_pages}")
+            self.stats["pages_over_budget"] += len(missing) - self.max_pages
+            missing = dict(list(missing.items())[:self.max_pages])
+        ocr_texts = self._ocr(pdf_data, [numbers[0] for numbers in missing.values()]) if missing else {}
+        for key, numbers in missing.items():
+            if numbers[0] in ocr_texts:
+                self._store(key, ocr_texts[numbers[0]])
+                for number in numbers:
+                    pages[number] = ocr_texts[numbers[0]]
+        logger.info(f"OCR: {len(candidates)} image-only pages, {cached} from cache, {len(ocr_texts)} OCR'd")
+        return pages
+
+    def snapshot(self):
+        return {"enabled": self.enabled, "tessdata": self.tessdata, "workers": self.workers, **self.stats}
+
+    def _find_tessdata(self):
+        """Tesseract's language data directory, or None (OCR off) if it or a language is missing"""
+        try:
+            tessdata = fitz.get_tessdata()
+        except Exception as e:
+            logger.warning(f"OCR is off: {e}")
+            return None
+        missing = [language for language in self.language.split('+')
+                   if not os.path.exists(os.path.join(tessdata, f"{language}.traineddata"))]
+        if missing:
+            logger.warning(f"OCR is off: no Tesseract data for {', '.join(missing)} in {tessdata}")
+            return None
+        return tessdata
+
+    def _page_key(self, pdf_document, page):
+        """Hash of a page's embedded images and the OCR settings, or None for a page without images"""
+        images = page.get_images(full=True)
+        if not images:
+            return None
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{self.language}|{self.dpi}|{page.rotation}".encode())
+        for image in images:
+            digest.update(pdf_document.xref_stream_raw(image[0]) or b"")
+        return digest.hexdigest()
+
+    def _ocr(self, pdf_data, page_numbers):
+        """OCR pages in the pool within the time budget; pages not done in time are left out"""
+        texts = {}
+        # Pool processes open the PDF from a file rather than receiving it with every page
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            pdf_file.write(pdf_data)
+            pdf_file.flush()
+            pool = self._get_pool()
+            futures = {pool.submit(_ocr_page, pdf_file.name, number, self.language, self.dpi, self.tessdata): number
+                       for number in page_numbers}
+            done, not_done = wait(futures, timeout=self.timeout_s)
+            if not_done:
+                logger.warning(f"OCR budget: {len(not_done)} pages not done within {self.timeout_s}s")
+                self.stats["pages_timed_out"] += len(not_done)
+                # cancel() can't stop a page that is being OCR'd, so the pool's processes are killed. Pages
+                # of other documents OCR'd in this worker at the same time fail with it and stay empty.
+                self._reset_pool(pool, kill=True)
+            for future in done:
+                try:
+                    texts[futures[future]] = future.result()
+                    self.stats["pages_ocred"] += 1
+                except BrokenProcessPool as e:
+                    logger.error(f"Error OCR'ing page {futures[future] + 1}: {e}")
+                    self.stats["pages_failed"] += 1
+                    self._reset_pool(pool)
+                except Exception as e:
+                    logger.error(f"Error OCR'ing page {futures[future] + 1}: {e}")
+                    self.stats["pages_failed"] += 1
+        return texts
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned, not forked: the web worker has threads and open connections
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _reset_pool(self, pool, kill=False):
+        # A pool that lost a process (e.g. killed for memory) fails every later task; the next document gets a new one
+        with self._lock:
+            if self._pool is not pool:
+                return  # already replaced after another document's failure
+            self._pool = None
+        processes = list((pool._processes or {}).values()) if kill else []
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+
+    def _cached(self, key):
+        local_path = self._cache_path(key)
+        if os.path.exists(local_path):
+            with open(local_path, encoding='utf-8') as f:
+                return f.read()
+        if self.container_client is None:
+            return None
+        try:
+            text = self.container_client.get_blob_client(f"{OCR_BLOB_PREFIX}{key}.txt") \
+                .download_blob().readall().decode('utf-8')
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading cached OCR text {key}: {e}")
+            return None
+        self._write_local(key, text)
+        return text
+
+    def _store(self, key, text):
+        self._write_local(key, text)
+        if self.container_client is None:
+            return
+        try:
+            self.container_client.get_blob_client(f"{OCR_BLOB_PREFIX}{key}.txt").upload_blob(
+                text.encode('utf-8'), overwrite=True)
+        except Exception as e:
+            logger.error(f"Error caching OCR text {key}: {e}")
+
+    def _write_local(self, key, text):
+        local_path = self._cache_path(key)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(f"{local_path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(f"{local_path}.tmp", local_path)
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
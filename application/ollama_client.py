@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+from cache import LRUCache
+from resilient_http import http_client
+from config import (OLLAMA_URL, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX, OLLAMA_SESSION_CACHE_SIZE,
+                    LLM_REQUEST_TIMEOUT_S)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# First turn of every pinned session; the model reads the prefix and acknowledges it
+PRIME_PROMPT = "Reply with OK once you have read the primary document."
+
+
+class OllamaSessionClient:
+    """
+    Ollama client that keeps a context handle per document prompt prefix.
+
+    The prefix (instructions plus primary document) is prefilled once and its
+    token context is kept; each question is sent with that context, so with
+    keep_alive holding the model in memory only the question is prefilled.
+    Prefill tokens saved are computed from Ollama's own counts.
+    """
+
+    def __init__(self, base_url=OLLAMA_URL, model=OLLAMA_MODEL):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.handles = LRUCache(max_entries=OLLAMA_SESSION_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self.stats = {"turns": 0, "primes": 0, "prompt_tokens": 0, "prefill_tokens": 0, "prefill_tokens_saved": 0}
+
+    def generate(self, prompt, prompt_prefix, document_id=None):
+        """
+        Answer a prompt after the given prefix
+
+        Args:
+            prompt (str): The per-question part of the prompt
+            prompt_prefix (str): The static system prefix
+            document_id (int, optional): Pins the prefix's context handle to this document
+
+        Returns:
+            str: The model's response
+        """
+        if document_id is None:
+            return self._generate({"system": prompt_prefix, "prompt": prompt})["response"]
+
+        context = self._context_handle(document_id, prompt_prefix)
+        result = self._generate({"prompt": prompt, "context": context})
+
+        # The returned context is the full prompt plus the response, so the prompt length is exact
+        prompt_tokens = len(result.get("context", [])) - result.get("eval_count", 0)
+        prefill_tokens = result.get("prompt_eval_count", prompt_tokens)
+        saved = max(0, prompt_tokens - prefill_tokens)
+        with self._lock:
+            self.stats["turns"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["prefill_tokens"] += prefill_tokens
+            self.stats["prefill_tokens_saved"] += saved
+        logger.info(f"Ollama turn for document {document_id}: prefilled {prefill_tokens} of "
+                    f"{prompt_tokens} prompt tokens ({saved} reused)")
+        return result["response"]
+
+    def snapshot(self):
+        with self._lock:
+            return {"model": self.model, "pinned_sessions": len(self.handles), **self.stats}
+
+    def _context_handle(self, document_id, prompt_prefix):
+        """Return the context tokens of a document's prefix, prefilling it on first use or after a change"""
+        prefix_hash = hashlib.blake2b(prompt_prefix.encode('utf-8'), digest_size=16).hexdigest()
+        handle = self.handles.get(document_id)
+        if handle is not None and handle["prefix_hash"] == prefix_hash:
+            return handle["context"]
+
+        result = self._generate({"system": prompt_prefix, "prompt": PRIME_PROMPT}, num_predict=2)
+        context = result.get("context", [])
+        self.handles.set(document_id, {"prefix_hash": prefix_hash, "context": context})
+        with self._lock:
+            self.stats["primes"] += 1
+            self.stats["prefill_tokens"] += result.get("prompt_eval_count", 0)
+        logger.info(f"Pinned Ollama context for document {document_id} ({len(context)} tokens)")
+        return context
+
+    def _generate(self, payload, num_predict=None):
+        options = {"num_ctx": OLLAMA_NUM_CTX}
+        if num_predict is not None:
+            options["num_predict"] = num_predict
+        response = http_client.post(
+            f"{self.base_url}/api/generate",
+            json={"model": self.model, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE,
+                  "options": options, **payload},
+            deadline=LLM_REQUEST_TIMEOUT_S
+        )
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,124 @@
+import math
+import re
+
+# Question words that say nothing about where the answer is
+STOPWORDS = {
+    'the', 'and', 'for', 'are', 'was', 'were', 'what', 'which', 'who', 'whom', 'how', 'why', 'when',
+    'where', 'does', 'did', 'this', 'that', 'these', 'those', 'with', 'from', 'into', 'about', 'paper',
+    'can', 'could', 'would', 'should', 'you', 'your', 'their', 'there', 'they', 'them', 'its', 'has',
+    'have', 'had', 'not', 'but', 'all', 'any', 'use', 'used', 'using', 'explain', 'describe', 'tell',
+}
+
+MAX_TERMS = 32
+
+
+def query_terms(query):
+    """Distinct content words of a query, longest first"""
+    terms = []
+    for word in re.findall(r'[a-z0-9]+', query.lower()):
+        if len(word) >= 3 and word not in STOPWORDS and word not in terms:
+            terms.append(word)
+    return sorted(terms, key=len, reverse=True)[:MAX_TERMS]
+
+
+def extract_passages(content, query, budget=6000, window=800, separator="\n...\n"):
+    """
+    Return the passages of content that best match the query, up to budget characters
+
+    All query terms are matched in one regex pass. Each window of `window`
+    characters starting near a match is scored by how many distinct terms it
+    covers (rarer terms weigh more), how densely they occur and how close
+    together they are. The best non-overlapping windows are returned in
+    document order.
+    """
+    if len(content) <= budget:
+        return content
+    windows = _select_windows(content, query, budget, window)
+    if not windows:
+        return content[:budget]
+    return separator.join(_trim_to_boundaries(content, start, end) for start, end in sorted(windows))
+
+
+def rank_passages(content, query, budget=6000, window=800):
+    """The passages extract_passages would select, best first instead of in document order"""
+    if len(content) <= budget:
+        return [content]
+    windows = _select_windows(content, query, budget, window)
+    if not windows:
+        return [content[:budget]]
+    return [_trim_to_boundaries(content, start, end) for start, end in windows]
+
+
+def _select_windows(content, query, budget, window):
+    """Best non-overlapping (start, end) windows up to budget characters, best first"""
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    # One capture group per term; \w* lets "cache" match "caches" and "caching". The
+    # first-letter lookahead lets the engine skip most positions without trying the alternation.
+    first_letters = re.escape(''.join(sorted({term[0] for term in terms})))
+    alternation = '|'.join(f'({re.escape(term)})' for term in terms)
+    pattern = re.compile(rf'\b(?=[{first_letters}])(?:{alternation})\w*', re.IGNORECASE)
+    hits = [(match.start(), match.lastindex - 1) for match in pattern.finditer(content)]
+    if not hits:
+        return []
+
+    frequency = [0] * len(terms)
+    for _, term in hits:
+        frequency[term] += 1
+    weights = [1.0 / math.log(2 + count) for count in frequency]
+
+    # Slide over the hits with two pointers, tracking per-term counts inside the window
+    candidates = []
+    counts = [0] * len(terms)
+    distinct_weight = 0.0
+    end = 0
+    for start_index, (start_position, _) in enumerate(hits):
+        window_start = max(0, start_position - window // 4)
+        window_end = window_start + window
+        while end < len(hits) and hits[end][0] < window_end:
+            term = hits[end][1]
+            if counts[term] == 0:
+                distinct_weight += weights[term]
+            counts[term] += 1
+            end += 1
+
+        in_window = end - start_index
+        span = hits[end - 1][0] - start_position
+        proximity = distinct_weight / (1.0 + span / 200.0)
+        score = 2.0 * distinct_weight + 0.2 * in_window + proximity
+        candidates.append((score, window_start, window_end))
+
+        term = hits[start_index][1]
+        counts[term] -= 1
+        if counts[term] == 0:
+            distinct_weight -= weights[term]
+
+    # Greedily keep the best windows that don't overlap, until the budget is spent
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    selected = []
+    used = 0
+    for _, window_start, window_end in candidates:
+        if used + (window_end - window_start) > budget:
+            if used:
+                break
+            window_end = window_start + budget
+        if any(window_start < chosen_end and chosen_start < window_end for chosen_start, chosen_end in selected):
+            continue
+        selected.append((window_start, window_end))
+        used += window_end - window_start
+    return [(window_start, min(window_end, len(content))) for window_start, window_end in selected]
+
+
+def _trim_to_boundaries(content, start, end):
+    """Move window edges to the nearest whitespace so words aren't cut in half"""
+    if start > 0:
+        space = content.find(' ', start, min(end, start + 40))
+        if space != -1:
+            start = space + 1
+    if end < len(content):
+        space = content.rfind(' ', max(start, end - 40), end)
+        if space != -1:
+            end = space
+    return content[start:end].strip()
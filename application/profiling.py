@@ -0,0 +1,245 @@
+"""
+Production-safe request profiling and memory snapshots.
+
+RequestProfiler samples the stacks of threads serving profiled requests from
+one background thread and writes them in the collapsed ("folded") format
+read by flamegraph.pl and speedscope. Nothing is sampled while no profiled
+request is running. Memory snapshots use tracemalloc, which stays off until
+an admin starts it.
+"""
+import glob
+import linecache
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+from config import (ADMIN_USERS, PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_DIR,
+                    PROFILE_MAX_FILES, TRACEMALLOC_FRAMES)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Query parameter with which admins profile a single request
+PROFILE_PARAMETER = "__profile"
+
+# Deepest stack recorded per sample
+MAX_STACK_DEPTH = 128
+
+
+class RequestProfiler:
+    """Statistical profiler for selected requests of this worker"""
+
+    def __init__(self, slow_ms=PROFILE_SLOW_MS, sample_rate=PROFILE_SAMPLE_RATE, interval_ms=PROFILE_INTERVAL_MS,
+                 output_dir=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.interval_ms = interval_ms
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = Counter()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def settings(self):
+        return {"pid": os.getpid(), "slow_ms": self.slow_ms, "sample_rate": self.sample_rate,
+                "interval_ms": self.interval_ms, "active": len(self._active), **self.stats}
+
+    def start_request(self, force=False):
+        """
+        Start sampling the current thread if this request should be profiled
+
+        Args:
+            force (bool): Profile and keep this request whatever the settings
+
+        Returns:
+            bool: Whether the request is being sampled
+        """
+        sampled = random.random() < self.sample_rate
+        if not (force or sampled or self.slow_ms > 0):
+            return False
+        with self._lock:
+            self._active[threading.get_ident()] = {
+                "stacks": Counter(),
+                "started": time.monotonic(),
+                "keep": force or sampled
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return True
+
+    def finish_request(self, label):
+        """
+        Stop sampling the current thread and save the profile if it was requested or slow
+
+        Returns:
+            str: Path of the saved profile, or None
+        """
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+        if entry is None:
+            return None
+        duration_ms = (time.monotonic() - entry["started"]) * 1000
+        if not (entry["keep"] or (self.slow_ms > 0 and duration_ms >= self.slow_ms)):
+            self.stats["discarded"] += 1
+            return None
+        if not entry["stacks"]:
+            return None
+        return self._save(label, duration_ms, entry["stacks"])
+
+    def list_profiles(self):
+        """Saved profiles of all workers, newest first"""
+        paths = sorted(glob.glob(os.path.join(self.output_dir, "*.folded")), key=os.path.getmtime, reverse=True)
+        return [{"name": os.path.basename(path), "bytes": os.path.getsize(path)} for path in paths]
+
+    def _before_request(self):
+        force = PROFILE_PARAMETER in request.args and current_user.is_authenticated \
+            and current_user.username in ADMIN_USERS
+        g._profiled = self.start_request(force=force)
+
+    def _teardown_request(self, exception=None):
+        if g.pop('_profiled', False):
+            path = self.finish_request(request.endpoint or "unknown")
+            if path:
+                logger.info(f"Saved profile of {request.method} {request.path} to {path}")
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while True:
+            if not self._active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, entry in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own_ident:
+                        entry["stacks"][self._collapse(frame)] += 1
+            self.stats["samples"] += 1
+            time.sleep(self.interval_ms / 1000)
+
+    def _collapse(self, frame):
+        """Stack as 'outer;...;inner' with one 'function (file)' entry per frame"""
+        names = []
+        while frame is not None and len(names) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _save(self, label, duration_ms, stacks):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{label}-{duration_ms:.0f}ms-{os.getpid()}.folded"
+        path = os.path.join(self.output_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.stats["saved"] += 1
+
+        # Keep the directory bounded
+        profiles = sorted(glob.glob(os.path.join(self.output_dir, "*.folded")), key=os.path.getmtime)
+        for old in profiles[:max(0, len(profiles) - self.max_files)]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return path
+
+
+class MemorySnapshots:
+    """On-demand tracemalloc snapshots of this worker, each compared with the previous one"""
+
+    def __init__(self):
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def start(self, frames=TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return self.status()
+
+    def stop(self):
+        with self._lock:
+            self._previous = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return self.status()
+
+    def status(self):
+        status = {"pid": os.getpid(), "tracing": tracemalloc.is_tracing(), "rss_kb": _rss_kb()}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            status.update({"traced_kb": current // 1024, "traced_peak_kb": peak // 1024})
+        return status
+
+    def snapshot(self, limit=25, group_by='lineno'):
+        """
+        Top allocation sites now, and the biggest changes since the previous snapshot
+
+        Args:
+            limit (int): Number of sites in each list
+            group_by (str): 'lineno', 'filename' or 'traceback'
+        """
+        if not tracemalloc.is_tracing():
+            return {**self.status(), "error": "tracemalloc is not running"}
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        with self._lock:
+            previous, self._previous = self._previous, snapshot
+
+        result = {
+            **self.status(),
+            "top": [_stat(stat) for stat in snapshot.statistics(group_by)[:limit]]
+        }
+        if previous is not None:
+            result["growth"] = [_stat(stat) for stat in snapshot.compare_to(previous, group_by)[:limit]]
+        return result
+
+
+def _stat(stat):
+    frame = stat.traceback[0]
+    entry = {
+        "site": f"{frame.filename}:{frame.lineno}",
+        "line": linecache.getline(frame.filename, frame.lineno).strip(),
+        "size_kb": round(stat.size / 1024, 1),
+        "count": stat.count
+    }
+    if hasattr(stat, "size_diff"):
+        entry.update({"size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff})
+    if len(stat.traceback) > 1:
+        entry["traceback"] = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+    return entry
+
+
+def _rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# One of each per worker process
+request_profiler = RequestProfiler()
+memory_snapshots = MemorySnapshots()
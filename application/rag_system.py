@@ -1,10 +1,24 @@
 import os
 import logging
 from document_manager import DocumentManager
+from citation_index import CitationIndex
+from citation_metadata import CitationMetadataStore, MetadataQueryRouter
+from embedding_client import EmbeddingClient
+from vector_store import ChunkVectorStore
+from models import Document
+from llm_scheduler import llm_scheduler, LLMBusyError, INTERACTIVE
+from cache import LRUCache
+from cache_bus import cache_bus, DOCUMENT
+from resilient_http import http_client
+from ollama_client import OllamaSessionClient
+from config import (PROMPT_PREFIX_CACHE_SIZE, LLM_REQUEST_TIMEOUT_S, LLM_MAX_RETRIES, LLM_BACKEND, OLLAMA_URL,
+                    OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX)
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 
 # Import langchain components
 from langchain_groq import ChatGroq
+from langchain_ollama import ChatOllama
 from langchain.prompts import ChatPromptTemplate
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import LLMChain
@@ -19,27 +33,83 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Host of the Groq API, for its circuit breaker and metrics
+LLM_HOST = "api.groq.com"
+
+# Token limits (1 token ≈ 4 characters)
+MAX_TOKENS = 30000
+RESERVED_TOKENS = 1500  # For prompt, query, and response
+MAX_CONTEXT_TOKENS = MAX_TOKENS - RESERVED_TOKENS
+
+PROMPT_INSTRUCTIONS = """You are a renowned professor with decades of experience in academic research, skilled at explaining complex concepts to non-experts. Your task is to answer the user's question based primarily on the full text of the primary research paper provided below, supplemented by relevant excerpts from cited papers. The primary document is the main source of information, while cited papers provide supporting details, especially for questions about how the current paper builds on past work.
+
+When answering:
+- Base your answer primarily on the primary document, using its full text to provide comprehensive and accurate information.
+- Use the cited papers' excerpts to supplement your answer, particularly when explaining how the current paper builds on or relates to previous work.
+- Explain concepts as you would to a curious student with no prior knowledge of the field, using simple language and analogies where helpful.
+- If the question relates to contributions from past work, summarize the relevant cited papers' contributions based on the provided excerpts.
+- If the answer is not contained in the context, say: "I don't have enough information in the provided documents to answer this question."
+- Do not use external knowledge or make up information. Base your answer solely on the provided context.
+- Keep your response concise, informative, and directly related to the question."""
+
+QUESTION_TEMPLATE = """CITED PAPERS:
+{cited_context}
+
+USER QUESTION:
+{query}"""
+
+
+def estimate_tokens(text):
+    """Estimate token count (1 token ≈ 4 characters)"""
+    return len(text) // 4 + 1
+
 class RAGSystem:
-    def __init__(self):
-        self.document_manager = DocumentManager()
+    def __init__(self, document_manager=None):
+        self.document_manager = document_manager or DocumentManager()
+        self.citation_index = CitationIndex()
+        self.citation_metadata = CitationMetadataStore(self.document_manager.title_index)
+        self.metadata_router = MetadataQueryRouter()
+        self.embedding_client = EmbeddingClient()
+        self.vector_store = ChunkVectorStore(container_client=self.document_manager.container_client)
+        self.chunk_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
+        self.context_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=20000,  # ~5,000 tokens, smaller to fit primary + cited
+            chunk_overlap=500
+        )
+        self.prompt_prefix_cache = LRUCache(max_entries=PROMPT_PREFIX_CACHE_SIZE)
+        cache_bus.subscribe(DOCUMENT, self._invalidate_document)
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
         
-        # Initialize Groq LLM
+        # Initialize the LLM
         self.llm = None
+        self.ollama = None
         try:
+            if LLM_BACKEND == 'ollama':
+                # Local serving: chat turns reuse a pinned context per document through OllamaSessionClient
+                logger.info(f"Initializing Ollama LLM ({OLLAMA_MODEL})...")
+                self.llm = ChatOllama(
+                    base_url=OLLAMA_URL,
+                    model=OLLAMA_MODEL,
+                    num_ctx=OLLAMA_NUM_CTX,
+                    keep_alive=OLLAMA_KEEP_ALIVE
+                )
+                self.ollama = OllamaSessionClient()
             # Check if GROQ_API_KEY is available
-            if os.environ.get("GROQ_API_KEY"):
+            elif os.environ.get("GROQ_API_KEY"):
                 logger.info("Initializing GROQ LLM...")
                 self.llm = ChatGroq(
                     api_key=os.environ.get("GROQ_API_KEY"),
                     model_name=
-                    "meta-llama/llama-4-scout-17b-16e-instruct"
+                    "meta-llama/llama-4-scout-17b-16e-instruct",
+                    timeout=LLM_REQUEST_TIMEOUT_S,
+                    max_retries=LLM_MAX_RETRIES
                 )
                 logger.info("GROQ LLM initialized successfully")
             else:
                 logger.warning(
                     "GROQ_API_KEY not found in environment variables")
         except Exception as e:
-            logger.error(f"Error initializing GROQ LLM: {str(e)}")
+            logger.error(f"Error initializing LLM: {str(e)}")
     
     def get_answer(self, query, user_id, document_id=None):
         """
@@ -54,12 +124,28 @@ class RAGSystem:
             str: The generated answer
         """
         try:
+            # Questions about the reference list as a whole are answered exactly from its metadata
+            if document_id:
+                metadata_answer = self.metadata_router.answer(query, document_id)
+                if metadata_answer is not None:
+                    return metadata_answer
+
+            # Questions about a specific reference only need the sentences that cite it
+            if document_id:
+                citation_contexts = self.citation_index.find_contexts(document_id, query)
+                if citation_contexts:
+                    current_app.logger.info(f"Answering from {len(citation_contexts)} citation contexts")
+                    return self._answer_from_citation_contexts(query, citation_contexts, user_id)
+
+            # Rank cited-paper chunks by embedding similarity when the vectors exist
+            cited_chunks = self._search_cited_chunks(query, user_id, document_id) if document_id else []
+
             # Search for relevant documents
             search_results = self.document_manager.search_documents(
                 query=query,
                 user_id=user_id,
                 document_id=document_id,
-                top=3
+                top=0 if cited_chunks else 3
             )
             
             if not search_results:
@@ -76,6 +162,8 @@ class RAGSystem:
                         "title": result["title"],
                         "content": result["content"]  # Query-relevant excerpt
                     })
+            if cited_chunks:
+                cited_contents = cited_chunks
             
             # Combine context: primary document (full) + cited papers (relevant)
             context_parts = [f"Primary Document:\n{primary_content}"]
@@ -86,130 +174,256 @@ class RAGSystem:
             # Check if LLM is available
             if self.llm:
                 current_app.logger.info("Using GROQ LLM for RAG response")
-                return self._generate_llm_response(query, context, primary_content, cited_contents)
+                return self._generate_llm_response(query, primary_content, cited_contents,
+                                                   user_id=user_id, document_id=document_id)
             else:
                 # Fall back to simple response if LLM isn't available
                 current_app.logger.warning("Falling back to simple response - GROQ LLM not available")
                 return self._generate_simple_response(query, context)
         
+        except LLMBusyError:
+            raise
         except Exception as e:
             current_app.logger.error(f"Error in get_answer: {str(e)}")
             return f"I encountered an error while trying to answer your question: {str(e)}"
     
-    def _generate_llm_response(self, query, context, primary_content, cited_contents):
+    def warm_session(self, document_id, user_id):
+        """
+        Start loading a chat's documents into the local caches without blocking the request
+        
+        Args:
+            document_id (int): The chat session's primary document
+            user_id (int): Owner of the document
+        """
+        app = current_app._get_current_object()
+        self.prefetch_executor.submit(self._warm_document, app, document_id, user_id)
+
+    def _warm_document(self, app, document_id, user_id):
+        """Fetch texts and vectors of a document and its citations, and build its prompt prefix"""
+        with app.app_context():
+            try:
+                document = Document.query.get(document_id)
+                if document is None:
+                    return
+                if document_id not in self.prompt_prefix_cache:
+                    primary_content = self.document_manager.get_document_text(document)
+                    self._get_prompt_prefix(document_id, primary_content)
+
+                cited_documents = Document.query.filter_by(parent_document_id=document_id, user_id=user_id).all()
+                for cited_doc in cited_documents:
+                    self.document_manager.get_document_text(cited_doc)
+                self.vector_store.warm(document_id)
+                logger.info(f"Warmed caches for document {document_id} and {len(cited_documents)} citations")
+            except Exception as e:
+                logger.error(f"Error warming caches for document {document_id}: {str(e)}")
+
+    def index_document(self, document, text_content=None, force=False):
+        """
+        Split a document into chunks and store their embeddings for retrieval
+        
+        Args:
+            document (Document): A saved document or citation row
+            text_content (str, optional): Its extracted text, read from storage when omitted
+            force (bool): Replace existing vectors (used when reindexing)
+            
+        Returns:
+            int: Number of chunks indexed
+        """
+        family_id = document.parent_document_id or document.id
+        if not self.embedding_client.available or (self.vector_store.has(document.id, family_id) and not force):
+            return 0
+        try:
+            if text_content is None:
+                text_content = self.document_manager.get_document_text(document)
+            chunks = self.chunk_splitter.split_text(text_content)
+            if not chunks:
+                return 0
+            vectors = self.embedding_client.embed_documents(chunks)
+            if vectors is None:
+                return 0
+            self.vector_store.save(document.id, chunks, vectors, family_id=family_id)
+            return len(chunks)
+        except Exception as e:
+            logger.error(f"Error indexing document {document.id}: {str(e)}")
+            return 0
+
+    def _search_cited_chunks(self, query, user_id, document_id, top_k=8):
+        """
+        Return the cited-paper chunks most similar to the query
+        
+        Returns:
+            list: Dicts with title and content, or an empty list when embeddings are unavailable
+        """
+        if not self.embedding_client.available:
+            return []
+        try:
+            cited_documents = Document.query.filter_by(parent_document_id=document_id, user_id=user_id).all()
+            titles = {doc.id: doc.title for doc in cited_documents if self.vector_store.has(doc.id, document_id)}
+            if not titles:
+                return []
+            query_vector = self.embedding_client.embed_query(query)
+            if query_vector is None:
+                return []
+            matches = self.vector_store.search(list(titles), query_vector, top_k=top_k,
+                                                family_id=document_id)
+            return [{"title": titles[doc_id], "content": chunk} for doc_id, chunk, _ in matches]
+        except Exception as e:
+            logger.error(f"Error searching cited chunks: {str(e)}")
+            return []
+
+    def _answer_from_citation_contexts(self, query, citation_contexts, user_id=None):
+        """
+        Answer a question about specific references from the sentences that cite them
+        
+        Args:
+            query (str): The user's question
+            citation_contexts (list): Citing sentences returned by CitationIndex.find_contexts
+        """
+        references = {}
+        for context in citation_contexts:
+            reference = references.setdefault(context["reference_label"], {
+                "marker": context["marker"],
+                "reference_text": context["reference_text"],
+                "sentences": []
+            })
+            reference["sentences"].append(context["sentence"])
+
+        context_parts = []
+        for label, reference in references.items():
+            sentences = "\n".join(f"- {sentence}" for sentence in reference["sentences"])
+            context_parts.append(
+                f"Reference {reference['marker']}: {reference['reference_text']}\n"
+                f"Sentences in the primary document that cite it:\n{sentences}")
+        context = "\n\n".join(context_parts)
+
+        if self.llm:
+            return self._generate_llm_response(query, context, [], user_id=user_id)
+        return self._generate_simple_response(query, context)
+
+    def _generate_llm_response(self, query, primary_content, cited_contents, user_id=None, priority=INTERACTIVE, document_id=None):
         """
         Generate a response using the GROQ LLM with provided context, prioritizing the primary document.
         
         Args:
             query (str): The user's question
-            context (str): Combined context (primary + cited papers)
             primary_content (str): Full text of the primary document
             cited_contents (list): List of cited papers with titles and relevant content
+            user_id (int, optional): User charged for the call by the LLM scheduler
+            priority (int): llm_scheduler.INTERACTIVE for chat, BACKGROUND for ingestion
+            document_id (int, optional): Primary document id, used to reuse its cached prompt prefix
+            
+        Raises:
+            LLMBusyError: When the scheduler does not admit the call
         """
         try:
-            # Estimate token count (1 token ≈ 4 characters)
-            def estimate_tokens(text):
-                return len(text) // 4 + 1
-
-            # Define token limits
-            MAX_TOKENS = 30000
-            RESERVED_TOKENS = 1500  # For prompt, query, and response
-            MAX_CONTEXT_TOKENS = MAX_TOKENS - RESERVED_TOKENS
-
-            # Create text splitter
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=20000,  # ~5,000 tokens, smaller to fit primary + cited
-                chunk_overlap=500
-            )
+            # The static part of the prompt: instructions plus the (possibly truncated) primary document
+            prompt_prefix = self._get_prompt_prefix(document_id, primary_content)
+            remaining_tokens = MAX_CONTEXT_TOKENS - estimate_tokens(prompt_prefix)
 
-            # Check context size
-            context_tokens = estimate_tokens(context)
-            if context_tokens > MAX_CONTEXT_TOKENS:
-                current_app.logger.info(f"Context exceeds {MAX_CONTEXT_TOKENS} tokens: {context_tokens}")
-                
-                # Prioritize primary document
-                primary_tokens = estimate_tokens(primary_content)
-                if primary_tokens >= MAX_CONTEXT_TOKENS:
-                    # Split primary document if too large
-                    primary_chunks = text_splitter.split_text(primary_content)
-                    primary_content = primary_chunks[0]  # Take first chunk
-                    current_app.logger.info("Truncated primary document to first chunk")
-                    cited_contents = []  # No room for cited papers
-                else:
-                    # Fit primary document, trim cited papers
-                    remaining_tokens = MAX_CONTEXT_TOKENS - primary_tokens
-                    
-                    # Rank cited papers by relevance
-                    def score_chunk(chunk, query):
-                        score = 0
-                        query_words = re.findall(r'\w+', query.lower())
-                        chunk_lower = chunk.lower()
-                        for word in query_words:
-                            if word in chunk_lower:
-                                score += chunk_lower.count(word)
-                        return score
-
-                    ranked_cited = []
-                    for cited in cited_contents:
-                        score = score_chunk(cited["content"], query)
-                        ranked_cited.append((cited, score))
-                    ranked_cited.sort(key=lambda x: x[1], reverse=True)
-
-                    # Select cited content to fit remaining tokens
-                    selected_cited = []
-                    total_cited_tokens = 0
-                    for cited, _ in ranked_cited:
-                        cited_tokens = estimate_tokens(cited["content"])
-                        if total_cited_tokens + cited_tokens <= remaining_tokens:
-                            selected_cited.append(cited)
-                            total_cited_tokens += cited_tokens
-                        else:
-                            break
-
-                    # Rebuild context
-                    context_parts = [f"Primary Document:\n{primary_content}"]
-                    for cited in selected_cited:
-                        context_parts.append(f"Cited Paper ({cited['title']}):\n{cited['content']}")
-                    context = "\n\n".join(context_parts)
-                
-                current_app.logger.info(f"Final context tokens: {estimate_tokens(context)}")
-
-            # Create prompt template
-            prompt = ChatPromptTemplate.from_template("""
-                You are a renowned professor with decades of experience in academic research, skilled at explaining complex concepts to non-experts. Your task is to answer the user's question based primarily on the full text of the primary research paper provided in the context, supplemented by relevant excerpts from cited papers. The primary document is the main source of information, while cited papers provide supporting details, especially for questions about how the current paper builds on past work.
-
-                CONTEXT:
-                {context}
-
-                USER QUESTION:
-                {query}
-
-                When answering:
-                - Base your answer primarily on the primary document, using its full text to provide comprehensive and accurate information.
-                - Use the cited papers' excerpts to supplement your answer, particularly when explaining how the current paper builds on or relates to previous work.
-                - Explain concepts as you would to a curious student with no prior knowledge of the field, using simple language and analogies where helpful.
-                - If the question relates to contributions from past work, summarize the relevant cited papers' contributions based on the provided excerpts.
-                - If the answer is not contained in the context, say: "I don't have enough information in the provided documents to answer this question."
-                - Do not use external knowledge or make up information. Base your answer solely on the provided context.
-                - Keep your response concise, informative, and directly related to the question.
-            """)
+            cited_tokens = sum(estimate_tokens(cited["content"]) for cited in cited_contents)
+            if cited_tokens > remaining_tokens:
+                current_app.logger.info(f"Cited context exceeds {remaining_tokens} tokens: {cited_tokens}")
+
+                # Rank cited papers by relevance
+                def score_chunk(chunk, query):
+                    score = 0
+                    query_words = re.findall(r'\w+', query.lower())
+                    chunk_lower = chunk.lower()
+                    for word in query_words:
+                        if word in chunk_lower:
+                            score += chunk_lower.count(word)
+                    return score
+
+                ranked_cited = []
+                for cited in cited_contents:
+                    score = score_chunk(cited["content"], query)
+                    ranked_cited.append((cited, score))
+                ranked_cited.sort(key=lambda x: x[1], reverse=True)
+
+                # Select cited content to fit remaining tokens
+                selected_cited = []
+                total_cited_tokens = 0
+                for cited, _ in ranked_cited:
+                    tokens = estimate_tokens(cited["content"])
+                    if total_cited_tokens + tokens <= remaining_tokens:
+                        selected_cited.append(cited)
+                        total_cited_tokens += tokens
+                    else:
+                        break
+                cited_contents = selected_cited
+
+            cited_context = "\n\n".join(
+                f"Cited Paper ({cited['title']}):\n{cited['content']}" for cited in cited_contents
+            ) or "No cited paper excerpts."
+            current_app.logger.info(
+                f"Final context tokens: {estimate_tokens(prompt_prefix) + estimate_tokens(cited_context)}")
+
+            cost = estimate_tokens(prompt_prefix) + estimate_tokens(cited_context) + RESERVED_TOKENS
+            if self.ollama is not None:
+                # The prefix is prefilled once per document; only the question part is new each turn
+                with llm_scheduler.slot(user_id, priority=priority, cost=cost):
+                    response_text = self.ollama.generate(
+                        QUESTION_TEMPLATE.format(cited_context=cited_context, query=query),
+                        prompt_prefix, document_id=document_id)
+                current_app.logger.info("Generated response from Ollama")
+                return response_text
+
+            # Static prefix first so it is identical across turns, per-question parts last
+            prompt = ChatPromptTemplate.from_messages([
+                ("system", "{prefix}"),
+                ("human", QUESTION_TEMPLATE)
+            ])
 
             # Create chain
             chain = LLMChain(llm=self.llm, prompt=prompt)
 
-            # Run the chain
-            response = chain.invoke({
-                "context": context,
-                "query": query
-            })
+            # Run the chain once the scheduler grants a slot
+            with llm_scheduler.slot(user_id, priority=priority, cost=cost), http_client.guard(LLM_HOST):
+                response = chain.invoke({
+                    "prefix": prompt_prefix,
+                    "cited_context": cited_context,
+                    "query": query
+                })
 
             current_app.logger.info("Generated response from GROQ LLM")
             return response['text']
 
+        except LLMBusyError as e:
+            current_app.logger.warning(f"LLM call not admitted: {e}")
+            raise
         except Exception as e:
             current_app.logger.error(f"Error in _generate_llm_response: {str(e)}")
             return f"I encountered an error while generating a response with the LLM: {str(e)}"
 
+    def _invalidate_document(self, document_id, same_host):
+        """Drop the prompt prefix (and pinned Ollama context) of a document changed in another process"""
+        if document_id is None:
+            self.prompt_prefix_cache.clear()
+            if self.ollama:
+                self.ollama.handles.clear()
+            return
+        self.prompt_prefix_cache.pop(document_id)
+        if self.ollama:
+            self.ollama.handles.pop(document_id)
+
+    def _get_prompt_prefix(self, document_id, primary_content):
+        """Return the static prompt prefix for a document, building and caching it on first use"""
+        if document_id is not None:
+            prompt_prefix = self.prompt_prefix_cache.get(document_id)
+            if prompt_prefix is not None:
+                return prompt_prefix
+
+        if estimate_tokens(primary_content) >= MAX_CONTEXT_TOKENS:
+            # Split primary document if too large and keep the first chunk
+            primary_chunks = self.context_splitter.split_text(primary_content)
+            primary_content = primary_chunks[0]
+            logger.info("Truncated primary document to first chunk")
+
+        prompt_prefix = f"{PROMPT_INSTRUCTIONS}\n\nPRIMARY DOCUMENT:\n{primary_content}"
+        if document_id is not None:
+            self.prompt_prefix_cache.set(document_id, prompt_prefix)
+        return prompt_prefix
+
     def _generate_simple_response(self, query, context):
         """
         Generate a simple response based on the context
@@ -0,0 +1,121 @@
+"""
+Recognising questions about a document's reference list as a set.
+
+"Which cited papers are from after 2018?" or "how many references does this
+paper have?" are answered exactly from the references' metadata. A question
+is only recognised when every word of it belongs to a reference phrase, a
+year, author or venue filter, a mode ("most cited", "how many", ...) or a
+short list of stopwords; anything else, such as a topic or a method, means
+the question is about what the references say and goes to the RAG path.
+"""
+import re
+from datetime import datetime
+
+# What a metadata question must be about
+REFERENCE_NOUN = re.compile(
+    r'\b(?:references?|citations|cited (?:papers?|works?|articles?|studies|sources)|bibliography|'
+    r'papers? (?:it|this paper|the paper) cites?|works? cited)\b', re.IGNORECASE)
+
+# Questions about what the references say need their text, not their metadata
+CONTENT_WORDS = re.compile(
+    r'\b(?:about|discuss(?:es|ed)?|say|says|said|propos(?:e|es|ed)|argu(?:e|es|ed)|claim(?:s|ed)?|describ(?:e|es|ed)|'
+    r'explain(?:s|ed)?|why|relat(?:e|es|ed)|support(?:s|ed)?|contradict(?:s|ed)?|agree(?:s|d)?|disagree(?:s|d)?|'
+    r'methods?|approach(?:es)?|findings?|results?|conclu(?:de|des|sion|sions)|summar(?:y|i[sz]e)|compar(?:e|ison)|times)\b', re.IGNORECASE)
+
+YEAR = r'((?:19|20)\d{2})'
+YEAR_BETWEEN = re.compile(rf'\b(?:between|from)\s+{YEAR}\s+(?:and|to|until)\s+{YEAR}\b|\b{YEAR}\s*[-–]\s*{YEAR}\b',
+                          re.IGNORECASE)
+YEAR_AFTER = re.compile(rf'\b(?:after|later than|newer than|more recent than|post-?)\s*{YEAR}\b', re.IGNORECASE)
+YEAR_SINCE = re.compile(rf'\b(?:since|from)\s+{YEAR}\s+(?:on(?:wards?)?|or later)\b|\bsince\s+{YEAR}\b|'
+                        rf'\b{YEAR}\s+or\s+(?:later|after|newer)\b', re.IGNORECASE)
+YEAR_BEFORE = re.compile(rf'\b(?:before|prior to|earlier than|older than|pre-?)\s*{YEAR}\b', re.IGNORECASE)
+YEAR_IN = re.compile(rf'\b(?:in|from|during)\s+{YEAR}\b', re.IGNORECASE)
+LAST_YEARS = re.compile(r'\b(?:last|past)\s+(\d{1,2})\s+years\b', re.IGNORECASE)
+AUTHOR = re.compile(r"\b(?:by|authored by|written by|from author)\s+([A-Z][\w'\-]+(?:\s+[A-Z][\w'\-]+)*)")
+VENUE = re.compile(r"\b(?:published|appeared|appearing|presented)\s+(?:in|at)\s+"
+                   r"(?!(?:the\s+)?(?:(?:19|20)\d{2}\b|(?:last|past)\s))(?:the\s+)?"
+                   r"([A-Za-z][\w&.\- ]*?)\s*(?=[?.,;]|$|\s(?:after|before|since|between|from|in)\b)")
+
+MOST_CITED = re.compile(r'\bmost (?:highly |frequently |often |widely )?cited\b|\bmost citations\b|\bhighly cited\b|'
+                        r'\bmost influential\b', re.IGNORECASE)
+OLDEST = re.compile(r'\b(?:oldest|earliest)\b', re.IGNORECASE)
+NEWEST = re.compile(r'\b(?:newest|latest|most recent)\b', re.IGNORECASE)
+COUNT = re.compile(r'\bhow many\b|\bnumber of\b|\bcount\b', re.IGNORECASE)
+LIST_ALL = re.compile(r'\b(?:list|show|give me|what are|which are)\b', re.IGNORECASE)
+
+# Everything classify_reference_question recognises; what is left must be stopwords
+RECOGNISED_PHRASES = (REFERENCE_NOUN, YEAR_BETWEEN, LAST_YEARS, YEAR_AFTER, YEAR_SINCE, YEAR_BEFORE, YEAR_IN, AUTHOR,
+                      VENUE, MOST_CITED, OLDEST, NEWEST, COUNT, LIST_ALL)
+STOPWORDS = frozenset("""
+    a all an and any are as be by can cite cited cites citing could do does did each for from give has have
+    how i in is it its listed many me my of on one ones or overall paper papers please show tell than that the
+    their there these this those to top total was were what which who with year years you your
+""".split())
+
+
+def classify_reference_question(query):
+    """
+    Recognise a question the reference metadata answers exactly
+
+    Returns:
+        dict: The mode (count, list, top, oldest or newest) and year, author and venue filters,
+              or None for questions that need the RAG path
+    """
+    if not REFERENCE_NOUN.search(query) or CONTENT_WORDS.search(query):
+        return None
+    intent = {"year_min": None, "year_max": None, "year_label": None, "author": None, "venue": None}
+    _parse_years(query, intent)
+    author = AUTHOR.search(query)
+    if author:
+        intent["author"] = author.group(1)
+    venue = VENUE.search(query)
+    if venue and venue.group(1).strip():
+        intent["venue"] = venue.group(1).strip()
+    filtered = any(intent[key] is not None for key in ("year_label", "author", "venue"))
+
+    if MOST_CITED.search(query):
+        intent["mode"] = "top"
+    elif OLDEST.search(query):
+        intent["mode"] = "oldest"
+    elif NEWEST.search(query):
+        intent["mode"] = "newest"
+    elif COUNT.search(query):
+        intent["mode"] = "count"
+    elif filtered or LIST_ALL.search(query):
+        intent["mode"] = "list"
+    else:
+        return None
+    # "references on attention", "references that use CNNs": a topic is left over, which needs the text
+    if _leftover_words(query):
+        return None
+    return intent
+
+
+def _parse_years(query, intent):
+    between = YEAR_BETWEEN.search(query)
+    last = LAST_YEARS.search(query)
+    if between:
+        first, last_year = sorted(int(year) for year in between.groups() if year)
+        intent.update(year_min=first, year_max=last_year, year_label=f"from {first} to {last_year}")
+    elif last:
+        first = datetime.utcnow().year - int(last.group(1))
+        intent.update(year_min=first, year_label=f"from {first} or later")
+    elif YEAR_AFTER.search(query):
+        year = int(YEAR_AFTER.search(query).group(1))
+        intent.update(year_min=year + 1, year_label=f"from after {year}")
+    elif YEAR_SINCE.search(query):
+        year = int(next(group for group in YEAR_SINCE.search(query).groups() if group))
+        intent.update(year_min=year, year_label=f"from {year} or later")
+    elif YEAR_BEFORE.search(query):
+        year = int(YEAR_BEFORE.search(query).group(1))
+        intent.update(year_max=year - 1, year_label=f"from before {year}")
+    elif YEAR_IN.search(query):
+        year = int(YEAR_IN.search(query).group(1))
+        intent.update(year_min=year, year_max=year, year_label=f"from {year}")
+
+
+def _leftover_words(query):
+    """Words of a query outside the recognised phrases, other than stopwords and numbers"""
+    for pattern in RECOGNISED_PHRASES:
+        query = pattern.sub(' ', query)
+    return [word for word in re.findall(r"[a-z0-9']+", query.lower()) if word not in STOPWORDS and not word.isdigit()]
@@ -0,0 +1,206 @@
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from sqlalchemy import or_
+from app import app, db
+from models import Document, DocumentChunk, DocumentIndexState, IndexGeneration, ReindexJob
+from config import PIPELINE_VERSION
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Per-process pipeline objects, created after the fork so no connections are shared with the parent
+_worker = {}
+
+
+def _init_worker():
+    from document_manager import DocumentManager
+    from rag_system import RAGSystem
+    with app.app_context():
+        db.engine.dispose(close=False)
+    _worker["document_manager"] = DocumentManager()
+    _worker["rag_system"] = RAGSystem(_worker["document_manager"])
+
+
+def _reprocess(document_id, generation):
+    """
+    Run extraction, chunk indexing and embedding again for one document (in a pool process)
+
+    Returns:
+        tuple: (document_id, True on success)
+    """
+    document_manager, rag_system = _worker["document_manager"], _worker["rag_system"]
+    with app.app_context():
+        try:
+            document = Document.query.get(document_id)
+            if document is None:
+                # Deleted since the batch was selected
+                return document_id, True
+            text_content = document_manager.reextract_text(document)
+            document_manager.index_document_text(document, text_content, generations=[generation])
+            rag_system.index_document(document, text_content, force=True)
+            db.session.commit()
+            return document_id, True
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error reprocessing document {document_id}: {e}")
+            return document_id, False
+
+
+class Reindexer:
+    """
+    Resumable backfill of every Document through the current pipeline.
+
+    Documents are walked in id order (keyset pagination) and reprocessed in a
+    process pool one batch at a time; the last id of each finished batch is
+    checkpointed in ReindexJob so an interrupted run resumes where it stopped.
+    An unfiltered run builds a new index generation and switches searches to
+    it in one transaction at the end; a filtered run updates the live
+    generation in place. Documents that fail are recorded and tried once
+    more at the end; a rebuild with documents still failing is left
+    incomplete rather than switched to, since they would have no chunks in
+    the new generation, and running it again retries them.
+    """
+
+    def __init__(self, workers=4, batch_size=50, max_per_minute=0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_per_minute = max_per_minute
+
+    def start(self, user_id=None, since=None, until=None, outdated_only=False):
+        """Create a job for the given filters"""
+        filters = {
+            "user_id": user_id,
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+            "outdated_only": outdated_only
+        }
+        full_rebuild = not any(filters.values())
+        if full_rebuild:
+            # Serializes starts, so two rebuilds can't both pass the check below
+            db.session.execute(db.text("SELECT pg_advisory_xact_lock(hashtext('apce_reindex_start'))"))
+            building = IndexGeneration.query.filter_by(status='building').first()
+            if building is not None:
+                db.session.rollback()
+                raise ValueError(f"Index generation {building.id} is still being built; "
+                                 f"resume or abandon its reindex job first")
+            generation = IndexGeneration(pipeline_version=PIPELINE_VERSION, status='building')
+            db.session.add(generation)
+            db.session.flush()
+            generation_id = generation.id
+        else:
+            generation = IndexGeneration.query.filter_by(status='active').order_by(IndexGeneration.id.desc()).first()
+            generation_id = generation.id if generation else 0
+
+        job = ReindexJob(
+            pipeline_version=PIPELINE_VERSION,
+            generation=generation_id,
+            switch_on_completion=full_rebuild,
+            filters=json.dumps(filters)
+        )
+        db.session.add(job)
+        db.session.commit()
+        logger.info(f"Started reindex job {job.id} into generation {generation_id} with filters {filters}")
+        return job
+
+    def unfinished_job(self):
+        return ReindexJob.query.filter(ReindexJob.status.in_(('running', 'incomplete'))) \
+            .order_by(ReindexJob.id.desc()).first()
+
+    def abandon(self, job):
+        """Stop tracking a job; a generation it was building is retired and its chunks dropped"""
+        job.status = 'abandoned'
+        if job.switch_on_completion:
+            IndexGeneration.query.filter_by(id=job.generation, status='building').update({"status": "retired"})
+            DocumentChunk.query.filter_by(generation=job.generation).delete(synchronize_session=False)
+        db.session.commit()
+
+    def run(self, job, progress=None):
+        """
+        Process the job's remaining documents, then switch generations if it is a full rebuild
+
+        Args:
+            job (ReindexJob): A running job, new or resumed
+            progress (callable, optional): Called with the job after every checkpoint
+        """
+        job.status = 'running'
+        failed_ids = json.loads(job.failed_ids or '[]')
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker) as pool:
+            while True:
+                ids = [row.id for row in self._remaining(job).limit(self.batch_size)]
+                if not ids:
+                    break
+                started = time.monotonic()
+                for document_id, succeeded in pool.map(_reprocess, ids, repeat(job.generation)):
+                    if succeeded:
+                        job.processed += 1
+                    else:
+                        failed_ids.append(document_id)
+                job.failed_ids = json.dumps(failed_ids)
+                job.failed = len(failed_ids)
+
+                # Checkpoint: everything up to the last id of the batch has been attempted
+                job.last_document_id = ids[-1]
+                db.session.commit()
+                if progress:
+                    progress(job)
+
+                if self.max_per_minute:
+                    time.sleep(max(0.0, len(ids) * 60.0 / self.max_per_minute - (time.monotonic() - started)))
+
+            # Failures are often transient (a blob or database hiccup): one more attempt each
+            if failed_ids:
+                logger.info(f"Reindex job {job.id}: retrying {len(failed_ids)} failed documents")
+                retried = list(pool.map(_reprocess, failed_ids, repeat(job.generation)))
+                failed_ids = [document_id for document_id, succeeded in retried if not succeeded]
+                job.processed += len(retried) - len(failed_ids)
+                job.failed_ids = json.dumps(failed_ids)
+                job.failed = len(failed_ids)
+
+        if failed_ids and job.switch_on_completion:
+            # The failed documents have no chunks in the new generation; switching would drop them from search
+            job.status = 'incomplete'
+            db.session.commit()
+            logger.warning(f"Reindex job {job.id}: {len(failed_ids)} documents still fail; "
+                           f"generation {job.generation} was not activated")
+            return
+        job.status = 'completed'
+        db.session.commit()
+        if job.switch_on_completion:
+            self.activate_generation(job.generation)
+
+    def activate_generation(self, generation_id):
+        """Switch searches to a generation in one transaction, then drop the chunks of the one it replaced"""
+        retired_ids = [row.id for row in IndexGeneration.query.with_entities(IndexGeneration.id)
+                       .filter_by(status='active').all()]
+        IndexGeneration.query.filter_by(status='active').update({"status": "retired"})
+        IndexGeneration.query.filter_by(id=generation_id).update(
+            {"status": "active", "activated_at": datetime.utcnow()})
+        db.session.commit()
+        logger.info(f"Index generation {generation_id} is now active")
+
+        # Generation 0 holds chunks written before generations existed; other building generations are kept
+        DocumentChunk.query.filter(DocumentChunk.generation.in_(retired_ids + [0])) \
+            .filter(DocumentChunk.generation != generation_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _remaining(self, job):
+        filters = json.loads(job.filters)
+        query = Document.query.with_entities(Document.id) \
+            .filter(Document.id > job.last_document_id).order_by(Document.id)
+        if filters.get("user_id"):
+            query = query.filter(Document.user_id == filters["user_id"])
+        if filters.get("since"):
+            query = query.filter(Document.uploaded_at >= datetime.fromisoformat(filters["since"]))
+        if filters.get("until"):
+            query = query.filter(Document.uploaded_at < datetime.fromisoformat(filters["until"]))
+        if filters.get("outdated_only"):
+            query = query.outerjoin(DocumentIndexState, DocumentIndexState.document_id == Document.id).filter(
+                or_(DocumentIndexState.pipeline_version.is_(None),
+                    DocumentIndexState.pipeline_version < job.pipeline_version))
+        return query
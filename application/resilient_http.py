@@ -0,0 +1,294 @@
+"""
+Shared outbound HTTP layer with deadlines, retries, hedging and circuit breakers.
+
+Every call gets a total deadline. Idempotent calls are retried with jittered
+exponential backoff while the deadline allows. Once a host has enough latency
+samples, a duplicate request is sent when the first one is slower than the
+host's p95, and whichever answers first wins. Hosts that fail repeatedly are
+short-circuited until a probe request succeeds after a cooldown.
+"""
+import logging
+import random
+import threading
+import time
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+from config import (HTTP_DEFAULT_DEADLINE_S, HTTP_CONNECT_TIMEOUT_S, HTTP_MAX_RETRIES, HTTP_HEDGE_MIN_SAMPLES,
+                    HTTP_BREAKER_FAILURES, HTTP_BREAKER_COOLDOWN_S)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+BACKOFF_BASE_S = 0.25
+BACKOFF_CAP_S = 4.0
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without contacting a host whose circuit is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open (one probe) -> closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=HTTP_BREAKER_FAILURES, cooldown=HTTP_BREAKER_COOLDOWN_S):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.OPEN:
+                return False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """Count a failure; returns True when it opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class LatencyWindow:
+    """Most recent request latencies of a host"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class ResilientHTTP:
+    """requests-compatible client; responses are fully read before they are returned"""
+
+    def __init__(self, max_workers=16):
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http")
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._latencies = defaultdict(LatencyWindow)
+        self._stats = defaultdict(Counter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, deadline=HTTP_DEFAULT_DEADLINE_S, retries=HTTP_MAX_RETRIES, hedge=True,
+                **kwargs):
+        """
+        Send a request within a total deadline
+
+        Args:
+            method (str): HTTP method; only idempotent methods are retried and hedged
+            url (str): Request URL
+            deadline (float): Seconds for the whole call, retries and backoff included
+            retries (int): Extra attempts after a connection error, timeout or retryable status
+            hedge (bool): Allow a duplicate request once the first is slower than the host's p95
+            **kwargs: Passed to requests (headers, params, json, allow_redirects, ...)
+
+        Returns:
+            requests.Response: The last response, which may still carry an error status
+
+        Raises:
+            CircuitOpenError: When the host's circuit is open
+            requests.exceptions.RequestException: When no response arrived before the deadline
+        """
+        host = urlsplit(url).hostname or url
+        breaker = self._breaker(host)
+        end = time.monotonic() + deadline
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count(host, "short_circuited")
+                raise CircuitOpenError(f"Circuit open for {host}")
+
+            response, error = None, None
+            try:
+                response = self._attempt(method, url, host, end, hedge and idempotent, kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+
+            if response is not None and response.status_code not in RETRYABLE_STATUSES:
+                breaker.record_success()
+                self._count(host, "successes")
+                return response
+
+            self._count(host, "failures")
+            if breaker.record_failure():
+                logger.warning(f"Circuit opened for {host} after repeated failures")
+
+            attempt += 1
+            remaining = end - time.monotonic()
+            delay = self._backoff(attempt, response)
+            if not idempotent or attempt > retries or delay >= remaining:
+                if response is not None:
+                    return response
+                raise error
+            self._count(host, "retries")
+            time.sleep(delay)
+
+    @contextmanager
+    def guard(self, host):
+        """Apply the host's circuit breaker and metrics to a call made by another client library"""
+        breaker = self._breaker(host)
+        if not breaker.allow():
+            self._count(host, "short_circuited")
+            raise CircuitOpenError(f"Circuit open for {host}")
+        started = time.monotonic()
+        self._count(host, "requests")
+        try:
+            yield
+        except Exception:
+            self._count(host, "failures")
+            if breaker.record_failure():
+                logger.warning(f"Circuit opened for {host} after repeated failures")
+            raise
+        self._latencies[host].add(time.monotonic() - started)
+        breaker.record_success()
+        self._count(host, "successes")
+
+    def snapshot(self):
+        """Per-host counters, latency percentiles and breaker states"""
+        with self._lock:
+            hosts = set(self._stats) | set(self._breakers)
+        metrics = {}
+        for host in sorted(hosts):
+            latencies = self._latencies[host]
+            p50, p95 = latencies.percentile(0.5), latencies.percentile(0.95)
+            breaker = self._breakers.get(host)
+            metrics[host] = {
+                **self._stats[host],
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "breaker": breaker.state if breaker else CircuitBreaker.CLOSED
+            }
+        return metrics
+
+    def _attempt(self, method, url, host, end, hedge, kwargs):
+        """One attempt, possibly hedged; returns the first response to arrive"""
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            self._count(host, "deadline_exceeded")
+            raise requests.exceptions.Timeout(f"Deadline exceeded for {host}")
+        timeout = (min(HTTP_CONNECT_TIMEOUT_S, remaining), remaining)
+
+        futures = [self.executor.submit(self._send, method, url, host, timeout, kwargs)]
+        hedge_delay = self._hedge_delay(host) if hedge else None
+        if hedge_delay is not None and hedge_delay < remaining:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self._count(host, "hedges")
+                futures.append(self.executor.submit(self._send, method, url, host, timeout, kwargs))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is not futures[0]:
+                    self._count(host, "hedge_wins")
+                # Release the connections of requests that lost the race
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(_close_response)
+                return future.result()
+
+        for future in futures:
+            future.add_done_callback(_close_response)
+        if error is not None and not pending:
+            raise error
+        self._count(host, "deadline_exceeded")
+        raise requests.exceptions.Timeout(f"Deadline exceeded for {host}")
+
+    def _send(self, method, url, host, timeout, kwargs):
+        self._count(host, "requests")
+        started = time.monotonic()
+        response = self.session.request(method, url, timeout=timeout, **kwargs)
+        response.content  # Read the body here so the deadline covers it
+        self._latencies[host].add(time.monotonic() - started)
+        return response
+
+    def _hedge_delay(self, host):
+        latencies = self._latencies[host]
+        if len(latencies) < HTTP_HEDGE_MIN_SAMPLES:
+            return None
+        return latencies.percentile(0.95)
+
+    def _backoff(self, attempt, response):
+        """Full-jitter exponential backoff, honouring a numeric Retry-After header"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(BACKOFF_CAP_S, BACKOFF_BASE_S * 2 ** attempt))
+
+    def _breaker(self, host):
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker()
+            return breaker
+
+    def _count(self, host, name):
+        with self._lock:
+            self._stats[host][name] += 1
+
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+# One client per worker process, so breakers and latency windows are shared by all callers
+http_client = ResilientHTTP()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Offline evaluation of retrieval quality against context size and latency.
+
+Runs every labelled question of an evaluation set through each retrieval
+configuration and reports recall@k, MRR, the tokens of context the
+configuration would put in the prompt and its retrieval latency, side by
+side:
+
+    python retrieval_eval.py
+    python retrieval_eval.py --k 3 --k 5 --min-recall 0.9 --output results.json
+
+The evaluation set (retrieval_eval_set.json) names the documents, and for
+each question the short passages that answer it. Documents are read from
+the sample papers (PDF, or the extracted .txt of older uploads) and
+normalized as at upload. No database, blob storage or LLM is needed. The
+embedding configurations run only when the embedding service at
+EMBEDDING_SERVICE_URL (see embedding_service.py) answers /health; they are
+skipped when it is down or the variable is set empty.
+
+Questions none of whose labelled passages are found in their document are
+left out and counted in the report; --strict makes that an error.
+"""
+import json
+import logging
+import os
+import re
+import statistics
+import tempfile
+import time
+from collections import namedtuple
+
+import click
+import fitz
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from embedding_client import EmbeddingClient
+from passage_extractor import rank_passages
+from text_normalizer import normalize_pages
+from vector_store import ChunkVectorStore, QUANTIZATIONS
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVAL_SET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrieval_eval_set.json')
+
+# Same limit and estimate as rag_system (MAX_CONTEXT_TOKENS, estimate_tokens), which needs the database to import
+MAX_CONTEXT_TOKENS = 28500
+
+Question = namedtuple('Question', ['document', 'question', 'relevant'])
+Result = namedtuple('Result', ['configuration', 'k', 'recall', 'mrr', 'context_tokens', 'p50_ms', 'p95_ms', 'missed'])
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def _match_key(text):
+    """Lowercase letters and digits only, so labels match across spacing, hyphenation and punctuation"""
+    return re.sub(r'[^a-z0-9]', '', text.lower())
+
+
+class FullDocumentRetriever:
+    """The primary document as RAGSystem puts it in the prompt today"""
+    ranked = False
+
+    def __init__(self, max_context_tokens=MAX_CONTEXT_TOKENS):
+        self.name = "full-document"
+        self.max_chars = max_context_tokens * 4
+        self.documents = {}
+
+    def prepare(self, documents):
+        self.documents = documents
+
+    def retrieve(self, document, query, limit):
+        return [self.documents[document][:self.max_chars]]
+
+
+class PassageRetriever:
+    """Query-term windows from passage_extractor, as used for cited papers and library questions"""
+    ranked = True
+
+    def __init__(self, window):
+        self.name = f"passages-{window}"
+        self.window = window
+        self.documents = {}
+
+    def prepare(self, documents):
+        self.documents = documents
+
+    def retrieve(self, document, query, limit):
+        return rank_passages(self.documents[document], query, budget=limit * self.window, window=self.window)
+
+
+class EmbeddingRetriever:
+    """Chunks ranked by embedding similarity, through ChunkVectorStore as for cited papers"""
+    ranked = True
+
+    def __init__(self, embedding_client, chunk_size, chunk_overlap, quantization='none'):
+        self.name = f"embeddings-{chunk_size}" + (f"-{quantization}" if quantization != 'none' else "")
+        self.embedding_client = embedding_client
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.vector_store = ChunkVectorStore(base_dir=tempfile.mkdtemp(prefix="retrieval-eval-"),
+                                             quantization=quantization)
+
+    def prepare(self, documents):
+        for key, text in documents.items():
+            chunks = self.splitter.split_text(text)
+            vectors = self.embedding_client.embed_documents(chunks)
+            if vectors is None:
+                raise RuntimeError(f"Embedding service failed for {key}")
+            self.vector_store.save(key, chunks, vectors)
+
+    def retrieve(self, document, query, limit):
+        query_vector = self.embedding_client.embed_query(query)
+        return [chunk for _, chunk, _ in self.vector_store.search([document], query_vector, top_k=limit)]
+
+
+def load_eval_set(path):
+    """
+    Read an evaluation set and the normalized text of its documents
+
+    Returns:
+        tuple: ({document key: text}, [Question], [question text left out because no label matched])
+    """
+    with open(path, encoding='utf-8') as f:
+        eval_set = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    documents = {}
+    for key, relative_path in eval_set["documents"].items():
+        documents[key] = read_document(os.path.join(base_dir, relative_path))
+
+    questions, dropped = [], []
+    for entry in eval_set["questions"]:
+        text_key = _match_key(documents[entry["document"]])
+        relevant = []
+        for passage in entry["relevant"]:
+            if _match_key(passage) in text_key:
+                relevant.append(passage)
+            else:
+                logger.warning(f"Label not found in {entry['document']}, ignored: {passage!r}")
+        if relevant:
+            questions.append(Question(entry["document"], entry["question"], relevant))
+        else:
+            logger.warning(f"No label found in {entry['document']}, question left out: {entry['question']!r}")
+            dropped.append(entry["question"])
+    return documents, questions, dropped
+
+
+def read_document(path):
+    """Normalized text of a PDF, or of an extracted .txt, without its reference list"""
+    if path.lower().endswith('.pdf'):
+        with fitz.open(path) as pdf_document:
+            pages = [page.get_text("text") for page in pdf_document]
+    else:
+        with open(path, encoding='utf-8') as f:
+            pages = [f.read()]
+    return "\n".join(normalize_pages(pages).pages)
+
+
+def evaluate(retriever, questions, ks, repeat=3):
+    """
+    Run every question through a retriever
+
+    Args:
+        retriever: Object with name, ranked, and retrieve(document, query, limit)
+        questions (list): Question tuples
+        ks (list): Numbers of top-ranked pieces to score
+        repeat (int): Timed runs per question; every run counts towards the latency percentiles
+
+    Returns:
+        list: One Result per k (a single one for an unranked retriever)
+    """
+    ks = sorted(ks) if retriever.ranked else [None]
+    limit = max(k or 1 for k in ks)
+    latencies = []
+    rankings = []
+    for question in questions:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            ranking = retriever.retrieve(question.document, question.question, limit)
+            latencies.append((time.perf_counter() - started) * 1000)
+        rankings.append(ranking)
+
+    p50_ms = statistics.median(latencies)
+    p95_ms = sorted(latencies)[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+
+    results = []
+    for k in ks:
+        recalls, reciprocal_ranks, tokens, missed = [], [], [], []
+        for question, ranking in zip(questions, rankings):
+            pieces = [_match_key(piece) for piece in ranking[:k]]
+            labels = [_match_key(passage) for passage in question.relevant]
+            found = [label for label in labels if any(label in piece for piece in pieces)]
+            recalls.append(len(found) / len(labels))
+            first = next((rank for rank, piece in enumerate(pieces, 1) if any(label in piece for label in labels)), None)
+            reciprocal_ranks.append(1.0 / first if first else 0.0)
+            tokens.append(estimate_tokens("\n\n".join(ranking[:k])))
+            if len(found) < len(labels):
+                missed.append(question.question)
+        results.append(Result(retriever.name, k, statistics.mean(recalls), statistics.mean(reciprocal_ranks),
+                              statistics.mean(tokens), p50_ms, p95_ms, missed))
+    return results
+
+
+def recommend(results, min_recall):
+    """The configuration with the smallest context that meets the recall bar, then the fastest"""
+    eligible = [result for result in results if result.recall >= min_recall]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda result: (result.context_tokens, result.p50_ms))
+
+
+def print_table(results):
+    click.echo(f"{'configuration':<22} {'k':>3} {'recall':>7} {'MRR':>6} {'tokens':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for result in results:
+        k = result.k if result.k is not None else '-'
+        click.echo(f"{result.configuration:<22} {k:>3} {result.recall:>7.3f} {result.mrr:>6.3f} "
+                   f"{result.context_tokens:>8.0f} {result.p50_ms:>8.2f} {result.p95_ms:>8.2f}")
+
+
+@click.command()
+@click.option('--eval-set', default=DEFAULT_EVAL_SET, show_default=True, help='Labelled questions and documents')
+@click.option('--k', 'ks', multiple=True, type=int, default=(3, 5, 8), show_default=True,
+              help='Pieces of context to score; repeat for several')
+@click.option('--window', 'windows', multiple=True, type=int, default=(400, 800), show_default=True,
+              help='Passage window sizes in characters; repeat for several')
+@click.option('--chunk-size', 'chunk_sizes', multiple=True, type=int, default=(800, 1500), show_default=True,
+              help='Embedding chunk sizes in characters (10% overlap); repeat for several')
+@click.option('--quantization', 'quantizations', multiple=True, type=click.Choice(QUANTIZATIONS),
+              default=QUANTIZATIONS, show_default=True, help='Vector quantizations to compare; repeat for several')
+@click.option('--repeat', default=3, show_default=True, help='Timed runs per question')
+@click.option('--min-recall', type=float, help='Recommend the smallest configuration with at least this recall')
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the results as JSON')
+@click.option('--verbose', is_flag=True, help='List the questions each configuration missed')
+@click.option('--strict', is_flag=True, help='Fail if any question is left out because its labels are not found')
+def main(eval_set, ks, windows, chunk_sizes, quantizations, repeat, min_recall, output, verbose, strict):
+    """Compare retrieval configurations on a labelled question set"""
+    documents, questions, dropped = load_eval_set(eval_set)
+    click.echo(f"{len(questions)} questions over {len(documents)} documents "
+               f"(~{sum(estimate_tokens(text) for text in documents.values()) // len(documents)} tokens each)")
+    if dropped:
+        click.echo(f"{len(dropped)} question(s) left out, no label found in the document:")
+        for question in dropped:
+            click.echo(f"  {question}")
+        if strict:
+            raise click.ClickException(f"{len(dropped)} question(s) have no matching label; fix {eval_set}")
+
+    retrievers = [FullDocumentRetriever()]
+    retrievers.extend(PassageRetriever(window) for window in windows)
+    embedding_client = EmbeddingClient()
+    if embedding_client.healthy():
+        retrievers.extend(EmbeddingRetriever(embedding_client, size, size // 10, quantization)
+                          for size in chunk_sizes for quantization in quantizations)
+    elif embedding_client.available:
+        click.echo(f"Embedding service at {embedding_client.base_url} is not reachable; "
+                   f"skipping embedding configurations")
+    else:
+        click.echo("EMBEDDING_SERVICE_URL is not set; skipping embedding configurations")
+
+    results = []
+    for retriever in retrievers:
+        retriever.prepare(documents)
+        results.extend(evaluate(retriever, questions, ks, repeat=repeat))
+
+    click.echo()
+    print_table(results)
+
+    if verbose:
+        for result in results:
+            for question in result.missed:
+                click.echo(f"  {result.configuration} k={result.k} missed: {question}")
+
+    if min_recall is not None:
+        best = recommend(results, min_recall)
+        if best is None:
+            click.echo(f"\nNo configuration reaches recall {min_recall}")
+        else:
+            k = f" k={best.k}" if best.k is not None else ""
+            click.echo(f"\nRecommended: {best.configuration}{k} "
+                       f"(recall {best.recall:.3f}, ~{best.context_tokens:.0f} tokens, {best.p50_ms:.2f} ms)")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump([result._asdict() for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,29 @@
 import os
+from datetime import datetime
 from flask import render_template, request, redirect, url_for, flash, jsonify, abort
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
 from app import app, db
-from models import User, Document, ChatSession, ChatMessage
+from models import User, Document, ChatSession, ChatMessage, ImportJob
 from document_manager import DocumentManager
 from rag_system import RAGSystem
+from library_qa import LibraryQA
+from citation_index import CitationIndex
+from llm_scheduler import LLMBusyError
+from chat_archive import ChatArchiver
+from db_routing import read_replica
+from cache_bus import cache_bus, DOCUMENT
+from ingestion import DocumentIngestor
+from bulk_import import BulkImporter
+from config import IMPORT_MAX_MB
 
 # Initialize document manager and RAG system
 document_manager = DocumentManager()
-rag_system = RAGSystem()
+rag_system = RAGSystem(document_manager)
+library_qa = LibraryQA(rag_system)
+citation_index = CitationIndex()
+chat_archiver = ChatArchiver(document_manager.container_client)
+document_ingestor = DocumentIngestor(document_manager, rag_system, citation_index)
+bulk_importer = BulkImporter(document_ingestor)
 
 @app.route('/')
 def index():
@@ -19,6 +33,7 @@ def index():
 
 @app.route('/dashboard')
 @login_required
+@read_replica
 def dashboard():
     # Get user's documents
     documents = Document.query.filter_by(user_id=current_user.id).filter(Document.parent_document_id.is_(None)).order_by(Document.uploaded_at.desc()).all()
@@ -50,33 +65,16 @@ def upload_document():
         # Check if it's a PDF file
         if file and file.filename.lower().endswith('.pdf'):
             try:
-                # Upload to Azure Blob Storage
-                blob_name, blob_url, citation_docs = document_manager.upload_document(
-                    file=file,
-                    title=title,
-                    user_id=current_user.id, 
-                    rag_system= rag_system
-                )
+                # Upload to Azure Blob Storage, then store and index the document
+                document_ingestor.ingest(file, title, current_user.id)
                 
-                # Save document info to database
-                new_document = Document(
-                    title=title,
-                    filename=secure_filename(file.filename),
-                    blob_url=blob_url,
-                    user_id=current_user.id,
-                    parent_document_id=None
-                )
-                db.session.add(new_document)
-                db.session.flush()
-
-                for citation_doc in citation_docs:
-                    citation_doc.parent_document_id = new_document.id
-
-                db.session.commit()
-                
-                app.logger.info(f"Document stored in database with ID: {new_document.id}")
                 flash('Document uploaded successfully to Azure Blob Storage!', 'success')
                 return redirect(url_for('dashboard'))
+            except LLMBusyError as e:
+                db.session.rollback()
+                app.logger.warning(f"Upload deferred: {str(e)}")
+                flash(f'The assistant is busy right now. Please retry the upload in {e.retry_after} seconds.', 'warning')
+                return redirect(request.url)
             except Exception as e:
                 app.logger.error(f"Upload error: {str(e)}")
                 flash(f'Error uploading document: {str(e)}', 'danger')
@@ -87,6 +85,57 @@ def upload_document():
     
     return render_template('upload.html')
 
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_library():
+    if request.method == 'POST':
+        # A library is far larger than the single-PDF upload limit (per-request limits need Flask 3.1)
+        request.max_content_length = IMPORT_MAX_MB * 1024 * 1024
+        archive = request.files.get('archive')
+        bibtex = request.files.get('bibtex')
+        archive = archive if archive and archive.filename else None
+        bibtex = bibtex if bibtex and bibtex.filename else None
+
+        if archive is None and bibtex is None:
+            flash('Select a zip of PDFs, a BibTeX file or both', 'danger')
+            return redirect(request.url)
+        if archive is not None and not archive.filename.lower().endswith('.zip'):
+            flash('The archive must be a .zip file', 'warning')
+            return redirect(request.url)
+        if bibtex is not None and not bibtex.filename.lower().endswith('.bib'):
+            flash('The BibTeX file must be a .bib file', 'warning')
+            return redirect(request.url)
+
+        try:
+            job = bulk_importer.start(current_user.id, archive=archive, bibtex=bibtex,
+                                      with_citations=request.form.get('citations') == 'on')
+        except ValueError as e:
+            flash(str(e), 'warning')
+            return redirect(request.url)
+        except Exception as e:
+            app.logger.error(f"Import error: {str(e)}")
+            flash(f'Error starting the import: {str(e)}', 'danger')
+            return redirect(request.url)
+        return redirect(url_for('import_status', job_id=job.id))
+
+    return render_template('import.html', job=None, max_mb=IMPORT_MAX_MB)
+
+@app.route('/import/<int:job_id>')
+@login_required
+def import_status(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id:
+        abort(403)
+    return render_template('import.html', job=job, max_mb=IMPORT_MAX_MB)
+
+@app.route('/import/<int:job_id>/progress')
+@login_required
+def import_progress(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(bulk_importer.progress(job))
+
 @app.route('/document/<int:document_id>/delete', methods=['POST'])
 @login_required
 def delete_document(document_id):
@@ -97,18 +146,22 @@ def delete_document(document_id):
         abort(403)
     
     try:
-        # Delete from Azure Blob Storage and Azure AI Search
-        document_manager.delete_document(
-            blob_name=document.blob_url.split('/')[-1],
-            user_id=current_user.id
-        )
+        citations = document.citations.all()
+
+        # Delete the document's and its citations' blobs from Azure Blob Storage
+        document_manager.delete_document(document, current_user.id)
+        rag_system.vector_store.delete_family(document.id, [citation.id for citation in citations])
+        rag_system.prompt_prefix_cache.pop(document.id)
+        cache_bus.publish(DOCUMENT, [document.id])
         
         # Delete associated chat sessions
         chat_sessions = ChatSession.query.filter_by(document_id=document.id).all()
         for session in chat_sessions:
-            db.session.delete(session)
+            chat_archiver.delete_session(session)
         
-        # Delete document from database
+        # Delete the citations and the document from database
+        for citation in citations:
+            db.session.delete(citation)
         db.session.delete(document)
         db.session.commit()
         
@@ -138,6 +191,9 @@ def new_chat_session(document_id):
         )
         db.session.add(new_session)
         db.session.commit()
+
+        # Start loading the document and its citations before the first question
+        rag_system.warm_session(document_id, current_user.id)
         
         return redirect(url_for('chat', session_id=new_session.id))
     
@@ -145,6 +201,7 @@ def new_chat_session(document_id):
 
 @app.route('/chat/<int:session_id>')
 @login_required
+@read_replica
 def chat(session_id):
     # Check if chat session exists and belongs to user
     chat_session = ChatSession.query.get_or_404(session_id)
@@ -154,8 +211,15 @@ def chat(session_id):
     # Get document associated with chat
     document = Document.query.get(chat_session.document_id)
     
+    # Bring back the messages of a session moved to the archive
+    if not chat_archiver.restore(chat_session):
+        flash('Earlier messages of this chat could not be loaded. Please try again later.', 'warning')
+
     # Get messages in this chat session
-    messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.timestamp).all()
+    messages = chat_archiver.messages(chat_session)
+
+    # Start loading the document and its citations before the first question
+    rag_system.warm_session(chat_session.document_id, current_user.id)
     
     return render_template('chat.html', 
                           session=chat_session, 
@@ -176,6 +240,10 @@ def send_message(session_id):
     if not user_message:
         return jsonify({'error': 'Message is required'}), 400
     
+    # Keep the history in one place before adding to it
+    if not chat_archiver.restore(chat_session):
+        return jsonify({'error': 'This chat could not be loaded. Please try again later.'}), 503
+
     # Save user message to database
     user_msg = ChatMessage(
         content=user_message,
@@ -183,6 +251,7 @@ def send_message(session_id):
         session_id=session_id
     )
     db.session.add(user_msg)
+    chat_session.last_message_at = user_msg.timestamp = datetime.utcnow()
     db.session.commit()
     
     # # Get response from RAG system
@@ -191,11 +260,22 @@ def send_message(session_id):
     # # Convert blob URL to document ID format expected by document_manager
     # document_id = document.blob_url.split('/')[-1]
     
-    rag_response = rag_system.get_answer(
-        query=user_message,
-        user_id=current_user.id,
-        document_id=chat_session.document_id
-    )
+    try:
+        rag_response = rag_system.get_answer(
+            query=user_message,
+            user_id=current_user.id,
+            document_id=chat_session.document_id
+        )
+    except LLMBusyError as e:
+        # Drop the unanswered message so the retry doesn't duplicate it
+        db.session.delete(user_msg)
+        db.session.commit()
+        response = jsonify({
+            'error': 'The assistant is busy. Please retry shortly.',
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
     
     # Save AI response to database
     ai_msg = ChatMessage(
@@ -204,6 +284,7 @@ def send_message(session_id):
         session_id=session_id
     )
     db.session.add(ai_msg)
+    chat_session.last_message_at = ai_msg.timestamp = datetime.utcnow()
     db.session.commit()
     
     return jsonify({
@@ -219,6 +300,28 @@ def send_message(session_id):
         }
     })
 
+@app.route('/library/ask', methods=['POST'])
+@login_required
+@read_replica
+def ask_library():
+    data = request.json
+    question = data.get('message')
+
+    if not question:
+        return jsonify({'error': 'Message is required'}), 400
+
+    try:
+        answer = library_qa.answer(question, current_user.id)
+    except LLMBusyError as e:
+        response = jsonify({
+            'error': 'The assistant is busy. Please retry shortly.',
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    return jsonify({'answer': answer})
+
 @app.route('/chat/<int:session_id>/delete', methods=['POST'])
 @login_required
 def delete_chat_session(session_id):
@@ -229,7 +332,7 @@ def delete_chat_session(session_id):
     
     try:
         # Delete chat session and all associated messages
-        db.session.delete(chat_session)
+        chat_archiver.delete_session(chat_session)
         db.session.commit()
         flash('Chat session deleted successfully', 'success')
     except Exception as e:
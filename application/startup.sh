@@ -0,0 +1,17 @@
+#!/bin/sh
+# App Service startup command (see startup.txt)
+
+# The shared embedding service, unless embeddings are turned off with an empty EMBEDDING_SERVICE_URL.
+# Restarted whenever it exits, so a crash doesn't leave the workers without embeddings.
+if [ "${EMBEDDING_SERVICE_URL-default}" != "" ]; then
+    (
+        while true; do
+            python embedding_service.py
+            echo "embedding service exited with status $?, restarting in 5s" >&2
+            sleep 5
+        done
+    ) &
+fi
+
+# Uploads extract, OCR (up to OCR_TIMEOUT_S) and embed within the request, far past gunicorn's 30s default
+exec gunicorn --bind 0.0.0.0:8000 --workers 4 --timeout 300 main:app
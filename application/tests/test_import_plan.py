@@ -0,0 +1,82 @@
+import fitz
+from import_plan import parse_bibtex, clean_latex, plan_import
+
+BIBTEX = r"""
+@comment{exported from Zotero}
+@string{sosp = "SOSP"}
+
+@inproceedings{barham2003xen,
+  title = {Xen and the Art of {V}irtualization},
+  author = "Barham, Paul and Dragovic, Boris",
+  booktitle = sosp # " '03",
+  year = 2003,
+  doi = {10.1145/945445.945462},
+  file = {Barham - Xen.pdf:files/12/Barham - Xen.pdf:application/pdf}
+}
+
+@article(vaswani2017attention,
+  title = "Attention Is All You Need",
+  eprint = {1706.03762},
+  archivePrefix = {arXiv}
+)
+
+@misc{untitled, note = {no title}}
+"""
+
+
+def _write_pdf(path, text, title=None):
+    pdf_document = fitz.open()
+    pdf_document.new_page().insert_text((72, 72), text)
+    if title:
+        pdf_document.set_metadata({'title': title})
+    pdf_document.save(str(path))
+    pdf_document.close()
+
+
+def test_parse_bibtex_entries_and_fields():
+    entries = parse_bibtex(BIBTEX)
+    assert [entry['key'] for entry in entries] == ['barham2003xen', 'vaswani2017attention', 'untitled']
+    xen = entries[0]
+    assert xen['type'] == 'inproceedings'
+    assert xen['title'] == 'Xen and the Art of {V}irtualization'
+    assert xen['author'] == 'Barham, Paul and Dragovic, Boris'
+    assert xen['booktitle'] == "sosp '03"  # @string macros are not expanded
+    assert xen['year'] == '2003'
+    assert entries[1]['archiveprefix'] == 'arXiv'
+
+
+def test_clean_latex():
+    assert clean_latex(r"Caf\'{e} \& {B}ar~Talk") == "Cafe & Bar Talk"
+    assert clean_latex(None) == ""
+
+
+def test_plan_matches_bibtex_entries_to_pdfs(tmp_path):
+    (tmp_path / "library.bib").write_text(BIBTEX)
+    _write_pdf(tmp_path / "Barham_-_Xen.pdf", "Xen")
+    _write_pdf(tmp_path / "attention.pdf", "arXiv:1706.03762", title="Attention Is All You Need")
+    _write_pdf(tmp_path / "other.pdf", "doi: 10.1000/other.1", title="Another Paper")
+
+    planned = plan_import(str(tmp_path))
+    by_title = {entry['title']: entry for entry in planned}
+    assert len(planned) == 3
+
+    xen = by_title['Xen and the Art of Virtualization']
+    assert xen['filename'] == 'Barham_-_Xen.pdf'
+    assert xen['doi'] == '10.1145/945445.945462'
+
+    # Not named by its entry's file field, but paired with it by title
+    attention = by_title['Attention Is All You Need']
+    assert attention['filename'] == 'attention.pdf'
+    assert attention['arxiv'] == '1706.03762'
+
+    # A PDF without an entry is imported on its own, with the DOI from its first page
+    other = by_title['Another Paper']
+    assert other['filename'] == 'other.pdf'
+    assert other['doi'] == '10.1000/other.1'
+
+
+def test_plan_keeps_entries_without_a_pdf(tmp_path):
+    (tmp_path / "library.bib").write_text(BIBTEX)
+    planned = plan_import(str(tmp_path))
+    assert [entry['filename'] for entry in planned] == [None, None]
+    assert planned[0]['doi'] == '10.1145/945445.945462'
@@ -0,0 +1,62 @@
+from datetime import datetime
+import pytest
+from reference_questions import classify_reference_question
+
+
+@pytest.mark.parametrize("query", [
+    "What are the references on attention mechanisms?",
+    "List the references that use reinforcement learning",
+    "Which references in 2019 used CNNs for segmentation?",
+    "What do the references say about dropout?",
+    "Summarize the references before 2000",
+    "What is the main contribution of this paper?",
+    "Which references are most relevant to my thesis?",
+])
+def test_topical_questions_go_to_rag(query):
+    assert classify_reference_question(query) is None
+
+
+def test_count():
+    intent = classify_reference_question("How many references does this paper have?")
+    assert intent["mode"] == "count"
+    assert intent["year_label"] is None
+
+
+def test_list_after_year():
+    intent = classify_reference_question("Which cited papers are from after 2018?")
+    assert intent["mode"] == "list"
+    assert (intent["year_min"], intent["year_max"]) == (2019, None)
+
+
+def test_list_between_years():
+    intent = classify_reference_question("List the references from 2010 to 2015")
+    assert intent["mode"] == "list"
+    assert (intent["year_min"], intent["year_max"]) == (2010, 2015)
+
+
+def test_last_years():
+    intent = classify_reference_question("Show me the references from the last 5 years")
+    assert intent["mode"] == "list"
+    assert intent["year_min"] == datetime.utcnow().year - 5
+    assert intent["venue"] is None
+
+
+def test_most_cited():
+    intent = classify_reference_question("What are the 3 most cited references?")
+    assert intent["mode"] == "top"
+
+
+def test_oldest():
+    assert classify_reference_question("What is the oldest reference?")["mode"] == "oldest"
+
+
+def test_author_filter():
+    intent = classify_reference_question("Which references are by Hinton?")
+    assert intent["mode"] == "list"
+    assert intent["author"] == "Hinton"
+
+
+def test_venue_filter_with_count():
+    intent = classify_reference_question("How many references were published in NeurIPS?")
+    assert intent["mode"] == "count"
+    assert intent["venue"] == "NeurIPS"
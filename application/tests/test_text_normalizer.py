@@ -0,0 +1,68 @@
+import os
+from text_normalizer import normalize_pages
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+BODY = ["1 Introduction", "Virtual machines are everywhere [2]."]
+
+
+def test_wrapped_title_case_reference_stays_in_references():
+    page = BODY + [
+        "References",
+        "[1] A. Author. Some Paper. In OSDI, 2002.",
+        "[2] P. Barham, B. Dragovic, K. Fraser. Xen and the Art of Virtualization:",
+        "A Practical Study",
+        "In SOSP, 2003.",
+        "[3] C. Clark. Live Migration of Virtual Machines. In NSDI, 2005.",
+    ]
+    result = normalize_pages(["\n".join(page)])
+    assert "A Practical Study" in result.references
+    assert "[3] C. Clark" in result.references
+    assert "Practical" not in result.pages[0]
+
+
+def test_reference_wrapped_onto_next_page_stays_in_references():
+    pages = [
+        "\n".join(BODY + ["References", "[1] P. Barham. Xen and the Art of Virtualization:"]),
+        "\n".join(["A Practical Study", "In SOSP, 2003.", "[2] C. Clark. Live Migration. In NSDI, 2005."]),
+    ]
+    result = normalize_pages(pages)
+    assert "A Practical Study" in result.references
+    assert "[2] C. Clark" in result.references
+
+
+def test_appendix_keyword_ends_references():
+    page = BODY + ["References", "[1] A. Author. Some Paper. In OSDI, 2002.", "Appendix A: Proofs",
+                   "The proof of Theorem 1 follows."]
+    result = normalize_pages(["\n".join(page)])
+    assert "Proofs" not in result.references
+    assert "The proof of Theorem 1 follows." in result.pages[0]
+
+
+def test_lettered_heading_after_blank_line_ends_references():
+    page = BODY + ["References", "[1] A. Author. Some Paper. In OSDI, 2002.", "", "A Hyperparameters",
+                   "We train for ten epochs."]
+    result = normalize_pages(["\n".join(page)])
+    assert "Hyperparameters" not in result.references
+    assert "We train for ten epochs." in result.pages[0]
+
+
+def test_lettered_heading_at_top_of_page_ends_references():
+    pages = [
+        "\n".join(BODY + ["References", "[1] A. Author. Some Paper. In OSDI, 2002."]),
+        "\n".join(["B.1 Additional Results", "Accuracy improves with depth."]),
+    ]
+    result = normalize_pages(pages)
+    assert "Additional Results" not in result.references
+    assert "Accuracy improves with depth." in result.pages[1]
+
+
+def test_appendix_after_a_table_stays_in_the_body():
+    # The end of the Inf2Guard paper (uploads/1/..._B4.pdf.txt): the reference list is followed by
+    # algorithms, tables and "A More Experimental Setup" with no blank line before it
+    with open(os.path.join(DATA, "inf2guard_references_and_appendix.txt"), encoding="utf-8") as f:
+        result = normalize_pages([f.read()])
+    assert "[81] Ligeng Zhu" in result.references
+    assert "Opacus" not in result.references
+    assert "We used the Opacus library" in result.pages[0]
+    assert "Experimental Setup" not in result.references
@@ -0,0 +1,141 @@
+"""
+Compressed extracted-text artifacts.
+
+Layout of an ``.apct`` blob:
+
+    b"APCT" | version (1 byte) | 3 reserved bytes | header length (uint32 LE)
+    header  JSON: {"codec", "metadata", "frames": [{"offset", "length", "label", "chars"}]}
+    frames  one zstd frame per page or section, offsets relative to the end of the header
+
+Readers fetch the preamble and header first and then only the frames they
+need, either with ranged blob downloads or from a local memory-mapped copy.
+"""
+import json
+import mmap
+import struct
+import zstandard
+
+MAGIC = b"APCT"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sB3xI")
+
+# First read covers the preamble and a typical header in one request
+HEADER_READ_SIZE = 16 * 1024
+
+
+class TextArtifactError(Exception):
+    """Raised when a blob is not a valid text artifact"""
+
+
+def build_artifact(frames, metadata=None, level=10):
+    """
+    Serialize text frames into an artifact
+
+    Args:
+        frames (list): Page or section texts, or (label, text) tuples
+        metadata (dict, optional): Stored in the header, e.g. title and page count
+        level (int): zstd compression level
+
+    Returns:
+        bytes: The artifact
+    """
+    compressor = zstandard.ZstdCompressor(level=level)
+    entries = []
+    payload = bytearray()
+    for index, frame in enumerate(frames):
+        label, text = frame if isinstance(frame, tuple) else (str(index + 1), frame)
+        data = compressor.compress(text.encode('utf-8'))
+        entries.append({"offset": len(payload), "length": len(data), "label": label, "chars": len(text)})
+        payload.extend(data)
+
+    header = json.dumps({
+        "codec": "zstd",
+        "metadata": metadata or {},
+        "frames": entries
+    }).encode('utf-8')
+    return PREAMBLE.pack(MAGIC, VERSION, len(header)) + header + bytes(payload)
+
+
+class TextArtifactReader:
+    """Reads frames of an artifact through a read_range(offset, length) callable"""
+
+    def __init__(self, read_range):
+        self.read_range = read_range
+        self._decompressor = zstandard.ZstdDecompressor()
+
+        head = read_range(0, HEADER_READ_SIZE)
+        if len(head) < PREAMBLE.size:
+            raise TextArtifactError("Artifact is truncated")
+        magic, version, header_length = PREAMBLE.unpack_from(head)
+        if magic != MAGIC or version != VERSION:
+            raise TextArtifactError(f"Unsupported artifact (magic={magic!r}, version={version})")
+
+        header_end = PREAMBLE.size + header_length
+        if len(head) < header_end:
+            head += read_range(len(head), header_end - len(head))
+        header = json.loads(head[PREAMBLE.size:header_end].decode('utf-8'))
+
+        self.metadata = header.get("metadata", {})
+        self.frames = header["frames"]
+        self.data_start = header_end
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(lambda offset, length: data[offset:offset + length])
+
+    @classmethod
+    def from_blob(cls, blob_client):
+        """Reader over an Azure blob using ranged downloads"""
+        return cls(lambda offset, length: blob_client.download_blob(offset=offset, length=length).readall())
+
+    @classmethod
+    def from_file(cls, path):
+        """Reader over a local file through a read-only memory map"""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(lambda offset, length: mapped[offset:offset + length])
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read_frames(self, indices=None):
+        """
+        Decompress the requested frames, coalescing adjacent ones into single reads
+
+        Args:
+            indices (list, optional): Frame indices (0-based); all frames when omitted
+
+        Returns:
+            list: Frame texts in the order of indices
+        """
+        if indices is None:
+            indices = range(len(self.frames))
+        wanted = sorted(set(i for i in indices if 0 <= i < len(self.frames)))
+
+        texts = {}
+        run = []
+        for index in wanted + [None]:
+            if run and (index is None or index != run[-1] + 1):
+                first, last = self.frames[run[0]], self.frames[run[-1]]
+                start = first["offset"]
+                data = self.read_range(self.data_start + start, last["offset"] + last["length"] - start)
+                for i in run:
+                    frame = self.frames[i]
+                    chunk = data[frame["offset"] - start:frame["offset"] - start + frame["length"]]
+                    texts[i] = self._decompressor.decompress(chunk).decode('utf-8')
+                run = []
+            if index is not None:
+                run.append(index)
+        return [texts[i] for i in indices if i in texts]
+
+    def read_text(self, separator="\n", exclude_labels=()):
+        """Return the full text with frames joined by separator, leaving out frames with the given labels"""
+        indices = [i for i, frame in enumerate(self.frames) if frame["label"] not in exclude_labels]
+        return separator.join(self.read_frames(indices))
+
+    def read_labeled(self, label):
+        """Return the text of the frame with the given label, or None"""
+        for index, frame in enumerate(self.frames):
+            if frame["label"] == label:
+                return self.read_frames([index])[0]
+        return None
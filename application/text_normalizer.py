@@ -0,0 +1,251 @@
+"""
+Normalization of text extracted from PDFs.
+
+PyMuPDF returns every visual line of a page, including running headers and
+footers, page numbers, words hyphenated at line ends and typographic
+ligatures. normalize_pages removes those, joins wrapped lines into
+paragraphs, marks section headings with "## " and separates the reference
+list, which is needed to resolve citations but not to answer questions.
+"""
+import re
+import statistics
+from collections import Counter, namedtuple
+
+LIGATURES = str.maketrans({
+    '\ufb00': 'ff', '\ufb01': 'fi', '\ufb02': 'fl', '\ufb03': 'ffi', '\ufb04': 'ffl', '\ufb05': 'st', '\ufb06': 'st',
+    # Non-breaking and thin spaces become plain spaces; soft hyphens and zero-width characters are dropped
+    '\u00a0': ' ', '\u2009': ' ', '\u202f': ' ',
+    '\u00ad': None, '\u200b': None, '\u200c': None, '\u200d': None, '\ufeff': None
+})
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+SPACE_RUNS = re.compile(r'[ \t]+')
+
+# Lines at the top or bottom of a page that are only a page number
+PAGE_NUMBER = re.compile(r'^(?:page\s+)?(?:\d{1,4}|[ivxlc]{1,6})(?:\s+(?:of|/)\s+\d{1,4})?$', re.IGNORECASE)
+
+# Lines inspected at each end of a page when looking for running headers and footers
+EDGE_LINES = 3
+# A digit-insensitive edge line repeated on this share of pages is a running header or footer
+BOILERPLATE_PAGE_SHARE = 0.3
+
+NUMBERED_HEADING = re.compile(r'^\d{1,2}(?:\.\d{1,2}){0,3}\.?\s+[A-Z][^.!?;,]{2,80}$')
+NAMED_HEADING = re.compile(
+    r'^(?:abstract|introduction|related work|background|preliminaries|conclusions?|discussion|evaluation|'
+    r'experiments|results|methodology|limitations|acknowledge?ments?|appendix)$', re.IGNORECASE)
+REFERENCES_HEADING = re.compile(r'^(?:\d{1,2}\.?\s*)?(?:references|bibliography)$', re.IGNORECASE)
+APPENDIX_HEADING = re.compile(r'^(?:appendix|appendices|supplementary material)\b', re.IGNORECASE)
+# "A Proofs", "B.1 Hyperparameters": only an appendix where it can't be a wrapped reference (see _is_appendix_heading)
+LETTERED_HEADING = re.compile(r'^[A-H](?:\.\d{1,2})?\.?\s+[A-Z][a-z]+(?:\s+[A-Za-z]+){0,5}$')
+MAX_HEADING_WORDS = 8
+
+# Something nearly every reference entry has within a few lines: a marker, a year, a venue, a link
+REFERENCE_SHAPE = re.compile(
+    r'^(?:\[\d{1,4}\]|\d{1,4}\.\s)|\b(?:19|20)\d{2}[a-z]?\b|\bet al\b|\bIn\s+(?:Proc|[A-Z][A-Za-z]*\b)|'
+    r'\b(?:Proceedings|Conference|Symposium|Workshop|Journal|Transactions|Press|arXiv|preprint|doi)\b|'
+    r'https?://|\bpp\.|\bvol\.', re.IGNORECASE)
+# Lines in a row without that shape: the reference list has ended where they began
+REFERENCE_GAP_LINES = 8
+
+HYPHENATED_WORD = re.compile(r'\b[a-z]+-[a-z]+\b')
+
+# Label of the artifact frame holding the reference list
+REFERENCES_LABEL = "references"
+
+NormalizedText = namedtuple('NormalizedText', ['pages', 'references', 'raw_chars', 'chars'])
+
+
+def with_references(text, references):
+    """Rejoin a normalized text with its reference list, for citation extraction and indexing"""
+    return f"{text}\n\nReferences\n{references}" if references else text
+
+
+def normalize_pages(pages):
+    """
+    Normalize the texts of a document's pages
+
+    Args:
+        pages (list): Raw text of each page, as extracted from the PDF
+
+    Returns:
+        NormalizedText: Cleaned page texts, the reference list ("" if none was found),
+            and the character counts before and after (references excluded)
+    """
+    raw_chars = sum(len(page) for page in pages)
+    page_lines = [_clean_lines(page) for page in pages]
+    page_lines = _strip_headers_and_footers(page_lines)
+    page_lines, reference_lines = _split_references(page_lines)
+
+    known_hyphenated = set()
+    for lines in page_lines:
+        for line in lines:
+            known_hyphenated.update(HYPHENATED_WORD.findall(line))
+
+    normalized = [_join_paragraphs(_dehyphenate(lines, known_hyphenated)) for lines in page_lines]
+    references = "\n".join(_dehyphenate(reference_lines, known_hyphenated))
+    return NormalizedText(normalized, references, raw_chars, sum(len(page) for page in normalized))
+
+
+def _clean_lines(text):
+    text = CONTROL_CHARACTERS.sub(' ', text.translate(LIGATURES))
+    return [SPACE_RUNS.sub(' ', line).strip() for line in text.splitlines()]
+
+
+def _edge_indices(lines):
+    """Indices of the first and last few non-empty lines of a page"""
+    filled = [i for i, line in enumerate(lines) if line]
+    return set(filled[:EDGE_LINES] + filled[-EDGE_LINES:])
+
+
+def _boilerplate_key(line):
+    return re.sub(r'\d+', '#', line.lower())
+
+
+def _strip_headers_and_footers(page_lines):
+    """Drop page numbers and lines repeated at the edges of many pages"""
+    counts = Counter()
+    for lines in page_lines:
+        counts.update({_boilerplate_key(lines[i]) for i in _edge_indices(lines)})
+    threshold = max(3, BOILERPLATE_PAGE_SHARE * len(page_lines))
+    repeated = {key for key, count in counts.items() if count >= threshold} if len(page_lines) >= 3 else set()
+
+    stripped = []
+    for lines in page_lines:
+        edges = _edge_indices(lines)
+        stripped.append([line for i, line in enumerate(lines)
+                         if i not in edges or not (PAGE_NUMBER.match(line) or _boilerplate_key(line) in repeated)])
+    return stripped
+
+
+def _split_references(page_lines):
+    """Remove the reference list (from the last references heading to where it ends, see _references_end)"""
+    start = None
+    for page_index, lines in enumerate(page_lines):
+        for line_index, line in enumerate(lines):
+            if REFERENCES_HEADING.match(line):
+                start = (page_index, line_index)
+    if start is None:
+        return page_lines, []
+
+    end = _references_end(page_lines, start)
+    body, references = [], []
+    for page_index, lines in enumerate(page_lines):
+        kept = []
+        for line_index, line in enumerate(lines):
+            position = (page_index, line_index)
+            if position == start:
+                continue
+            if start < position and (end is None or position < end):
+                references.append(line)
+            else:
+                kept.append(line)
+        body.append(kept)
+    return body, references
+
+
+def _references_end(page_lines, start):
+    """
+    Position of the first line after the reference list, or None if it runs to the end
+
+    The list ends at an appendix heading, or where lines stop looking like
+    reference entries (appendix text, tables or algorithms after the list
+    without a heading the patterns know).
+    """
+    previous = ""
+    gap_start, gap_lines = None, 0
+    for page_index in range(start[0], len(page_lines)):
+        lines = page_lines[page_index]
+        first = start[1] + 1 if page_index == start[0] else 0
+        for line_index in range(first, len(lines)):
+            line = lines[line_index]
+            if not line:
+                continue
+            if _is_appendix_heading(line, lines[:line_index], previous):
+                return page_index, line_index
+            if REFERENCE_SHAPE.search(line):
+                gap_start, gap_lines = None, 0
+            else:
+                if gap_start is None:
+                    gap_start = (page_index, line_index)
+                gap_lines += 1
+                if gap_lines >= REFERENCE_GAP_LINES:
+                    return gap_start
+            previous = line
+    return None
+
+
+def _is_appendix_heading(line, page_before, previous):
+    """
+    Whether a line inside the reference list is an appendix heading
+
+    Wrapped reference lines often look like lettered headings ("A Practical
+    Study"), so those only count at the top of a page or after a blank line,
+    once the reference before them (previous) is complete.
+    """
+    if len(line.split()) > MAX_HEADING_WORDS:
+        return False
+    if APPENDIX_HEADING.match(line):
+        return True
+    if not LETTERED_HEADING.match(line):
+        return False
+    starts_block = not any(page_before) or not page_before[-1]
+    return starts_block and (not previous or previous.endswith('.'))
+
+
+def _dehyphenate(lines, known_hyphenated):
+    """Join words split across lines, keeping the hyphen of compounds the document writes hyphenated"""
+    joined = []
+    carry = ""
+    for line in lines:
+        if carry:
+            if line and line[0].islower():
+                first, _, rest = line.partition(' ')
+                head, _, fragment = carry.rpartition(' ')
+                prefix = fragment[:-1]
+                word = f"{prefix}-{first}" if f"{prefix}-{first}".lower() in known_hyphenated else prefix + first
+                line = f"{head} {word}".lstrip() + (f" {rest}" if rest else "")
+            else:
+                joined.append(carry)
+            carry = ""
+        if re.search(r'[a-z]-$', line):
+            carry = line
+        else:
+            joined.append(line)
+    if carry:
+        joined.append(carry)
+    return joined
+
+
+def _is_heading(line):
+    if len(line.split()) > MAX_HEADING_WORDS:
+        return False
+    return bool(NUMBERED_HEADING.match(line) or NAMED_HEADING.match(line))
+
+
+def _join_paragraphs(lines):
+    """Unwrap lines into paragraphs and mark section headings"""
+    lengths = [len(line) for line in lines if line]
+    if not lengths:
+        return ""
+    paragraph_end = 0.75 * statistics.median(lengths)
+
+    blocks = []
+    paragraph = []
+
+    def flush():
+        if paragraph:
+            blocks.append(" ".join(paragraph))
+            paragraph.clear()
+
+    for line in lines:
+        if not line:
+            flush()
+        elif _is_heading(line):
+            flush()
+            blocks.append(f"## {line}")
+        else:
+            paragraph.append(line)
+            # A short line ending a sentence usually ends its paragraph
+            if line[-1] in '.!?:' and len(line) < paragraph_end:
+                flush()
+    flush()
+    return "\n".join(blocks)
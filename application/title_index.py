@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from app import db
+from models import ResolvedPaper
+from titles import DOI_PATTERN, normalize_title, trigrams
+from config import TITLE_MATCH_THRESHOLD, TITLE_INDEX_REFRESH_S
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+
+class TitleIndex:
+    """
+    In-memory trigram index over every paper title and DOI resolved so far.
+
+    Entries are persisted in ResolvedPaper and loaded lazily; each worker
+    picks up papers resolved elsewhere every TITLE_INDEX_REFRESH_S seconds.
+    """
+
+    def __init__(self, threshold=TITLE_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._papers = []
+        self._postings = defaultdict(list)
+        self._by_doi = {}
+        self._by_normalized = {}
+        self._loaded_ids = set()
+        self._watermark = 0
+        self._last_refresh = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, citation_title):
+        """
+        Find a resolved paper matching a citation title (or a DOI inside it)
+
+        Returns:
+            dict: Paper metadata with title, openAccessPdf, paperId and doi, or None on a miss
+        """
+        self._refresh()
+        with self._lock:
+            doi_match = DOI_PATTERN.search(citation_title or "")
+            if doi_match and doi_match.group(1).lower() in self._by_doi:
+                self.hits += 1
+                return self._by_doi[doi_match.group(1).lower()]
+
+            normalized = normalize_title(citation_title)
+            if not normalized:
+                return None
+            exact = self._by_normalized.get(normalized)
+            if exact is not None:
+                self.hits += 1
+                return exact
+
+            query = trigrams(normalized)
+            shared = defaultdict(int)
+            for gram in query:
+                for index in self._postings.get(gram, ()):
+                    shared[index] += 1
+
+            best, best_score = None, 0.0
+            for index, count in shared.items():
+                paper = self._papers[index]
+                score = count / (len(query) + paper["trigram_count"] - count)
+                if score > best_score:
+                    best, best_score = paper, score
+
+            if best is not None and best_score >= self.threshold:
+                self.hits += 1
+                return best
+            self.misses += 1
+            return None
+
+    def add(self, title, open_access_pdf=None, paper_id=None, doi=None):
+        """Record a paper resolved through the API so later lookups stay local"""
+        normalized = normalize_title(title)
+        if not normalized:
+            return
+        try:
+            if paper_id and ResolvedPaper.query.filter_by(paper_id=paper_id).first():
+                return
+            paper = ResolvedPaper(
+                title=title[:500],
+                normalized_title=normalized[:500],
+                doi=doi.lower()[:200] if doi else None,
+                paper_id=paper_id,
+                open_access_pdf=open_access_pdf[:1000] if open_access_pdf else None
+            )
+            # Savepoint so a concurrent insert of the same paper doesn't poison the caller's transaction
+            with db.session.begin_nested():
+                db.session.add(paper)
+            with self._lock:
+                self._index(paper)
+        except Exception as e:
+            logger.error(f"Error adding '{title}' to title index: {e}")
+
+    def _refresh(self):
+        """Load papers resolved since the last refresh"""
+        if time.monotonic() - self._last_refresh < TITLE_INDEX_REFRESH_S:
+            return
+        self._last_refresh = time.monotonic()
+        try:
+            papers = ResolvedPaper.query.filter(
+                ResolvedPaper.id > self._watermark).order_by(ResolvedPaper.id).all()
+            with self._lock:
+                for paper in papers:
+                    self._index(paper)
+                    self._watermark = paper.id
+            if papers:
+                logger.info(f"Title index loaded {len(papers)} papers ({len(self._papers)} total)")
+        except Exception as e:
+            logger.error(f"Error refreshing title index: {e}")
+
+    def _index(self, paper):
+        if paper.id in self._loaded_ids:
+            return
+        self._loaded_ids.add(paper.id)
+        grams = trigrams(paper.normalized_title)
+        entry = {
+            "title": paper.title,
+            "openAccessPdf": paper.open_access_pdf,
+            "paperId": paper.paper_id,
+            "doi": paper.doi,
+            "trigram_count": len(grams)
+        }
+        index = len(self._papers)
+        self._papers.append(entry)
+        for gram in grams:
+            self._postings[gram].append(index)
+        self._by_normalized.setdefault(paper.normalized_title, entry)
+        if paper.doi:
+            self._by_doi.setdefault(paper.doi, entry)
@@ -0,0 +1,16 @@
+"""
+Normalization of paper titles and DOIs, shared by the title index, citation metadata and library imports.
+"""
+import re
+
+DOI_PATTERN = re.compile(r'\b(10\.\d{4,9}/[^\s"<>]+)', re.IGNORECASE)
+
+
+def normalize_title(title):
+    """Lowercase alphanumeric words separated by single spaces"""
+    return " ".join(re.findall(r'[a-z0-9]+', (title or "").lower()))
+
+
+def trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
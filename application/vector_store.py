@@ -0,0 +1,405 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import namedtuple
+import numpy as np
+from cache import LRUCache
+from cache_bus import cache_bus, VECTORS
+from config import (VECTOR_STORE_DIR, VECTOR_CACHE_SIZE, VECTOR_CACHE_MB, VECTOR_QUANTIZATION, VECTOR_RESCORE_FACTOR,
+                    VECTOR_BLOB_PREFIX)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ('none', 'int8', 'binary')
+
+# Number of set bits in every byte value, for Hamming distances between packed binary codes
+# on numpy versions without np.bitwise_count
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+# Candidates rescored exactly per result, when VECTOR_RESCORE_FACTOR is not set. Sign bits lose
+# more of the ranking than int8, so binary search shortlists more.
+DEFAULT_RESCORE_FACTORS = {'none': 1, 'int8': 4, 'binary': 16}
+
+# Rough per-chunk overhead of a Python str, for sizing shards against the memory budget
+STR_OVERHEAD_BYTES = 50
+
+# What a worker keeps in memory per document. With quantization, codes are int8 (4x smaller than
+# float32) or one bit per dimension (32x smaller); the float vectors stay memory-mapped on disk
+# and only the rows of rescored candidates are read. scales are the per-vector scales of int8 codes.
+VectorIndex = namedtuple('VectorIndex', ['chunks', 'vectors', 'codes', 'scales'])
+
+# The indexes of one document family, with the family directory's mtime when they were read
+VectorShard = namedtuple('VectorShard', ['members', 'version'])
+
+
+class ChunkVectorStore:
+    """
+    Chunk texts and their embeddings, sharded by document family.
+
+    A family is a primary document and its citations, which is what one chat
+    searches; its files live in one directory (vectors/<family id>/), mirrored
+    to blob storage when a container is given. A family is loaded into memory
+    as one shard on first access, from local disk or else from blob storage,
+    and stays resident under VECTOR_CACHE_MB per worker, least recently used
+    shards evicted first. save and delete update resident shards in place,
+    and a shard is reread when another process changes its directory.
+
+    Searches run a first pass over quantized codes (int8 or binary), then
+    rescore the best top_k * rescore_factor candidates exactly against the
+    float32 vectors.
+    """
+
+    def __init__(self, base_dir=VECTOR_STORE_DIR, quantization=VECTOR_QUANTIZATION,
+                 rescore_factor=VECTOR_RESCORE_FACTOR, container_client=None, max_bytes=VECTOR_CACHE_MB * 1024 * 1024):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown vector quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+        self.base_dir = base_dir
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor or DEFAULT_RESCORE_FACTORS[quantization]
+        self.container_client = container_client
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.cache = LRUCache(max_entries=VECTOR_CACHE_SIZE, max_bytes=max_bytes, sizeof=self._shard_bytes)
+        self._lock = threading.Lock()
+        cache_bus.subscribe(VECTORS, self._invalidate)
+
+    def save(self, document_id, chunks, vectors, family_id=None):
+        """
+        Store the chunks and embeddings of one document
+
+        Args:
+            family_id: Primary document of the document's family; the document itself when omitted
+        """
+        family_id = family_id if family_id is not None else document_id
+        matrix = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(self._family_dir(family_id), exist_ok=True)
+        self._remove_legacy(document_id)
+
+        # Write to temporary files and rename, so readers never see a half-written or mismatched pair
+        vectors_path, chunks_path = self._vectors_path(family_id, document_id), self._chunks_path(family_id, document_id)
+        with open(f"{vectors_path}.tmp", 'wb') as f:
+            np.save(f, matrix)
+        with open(f"{chunks_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(chunks, f)
+        os.replace(f"{chunks_path}.tmp", chunks_path)
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        # Codes older than their vectors are rebuilt on load, so writing them last is safe
+        codes, scales = self._write_codes(family_id, document_id, matrix)
+        self._upload(family_id, document_id)
+
+        if codes is not None:
+            index = VectorIndex(chunks, np.load(vectors_path, mmap_mode='r'), codes, scales)
+        else:
+            index = VectorIndex(chunks, matrix, None, None)
+        self._update_shard(family_id, document_id, index)
+        cache_bus.publish(VECTORS, [family_id])
+        logger.info(f"Stored {len(chunks)} chunk vectors for document {document_id} (family {family_id})")
+
+    def has(self, document_id, family_id=None):
+        return self._index(document_id, family_id) is not None
+
+    def load(self, document_id, family_id=None):
+        """Return (chunks, vectors) for a document, or (None, None) if not indexed"""
+        index = self._index(document_id, family_id)
+        if index is None:
+            return None, None
+        return index.chunks, index.vectors
+
+    def warm(self, family_id):
+        """Load a family's shard ahead of the first question"""
+        self._shard(family_id)
+
+    def delete(self, document_id, family_id=None):
+        """Delete one document's vectors"""
+        family_id = family_id if family_id is not None else document_id
+        self._remove_legacy(document_id)
+        for path in self._document_paths(family_id, document_id):
+            if os.path.exists(path):
+                os.remove(path)
+        self._delete_blobs([self._blob_name(family_id, document_id, extension) for extension in ('.npy', '.json')])
+        self._update_shard(family_id, document_id, None)
+        cache_bus.publish(VECTORS, [family_id])
+
+    def delete_family(self, family_id, document_ids=()):
+        """
+        Delete the vectors of a whole family
+
+        Args:
+            document_ids: Members that may still be stored in the flat pre-shard layout
+        """
+        self.cache.pop(family_id)
+        for document_id in [family_id, *document_ids]:
+            self._remove_legacy(document_id)
+        shutil.rmtree(self._family_dir(family_id), ignore_errors=True)
+        if self.container_client is not None:
+            try:
+                prefix = f"{VECTOR_BLOB_PREFIX}{family_id}/"
+                self._delete_blobs([blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix)])
+            except Exception as e:
+                logger.error(f"Error listing vector blobs of family {family_id}: {e}")
+        cache_bus.publish(VECTORS, [family_id])
+
+    def search(self, document_ids, query_vector, top_k=8, family_id=None):
+        """
+        Rank the chunks of the given documents by cosine similarity to the query
+
+        Args:
+            family_id: Family of all the documents; each document is its own family when omitted
+
+        Returns:
+            list: (document_id, chunk, score) tuples, best first
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+
+        # First pass: approximate scores of every chunk, from the codes when quantized
+        indexes, scores = [], []
+        for document_id in document_ids:
+            index = self._index(document_id, family_id)
+            if index is None or not len(index.chunks):
+                continue
+            indexes.append((document_id, index))
+            scores.append(self._approximate_scores(index, query))
+        if not indexes:
+            return []
+        offsets = np.cumsum([0] + [len(part) for part in scores])
+        scores = np.concatenate(scores)
+
+        shortlist = top_k * self.rescore_factor if self.quantization != 'none' else top_k
+        if len(scores) > shortlist:
+            candidates = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        else:
+            candidates = np.arange(len(scores))
+        candidates.sort()
+        owners = np.searchsorted(offsets, candidates, side='right') - 1
+
+        results = []
+        for position in np.unique(owners):
+            document_id, index = indexes[position]
+            rows = candidates[owners == position] - offsets[position]
+            if self.quantization == 'none':
+                exact = scores[rows + offsets[position]]
+            else:
+                # Second pass: exact scores, reading only the shortlisted rows of the memory-mapped vectors.
+                # Vectors are normalised by the embedding service, so dot product is cosine
+                exact = np.asarray(index.vectors[rows], dtype=np.float32) @ query
+            results.extend((document_id, index.chunks[row], float(score)) for row, score in zip(rows, exact))
+        results.sort(key=lambda result: result[2], reverse=True)
+        return results[:top_k]
+
+    def memory_bytes(self):
+        """Approximate bytes held by this worker's resident shards (memory-mapped vectors excluded)"""
+        return self.cache.bytes
+
+    def _index(self, document_id, family_id):
+        family_id = family_id if family_id is not None else document_id
+        self._adopt_legacy(document_id, family_id)
+        return self._shard(family_id).members.get(document_id)
+
+    def _shard(self, family_id):
+        """Return a family's resident shard, loading it on first access or after another process changed it"""
+        shard = self.cache.get(family_id)
+        version = self._family_version(family_id)
+        if shard is not None and shard.version == version:
+            return shard
+
+        if version is None and self.container_client is not None:
+            self._download_family(family_id)
+        members = {}
+        directory = self._family_dir(family_id)
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith('.npy'):
+                    document_id = _parse_id(name[:-len('.npy')])
+                    try:
+                        members[document_id] = self._read_index(family_id, document_id)
+                    except Exception as e:
+                        logger.error(f"Error loading vectors of document {document_id}: {e}")
+        # Taken after reading, since rebuilding missing codes touches the directory
+        shard = VectorShard(members, self._family_version(family_id))
+        self.cache.set(family_id, shard)
+        return shard
+
+    def _invalidate(self, family_id, same_host):
+        """Drop a family another process changed; on another host the change also made this host's files stale"""
+        if family_id is None:
+            self.cache.clear()
+            return
+        self.cache.pop(family_id)
+        if same_host or self.container_client is None:
+            return
+        # Renamed first so only one worker removes it; the next load downloads the family again
+        directory = self._family_dir(family_id)
+        stale = f"{directory}.stale-{os.getpid()}"
+        try:
+            os.rename(directory, stale)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(stale, ignore_errors=True)
+
+    def _update_shard(self, family_id, document_id, index):
+        """Apply one document's change to a resident shard without rereading the family"""
+        with self._lock:
+            shard = self.cache.get(family_id)
+            if shard is None:
+                return
+            members = dict(shard.members)
+            if index is None:
+                members.pop(document_id, None)
+            else:
+                members[document_id] = index
+            self.cache.set(family_id, VectorShard(members, self._family_version(family_id)))
+
+    def _read_index(self, family_id, document_id):
+        with open(self._chunks_path(family_id, document_id), encoding='utf-8') as f:
+            chunks = json.load(f)
+        if self.quantization == 'none':
+            return VectorIndex(chunks, np.load(self._vectors_path(family_id, document_id)), None, None)
+        vectors = np.load(self._vectors_path(family_id, document_id), mmap_mode='r')
+        codes, scales = self._read_codes(family_id, document_id, vectors)
+        return VectorIndex(chunks, vectors, codes, scales)
+
+    def _shard_bytes(self, shard):
+        total = 0
+        for index in shard.members.values():
+            total += sum(len(chunk) + STR_OVERHEAD_BYTES for chunk in index.chunks)
+            if index.codes is not None:
+                total += index.codes.nbytes + (index.scales.nbytes if index.scales is not None else 0)
+            else:
+                total += index.vectors.nbytes
+        return total
+
+    def _family_version(self, family_id):
+        try:
+            return os.stat(self._family_dir(family_id)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _approximate_scores(self, index, query):
+        if self.quantization == 'none':
+            return index.vectors @ query
+        if self.quantization == 'int8':
+            return (index.codes @ query) * index.scales
+        # Fewer differing sign bits means a smaller angle
+        codes, query_bits = index.codes, np.packbits(query > 0)
+        if hasattr(np, 'bitwise_count'):
+            if codes.shape[1] % 8 == 0:
+                # Count bits a 64-bit word at a time
+                codes, query_bits = codes.view(np.uint64), query_bits.view(np.uint64)
+            return -np.bitwise_count(np.bitwise_xor(codes, query_bits)).sum(axis=1, dtype=np.int32)
+        return -POPCOUNT[np.bitwise_xor(codes, query_bits)].sum(axis=1, dtype=np.int32)
+
+    def _quantize(self, matrix):
+        """Return (codes, scales) for float vectors in this store's quantization; binary codes have no scales"""
+        if self.quantization == 'int8':
+            # One symmetric scale per vector keeps the full int8 range for every chunk
+            scales = np.abs(matrix).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            codes = np.round(matrix / scales[:, None]).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        return np.packbits(matrix > 0, axis=1), None
+
+    def _write_codes(self, family_id, document_id, matrix):
+        if self.quantization == 'none':
+            return None, None
+        codes, scales = self._quantize(matrix)
+        path = self._codes_path(family_id, document_id, self.quantization)
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, codes=codes, **({"scales": scales} if scales is not None else {}))
+        os.replace(f"{path}.tmp", path)
+        return codes, scales
+
+    def _read_codes(self, family_id, document_id, vectors):
+        """Read a document's codes, building them from the float vectors when they are missing or stale"""
+        path = self._codes_path(family_id, document_id, self.quantization)
+        vectors_path = self._vectors_path(family_id, document_id)
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(vectors_path):
+            with np.load(path) as stored:
+                return stored["codes"], stored["scales"] if "scales" in stored else None
+        return self._write_codes(family_id, document_id, np.asarray(vectors, dtype=np.float32))
+
+    def _upload(self, family_id, document_id):
+        """Mirror a document's vectors and chunks to blob storage, so other hosts can load the family"""
+        if self.container_client is None:
+            return
+        try:
+            for extension, path in (('.npy', self._vectors_path(family_id, document_id)),
+                                    ('.json', self._chunks_path(family_id, document_id))):
+                with open(path, 'rb') as f:
+                    self.container_client.get_blob_client(
+                        self._blob_name(family_id, document_id, extension)).upload_blob(f, overwrite=True)
+        except Exception as e:
+            logger.error(f"Error uploading vectors of document {document_id}: {e}")
+
+    def _download_family(self, family_id):
+        """Fetch a family's vectors from blob storage into the local directory"""
+        try:
+            prefix = f"{VECTOR_BLOB_PREFIX}{family_id}/"
+            blobs = [blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix)]
+            if not blobs:
+                return
+            directory = self._family_dir(family_id)
+            os.makedirs(directory, exist_ok=True)
+            # Chunks first: a family member appears once its .npy is renamed into place
+            for blob_name in sorted(blobs, key=lambda name: name.endswith('.npy')):
+                path = os.path.join(directory, blob_name[len(prefix):])
+                # Several workers may download the same family at once
+                temporary_path = f"{path}.{os.getpid()}.tmp"
+                with open(temporary_path, 'wb') as f:
+                    self.container_client.get_blob_client(blob_name).download_blob().readinto(f)
+                os.replace(temporary_path, path)
+            logger.info(f"Downloaded {len(blobs)} vector blobs of family {family_id}")
+        except Exception as e:
+            logger.error(f"Error downloading vectors of family {family_id}: {e}")
+
+    def _delete_blobs(self, blob_names):
+        if self.container_client is None or not blob_names:
+            return
+        try:
+            self.container_client.delete_blobs(*blob_names, raise_on_any_failure=False)
+        except Exception as e:
+            logger.error(f"Error deleting vector blobs: {e}")
+
+    def _adopt_legacy(self, document_id, family_id):
+        """Move a document stored in the flat pre-shard layout into its family directory"""
+        legacy_vectors = os.path.join(self.base_dir, f"{document_id}.npy")
+        if not os.path.isfile(legacy_vectors):
+            return
+        legacy_chunks = os.path.join(self.base_dir, f"{document_id}.json")
+        try:
+            with open(legacy_chunks, encoding='utf-8') as f:
+                chunks = json.load(f)
+            self.save(document_id, chunks, np.load(legacy_vectors), family_id=family_id)
+        except Exception as e:
+            logger.error(f"Error moving vectors of document {document_id} into family {family_id}: {e}")
+
+    def _remove_legacy(self, document_id):
+        for name in [f"{document_id}.npy", f"{document_id}.json"] + [f"{document_id}.{q}.npz" for q in QUANTIZATIONS]:
+            path = os.path.join(self.base_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _document_paths(self, family_id, document_id):
+        return [self._vectors_path(family_id, document_id), self._chunks_path(family_id, document_id)] + [
+            self._codes_path(family_id, document_id, quantization) for quantization in QUANTIZATIONS[1:]]
+
+    def _blob_name(self, family_id, document_id, extension):
+        return f"{VECTOR_BLOB_PREFIX}{family_id}/{document_id}{extension}"
+
+    def _family_dir(self, family_id):
+        return os.path.join(self.base_dir, str(family_id))
+
+    def _vectors_path(self, family_id, document_id):
+        return os.path.join(self._family_dir(family_id), f"{document_id}.npy")
+
+    def _chunks_path(self, family_id, document_id):
+        return os.path.join(self._family_dir(family_id), f"{document_id}.json")
+
+    def _codes_path(self, family_id, document_id, quantization):
+        return os.path.join(self._family_dir(family_id), f"{document_id}.{quantization}.npz")
+
+
+def _parse_id(name):
+    """Document ids are integers in the app; other keys (as in retrieval_eval) stay strings"""
+    return int(name) if name.isdigit() else name